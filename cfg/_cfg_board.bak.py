@@ -16,6 +16,7 @@ bid = 1    # should match physical id on board
 # Firmware
 # firmware_file = '../init/tetra_v7p1_impl_5.bit'
 firmware_file = 'init/tetra_v13p9.xsa'
+firmware_sim  = False # use the offline firmware simulator (firmware_sim.py)
 
 
 # ============================================================================ #
@@ -54,6 +55,71 @@ udp_ori_mac = 'c0:ff:ee:c0:ff:ee'
 wf_fs      = 512e6 # sampling rate
 wf_lut_len = 2**20 # look-up table length
 wf_fft_len = 1024  # fft length
+wf_single_precision = False # faster synthesis, within 1 LSB (not bit-exact)
+wf_fft_workers = -1 # synthesis fft threads, -1 is one per core
+
+
+# comb waveform cache, shared by the drones on a board
+wave_cache_dir   = 'tmp/wave_cache' # relative to the root directory
+wave_cache_quota = 2**30 # max size [bytes], 0 disables the cache
+
+# analysis result cache (same sweep and arguments), shared by the drones on a board
+analysis_cache_dir   = 'tmp/analysis_cache' # relative to the root directory
+analysis_cache_quota = 2**26 # max size [bytes], 0 disables the cache
+
+# board comb synthesis service (comb_service.py), shared by the drones on a board
+# drones synthesize combs themselves if it is not running
+comb_service_socket  = '/tmp/comb_service.sock' # unix socket, None to not use
+comb_service_workers = 0  # worker processes, 0 is one per core
+comb_service_timeout = 60 # max wait for a comb [s]
+
+# target comb tone planning (tone_plan.py)
+# nudge or drop tones sharing an fft bin, near bin edges, or too close together
+tone_plan          = True
+tone_edge_margin   = 10e3  # min distance of a tone from its fft bin edge [Hz]
+tone_min_spacing   = 50e3  # min distance between tones (ddc overlap) [Hz]
+tone_max_nudge     = 20e3  # max nudge of a resonator tone [Hz]
+tone_max_nudge_cal = 250e3 # max nudge of a calibration tone [Hz]
+
+# resonator fitting (resonator_fit.py, fitTargResonators)
+fit_workers = 2 # processes refitting stragglers one by one, 0 refits in the drone
+
+# IQ loop calibration table (iq_cal.py), after every target sweep
+iq_cal_auto = True
+
+# tone power optimization (tone_power.py, targetSweepPower, optimizeTonePowers)
+tone_power_sweeps  = 11     # target sweeps in the power series
+tone_power_step_db = -1     # tone power step per sweep [dB], from the current comb down
+tone_power_method  = 'asym' # 'asym' (dip asymmetry, fast) or 'fit' (fitted nonlinearity a)
+tone_power_targets = {'asym':0.6, 'fit':0.5} # metric to drive tones at (bifurcation a ~0.77)
+
+# closed loop target tuning (loops.py, tuneTargets)
+tune_f_tol       = 1e3 # frequency step tolerance [Hz]
+tune_a_tol       = 0.1 # relative amplitude step tolerance
+tune_max_move    = 50e3 # max tone move per iteration [Hz], at most half way to a neighbour
+tune_max_iters   = 10  # max iterations (sweeps)
+tune_time_budget = 600 # no iteration started that would end after this [s]
+tune_shrink      = 0.5 # sweep bandwidth and points factor per iteration
+tune_min_bw      = 0.1 # min sweep channel bandwidth [MHz]
+tune_min_steps   = 200 # min sweep points
+
+# vna sweep resonator finder (findVnaResonators): 'alt' (filters and peaks)
+# or 'mf' (matched filter, more sensitive to shallow/overlapping resonators)
+vna_finder = 'alt'
+vna_chunk_bins   = 64 # comb bins per window of the (chunked) search, 0 is all at once
+vna_overlap_bins = 4  # comb bins of overlap each side of a window
+
+# resonator catalog: stable IDs across sweeps (catalogResonators)
+res_catalog_auto = True # after each findVnaResonators/findTargResonators
+res_catalog_tol  = 20e3 # [Hz] max match distance, after the common shift
+
+# skip hardware writes (comb, nclo, channel count) that match what is loaded
+hw_skip_unchanged = True
+
+
+# ============================================================================ #
+# accumulator properties
+accum_length = 2**19-1 # timestream accumulation length [2 samples] (24 bits)
 
 
 # ============================================================================ #
@@ -61,6 +127,20 @@ wf_fft_len = 1024  # fft length
 sweep_steps    = 2000 # number of sweep steps
 sweep_accums   = 5   # number of repeats of each sweep (averaging)
 target_chan_bw = 1 # target sweep channel bandwidth [MHz]
+sweep_chunk_steps = 100 # LO steps per partial result published to queen
+
+# sweep speed/SNR profiles
+# accum_length:   accumulation length used during the sweep
+# accums:         number of accumulator reads averaged per step
+#                 (None uses sweep_accums)
+# settle_periods: wait between reads, in accumulation periods
+# discard:        accumulator reads discarded after each LO step
+sweep_profile  = 'standard' # default profile
+sweep_profiles = {
+    'fast':     {'accum_length':2**17-1, 'accums':1,    'settle_periods':1.5, 'discard':1},
+    'standard': {'accum_length':2**19-1, 'accums':None, 'settle_periods':1.5, 'discard':1},
+    'deep':     {'accum_length':2**21-1, 'accums':20,   'settle_periods':1.5, 'discard':2},
+}
 
 
 
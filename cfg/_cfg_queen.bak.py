@@ -16,4 +16,9 @@ ssh_pass = 'xilinx'
 
 ## drone monitoring
 master_drone_list_file = 'master_drone_list.yaml'
-monitor_interval = 10 # s
\ No newline at end of file
+monitor_interval = 10 # s
+
+## analysis offload (queen_commands/analysis_offload.py)
+offload_workers = 4         # processes, one drone each
+offload_dir = 'tmp/offload' # drone data mirrors, relative to dir_root
+offload_expire = 3600       # results left in Redis for the drones [s]
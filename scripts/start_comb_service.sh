@@ -0,0 +1,14 @@
+#!/bin/bash
+
+# Become root
+sudo bash <<EOF
+
+# Source the environment
+source /home/xilinx/xilinx/activate
+
+# Change to the directory containing comb_service.py for PATH issues
+cd /home/xilinx/primecam_readout/src
+
+# Run the comb_service.py script
+exec /usr/local/share/pynq-venv/bin/python3 /home/xilinx/primecam_readout/src/comb_service.py
+EOF
@@ -20,6 +20,7 @@ import alcove_commands.alcove_base as alcove_base
 import alcove_commands.tones as tones
 import alcove_commands.sweeps as sweeps
 import alcove_commands.analysis as analysis
+import alcove_commands.loops as loops
 
 from config import parentDir
 import sys_info
@@ -59,10 +60,19 @@ def _com():
         42:sweeps.targetSweep,
         # 43:sweeps.targetSweepFull,
         44:sweeps.customSweep,
+        46:sweeps.targetSweepPower,
+        47:loops.tuneTargets,
         # 45:sweeps.loChopSweep,
         50:analysis.findVnaResonators,
         51:analysis.findTargResonators,
+        52:analysis.fitTargResonators,
+        53:analysis.calibrateTargSweep,
+        54:analysis.catalogResonators,
         55:analysis.findCalTones,
+        56:analysis.analysisCache,
+        57:analysis.getAnalysisInputs,
+        58:analysis.putAnalysisResults,
+        59:analysis.optimizeTonePowers,
         60:sys_info.sys_info,
         61:sys_info.sys_info_v,
         70:alcove_base.timestreamOn,
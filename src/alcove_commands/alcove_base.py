@@ -23,6 +23,87 @@ except ImportError: cfg_b = None
 try: import xrfdc # type: ignore
 except ImportError: xrfdc = None
 
+# partial result, cancellation, and data fetch hooks
+# these are set by drone.py for the duration of each command
+_stream_hooks = {'publish':None, 'cancelled':None, 'fetch':None}
+
+
+
+
+# ============================================================================ #
+# STREAMING FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# CommandCancelled
+class CommandCancelled(Exception):
+    '''Raised when a running command is cancelled by the queen.'''
+    pass
+
+
+# ============================================================================ #
+# setStreamHooks
+def setStreamHooks(publish=None, cancelled=None, fetch=None):
+    '''Set the partial result publishing, cancellation, and fetch hooks.
+
+    publish:   (callable) Takes wrapped data and publishes it to the queen.
+    cancelled: (callable) Returns True if the queen has requested a cancel.
+    fetch:     (callable) Takes a Redis key and returns its value (bytes).
+    '''
+
+    _stream_hooks['publish'] = publish
+    _stream_hooks['cancelled'] = cancelled
+    _stream_hooks['fetch'] = fetch
+
+
+# ============================================================================ #
+# publishPartial
+def publishPartial(file, data):
+    '''Publish a partial result to the queen, while the command still runs.
+    Does nothing if no publish hook is set (e.g. running locally).
+
+    file: (dict) File attributes. See board_io.file class.
+    data: The partial data.
+    '''
+
+    publish = _stream_hooks['publish']
+    if publish is not None:
+        publish(io.returnWrapper(file, data))
+
+
+# ============================================================================ #
+# checkCancelled
+def checkCancelled():
+    '''Raise CommandCancelled if the queen has requested a cancel.
+    '''
+
+    cancelled = _stream_hooks['cancelled']
+    if cancelled is not None and cancelled():
+        raise CommandCancelled("Command cancelled by request.")
+
+
+# ============================================================================ #
+# fetchData
+def fetchData(key):
+    '''Data the queen left for this command under a Redis key (pickled),
+    e.g. results of analysis run on the queen.
+
+    key: (str) Redis key, given in the command arguments.
+    '''
+
+    import pickle
+
+    fetch = _stream_hooks['fetch']
+    if fetch is None:
+        raise RuntimeError("No fetch hook set (not running under drone.py).")
+
+    d = fetch(key)
+    if d is None:
+        raise KeyError(f"Redis key {key} not found (expired?).")
+
+    return pickle.loads(d)
+
 
 
 
@@ -137,11 +218,18 @@ def writeChannelCount(num_chans):
     num_chans = 0 if num_chans is None else num_chans # fails to 0
     num_chans = num_chans & 0xFFFF # ensure data is 16 bits
 
+    from alcove_commands.hw_context import hwContext
+
     udp_control = cfg_b.firmware.gpio_udp_info_control
 
     # current drone channel
     chan = cfg_b.drid
 
+    hw = hwContext(chan)
+    if hw.loaded('chan_count', num_chans):
+        return
+    hw.setLoaded('chan_count', None)
+
     count_shift = 18 # Shift for count enable (as opposed to data)
     drone_shift = 16 # Shift for drone ID
     edge_trigger = 19 # Shift for edge-triggered write
@@ -153,10 +241,24 @@ def writeChannelCount(num_chans):
     udp_control.write(0x08, (1<<edge_trigger) | val)  # edge trigger
     udp_control.write(0x08, val)
 
+    hw.setLoaded('chan_count', num_chans)
+
 
 # ============================================================================ #
 # generateWaveDdr4
-def generateWaveDdr4(freq_list, amp_list, phi):  
+_wf_spectrum = {} # reused spectrum workspace by (lut_len, dtype)
+def generateWaveDdr4(freq_list, amp_list, phi, single=None):  
+    """Comb waveform look-up table.
+
+    freq_list: (1D array of floats) Tone frequencies [Hz].
+    amp_list:  (1D array of floats) Tone amplitudes.
+    phi:       (1D array of floats) Tone phases.
+    single:    (bool) Synthesize in single precision (complex64).
+        Faster, but within 1 LSB (not bit-exact) after int16 truncation.
+        Default cfg_b.wf_single_precision.
+
+    Return: (wave, dphi, freq_actual)
+    """
 
     import numpy as np
 
@@ -165,113 +267,77 @@ def generateWaveDdr4(freq_list, amp_list, phi):
     amp_list = np.real(amp_list)
     phi = np.real(phi)
 
+    if single is None:
+        single = getattr(cfg_b, 'wf_single_precision', False)
+    dtype = np.complex64 if single else np.complex128
+
     fs = cfg_b.wf_fs # 512e6 
     lut_len = cfg_b.wf_lut_len # 2**20
     fft_len = cfg_b.wf_fft_len # 1024
     k = np.int64(np.round(freq_list/(fs/lut_len)))
     freq_actual = k*(fs/lut_len)
-    X = np.zeros(lut_len,dtype='complex')
+
+    # spectrum workspace, reused between combs
+    X = _wf_spectrum.get((lut_len, dtype))
+    if X is None:
+        X = _wf_spectrum[(lut_len, dtype)] = np.zeros(lut_len, dtype=dtype)
+    else:
+        X.fill(0)
     #phi = np.random.uniform(-np.pi, np.pi, np.size(freq_list))
-    for i in range(np.size(k)):
-        X[k[i]] = np.exp(-1j*phi[i])*amp_list[i] # multiply by amplitude
-    x = np.fft.ifft(X) * lut_len
+    X[k] = np.exp(-1j*phi)*amp_list # multiply by amplitude
+    x = _ifft(X)
+    x *= lut_len
+
     bin_num = np.int64(np.round(freq_actual / (fs / fft_len)))
     f_beat = bin_num*fs/fft_len - freq_actual
     dphi0 = f_beat/(fs/fft_len)*2**16
-    if np.size(dphi0) > 1:
-        dphi = np.concatenate((dphi0, np.zeros(fft_len - np.size(dphi0))))
-    else:
-        z = np.zeros(fft_len)
-        z[0] = dphi0
-        dphi = z
+    dphi = np.zeros(fft_len)
+    dphi[:np.size(dphi0)] = dphi0
     return x, dphi, freq_actual
 
 
+# ============================================================================ #
+# _ifft
+def _ifft(X):
+    """Inverse FFT of X into a new array of the same precision.
+    Uses multi-threaded scipy.fft if available (cfg_b.wf_fft_workers threads).
+    """
+
+    try: 
+        import scipy.fft as sfft
+        return sfft.ifft(X, workers=getattr(cfg_b, 'wf_fft_workers', -1))
+    except ImportError:
+        import numpy as np
+        return np.fft.ifft(X).astype(X.dtype, copy=False)
+
+
 # ============================================================================ #
 # _getSnapData
 # capture data from ADC
 def _getSnapData(chan, mux_sel, wrap=False):
 
     import numpy as np
-    from pynq import MMIO # type: ignore
+    from alcove_commands.hw_context import hwContext
+    from alcove_commands.snap_decode import decodeSnap
 
     # WIDE BRAM
-    if chan==1:
-        axi_wide = cfg_b.firmware.chan1.axi_wide_ctrl# 0x0 max count, 0x8 capture rising edge trigger
-        base_addr_wide = 0x00_A007_0000
-    elif chan==2:
-        axi_wide = cfg_b.firmware.chan2.axi_wide_ctrl
-        base_addr_wide = 0x00_B000_0000
-    elif chan==3:
-        axi_wide = cfg_b.firmware.chan3.axi_wide_ctrl
-        base_addr_wide = 0x00_B000_8000
-    elif chan==4:
-        axi_wide = cfg_b.firmware.chan4.axi_wide_ctrl
-        base_addr_wide = 0x00_8200_0000
-    else:
-        return "Does not compute"
+    hw = hwContext(chan)
+    axi_wide = hw.axi_wide # 0x0 max count, 0x8 capture rising edge trigger
     max_count = 32768
     axi_wide.write(0x08, mux_sel<<1) # mux select 0-adc, 1-pfb, 2-ddc, 3-accum
     axi_wide.write(0x00, max_count - 16) # -4 to account for extra delay in write counter state machine
     axi_wide.write(0x08, mux_sel<<1 | 0)
     axi_wide.write(0x08, mux_sel<<1 | 1)
     axi_wide.write(0x08, mux_sel<<1 | 0)
-    mmio_wide_bram = MMIO(base_addr_wide,max_count)
-    wide_data = mmio_wide_bram.array[0:8192]# max/4, bram depth*word_bits/32bits
-    if mux_sel==0:
-        #adc parsing
-        up0, lw0 = np.int16(wide_data[0::4] >> 16), np.int16(wide_data[0::4] & 0x0000ffff)
-        up1, lw1 = np.int16(wide_data[1::4] >> 16), np.int16(wide_data[1::4] & 0x0000ffff)
-        I = np.zeros(4096)
-        Q = np.zeros(4096)
-        Q[0::2] = lw0
-        Q[1::2] = up0
-        I[0::2] = lw1
-        I[1::2] = up1
-    elif mux_sel==1:
-        # pfb
-        chunk0 = (np.uint64(wide_data[1::4]) << np.uint64(32)) + np.uint64(wide_data[0::4])
-        chunk1 = (np.uint64(wide_data[2::4]) << np.uint64(32)) + np.uint64(wide_data[1::4])
-        q0 = np.int64((chunk0 & 0x000000000003ffff)<<np.uint64(46))/2**32
-        i0 = np.int64(((chunk0>>18) & 0x000000000003ffff)<<np.uint64(46))/2**32
-        q1 = np.int64(((chunk1>>4)  & 0x000000000003ffff)<<np.uint64(46))/2**32
-        i1 = np.int64(((chunk1>>22)  & 0x000000000003ffff)<<np.uint64(46))/2**32
-        I = np.zeros(4096)
-        Q = np.zeros(4096)
-        Q[0::2] = q0/2**14
-        Q[1::2] = q1/2**14
-        I[0::2] = i0/2**14
-        I[1::2] = i1/2**14
-    elif mux_sel==2:
-        # ddc
-        chunk0 = (np.uint64(wide_data[1::4]) << np.uint64(32)) + np.uint64(wide_data[0::4])
-        chunk1 = (np.uint64(wide_data[2::4]) << np.uint64(32)) + np.uint64(wide_data[1::4])
-        q0 = np.int64((chunk0 & 0x00000000000fffff)<<np.uint64(45))/2**32
-        i0 = np.int64(((chunk0>>19) & 0x00000000000fffff)<<np.uint64(45))/2**32
-        q1 = np.int64(((chunk1>>6)  & 0x00000000000fffff)<<np.uint64(45))/2**32
-        i1 = np.int64(((chunk1>>25)  & 0x00000000000fffff)<<np.uint64(45))/2**32
-        I = np.zeros(4096)
-        Q = np.zeros(4096)
-        Q[0::2] = q0/2**13
-        Q[1::2] = q1/2**13
-        I[0::2] = i0/2**13
-        I[1::2] = i1/2**13
-    elif mux_sel==3:
-        # accum
-        q0 = (np.int32(wide_data[1::4])).astype("float")
-        i0 = (np.int32(wide_data[0::4])).astype("float")
-        q1 = (np.int32(wide_data[3::4])).astype("float")
-        i1 = (np.int32(wide_data[2::4])).astype("float")
-        I = np.zeros(4096)
-        Q = np.zeros(4096)
-        Q[0::2] = q0
-        Q[1::2] = q1
-        I[0::2] = i0
-        I[1::2] = i1
-        I, Q = I[4:], Q[4:]
+    wide_data = hw.wide_data # max/4, bram depth*word_bits/32bits
+    
+    # 0-adc, 1-pfb, 2-ddc, 3-accum (first 4 samples dropped)
+    # z is a reused buffer, overwritten by the next capture
+    z = decodeSnap(wide_data, mux_sel)
+    I, Q = z.real, z.imag
 
     if wrap:
-        return io.returnWrapper(io.file.IQ_generic, (I,Q))
+        return io.returnWrapper(io.file.IQ_generic, (I.copy(),Q.copy()))
     else:
         return I, Q
 
@@ -303,45 +369,26 @@ def _setNCLO(chan, lofreq):
     # implemented in tones._writeComb and alcove_base._setNCLO
 
     # import xrfdc
-    rf_data_conv = cfg_b.firmware.usp_rf_data_converter_0
-    name = os.path.splitext(os.path.basename(cfg_b.firmware_file))[0]
-    if int(name[7:9]) >= 13:
-        tb_indices = {
-            1: [1,0,1,3], 2: [1,1,1,2], 3: [0,1,1,0], 4: [0,0,1,1]}
-    else:
-        tb_indices = {
-            1: [0,0,1,3], 2: [0,1,1,2], 3: [1,0,1,1], 4: [1,1,1,0]}
+    from alcove_commands.hw_context import hwContext
 
-    ii = tb_indices[chan]
-    adc = rf_data_conv.adc_tiles[ii[0]].blocks[ii[1]]
-    dac = rf_data_conv.dac_tiles[ii[2]].blocks[ii[3]]
+    hw = hwContext(chan)
+    if hw.loaded('nclo', lofreq):
+        return
+    hw.setLoaded('nclo', None)
 
-    adc.MixerSettings['Freq'] = lofreq
-    dac.MixerSettings['Freq'] = lofreq
-    adc.UpdateEvent(xrfdc.EVENT_MIXER)
-    dac.UpdateEvent(xrfdc.EVENT_MIXER)
+    hw.adc.MixerSettings['Freq'] = lofreq
+    hw.dac.MixerSettings['Freq'] = lofreq
+    hw.adc.UpdateEvent(xrfdc.EVENT_MIXER)
+    hw.dac.UpdateEvent(xrfdc.EVENT_MIXER)
 
-def _getNCLO(chan):
+    hw.setLoaded('nclo', lofreq)
 
-    rf_data_conv = cfg_b.firmware.usp_rf_data_converter_0
-
-    # adc tiles; adc blocks; dac tiles; dac blocks
-    if chan == 1: 
-        i = [0,0,1,3]
-    elif chan == 2:
-        i = [0,1,1,2]
-    elif chan == 3:
-        i = [1,0,1,1]
-    elif chan == 4:
-        i = [1,1,1,0]
-    else:
-        print("_getNCLO: Invalid chan!")
-        return
+def _getNCLO(chan):
 
-    adc = rf_data_conv.adc_tiles[i[0]].blocks[i[1]]
-    dac = rf_data_conv.dac_tiles[i[2]].blocks[i[3]]
+    from alcove_commands.hw_context import hwContext
 
-    f_lo = adc.MixerSettings['Freq']
+    # same adc block as _setNCLO (firmware version dependent)
+    f_lo = hwContext(chan).adc.MixerSettings['Freq']
 
     return f_lo
 
@@ -383,17 +430,9 @@ def getNCLO(chan=None):
 # _setNCLO2
 def _setNCLO2(chan, lofreq):
     import numpy as np
-    mix = cfg_b.firmware.mix_freq_set_0
-    if chan == 1:
-        offset = 0
-    elif chan == 2:
-        offset = 4
-    elif chan == 3:
-        offset = 8
-    elif chan == 4:
-        offset = 12
-    else:
-        return "Does not compute"
+    from alcove_commands.hw_context import hwContext
+    hw = hwContext(chan)
+    mix, offset = hw.mix, hw.mix_offset
     # set fabric nclo frequency 
     # only for small frequency sweeps
     # 0x00 -  frequency[21 downto 0] 
@@ -407,9 +446,54 @@ def _setNCLO2(chan, lofreq):
         return digi_val, actual_freq
 
     digi_val, actual_freq = nclo_num(lofreq)
+    if hw.loaded('fine_nclo', digi_val):
+        return
+    hw.setLoaded('fine_nclo', None)
     mix.write(offset, digi_val) # frequency
+    hw.setLoaded('fine_nclo', digi_val)
     return
 
+
+# ============================================================================ #
+# _setAccumLength
+def _setAccumLength(chan, accum_length=None):
+    '''Set the accumulation length and reset the accumulators.
+    Note that this also sets the timestream packet rate.
+
+    accum_length: (int) Accumulation length (24 bits).
+        None uses the configured (timestream) accum_length.
+    '''
+
+    from alcove_commands.hw_context import hwContext
+
+    dsp_regs = hwContext(chan).dsp_regs
+
+    if accum_length is None:
+        accum_length = cfg_b.accum_length
+
+    # 0x08 -  accum_len[23 downto 0], accum_rst[24 downto 24], sync_in[26 downto 26] (start dac)
+    sync_in = 2**26
+    accum_rst = 2**24  # (active rising edge)
+    accum_length = int(accum_length) & 0xFFFFFF
+
+    dsp_regs.write(0x08, accum_length | sync_in)
+    dsp_regs.write(0x08, accum_length | accum_rst | sync_in)
+
+
+# ============================================================================ #
+# accumPeriod
+def accumPeriod(accum_length=None):
+    '''Duration of one accumulation [s].
+    The accumulators take two samples per count, at the DAC rate.
+
+    accum_length: (int) Accumulation length. None uses configured.
+    '''
+
+    if accum_length is None:
+        accum_length = cfg_b.accum_length
+
+    return (int(accum_length) + 1)*2/cfg_b.wf_fs
+
 # ============================================================================ #
 # _setAtten
 def _setAtten(chan,direction,attenuation):
@@ -62,6 +62,42 @@ def _stitchS21m(S21m, bw=500, sw=100):
     return a_n.flatten()                   # reshape to 1D and return
 
 
+# ============================================================================ #
+# _stitchS21mRatio
+def _stitchS21mRatio(S21m, bw=500, sw=5):
+    """Scale S21 mags so the bin ends align (multiplicative stitch).
+    Neighbouring bins end and start at the same frequency, so the ratio of
+    the few samples at the ends is the tone gain ratio, which dips away
+    from the ends don't bias (unlike the wide medians of _stitchS21m).
+
+    S21m: (array of floats) 1D array of S21 complex modulus.
+    bw:   (int) Width of the stitch bins.
+    sw:   (int) Width of slice (at ends) of each stitch bin to average.
+    """
+
+    import numpy as np
+
+    a = S21m.reshape(-1, bw)                              # reshape into bins
+    g = _ratioGains(a, sw)
+
+    return (a*g[:, None]).flatten()
+
+
+# ============================================================================ #
+# _ratioGains
+def _ratioGains(a, sw=5):
+    """Stitch gain of each bin (row of S21 mags a) from the ratio of the sw
+    samples at neighbouring bin ends, see _stitchS21mRatio.
+    Only the sw samples at each end of a row are used.
+    """
+
+    import numpy as np
+
+    r = a[:-1, -sw:].mean(axis=1)/a[1:, :sw].mean(axis=1) # neighbour gain ratios
+
+    return np.concatenate(([1.], np.cumprod(r)))          # gains are cumulative
+
+
 # ============================================================================ #
 # _resonatorIndicesInS21
 def _resonatorIndicesInS21(f, Z, stitch_bw=500, stitch_sw=100, f_hi=50, f_lo=1, prom_dB=1, distance=30, width=(5,100), testing=False):
@@ -210,7 +246,141 @@ def _findResonators_alt(f, Z,
 
 
 # ============================================================================ #
-# _findMins
+# _findResonators_mf
+def _findResonators_mf(f, Z,
+                       widths=(5e3, 10e3, 20e3, 40e3), snr=8, distance=5e3,
+                       stitch=True, stitch_sw=5):
+    '''Find resonators by matched filtering |S21| with Lorentzian dips.
+    The fractional dip depth (|S21| below its continuum) is cross correlated
+    (fft) with zero mean Lorentzian templates of a few widths, and peaks
+    picked on the largest output in units of its (robust) noise std.
+    O(N log N); more sensitive to shallow and overlapping resonators
+    than _findResonators_alt.
+
+    f:   (1D array of floats) Frequency of S21 samples.
+    Z:   (1D array of complex) Forward transmission S_21 as complex.
+    widths:      (tuple of floats) Template (resonance) FWHMs [Hz].
+    snr:         (float) Detection threshold, in filter noise std.
+    distance:    (float) Min distance between resonators [Hz].
+    stitch:      (bool) Whether to stitch (comb discontinuities).
+    stitch_sw:   (int) Discontinuity edge size for alignment [bins].
+    '''
+
+    import numpy as np
+    from scipy.ndimage import median_filter
+    from scipy.signal import fftconvolve, find_peaks
+
+    # type enforcement
+    # required since parameters can get passed as strings
+    if isinstance(widths, str):
+        widths = [float(w) for w in widths.strip('()[] ').split(',') if w.strip()]
+    widths      = [float(w) for w in np.atleast_1d(widths)]
+    snr         = float(snr)
+    distance    = float(distance)
+    stitch      = str(stitch) in {True, 1, '1', 'True', 'true'}
+    stitch_sw   = int(stitch_sw)
+
+    df = np.abs(f[1] - f[0]).real
+    y = np.abs(Z)
+
+    # stitch discontinuities (multiplicative, from the shared bin ends)
+    if stitch:
+        y = _stitchS21mRatio(y, bw=cfg_b.sweep_steps, sw=stitch_sw)
+
+    # continuum: bin medians, median filtered over neighbouring bins (so
+    # resonance tails don't pull it), interpolated between bin centres
+    N = cfg_b.sweep_steps
+    med = median_filter(np.median(y.reshape(-1, N), axis=1), size=5, mode='nearest')
+    base = np.interp(np.arange(len(y)), np.arange(len(med))*N + (N - 1)/2, med)
+    d = 1 - y/base # fractional dip depth
+
+    # matched filter bank, each output in its noise std
+    s = np.full(len(d), -np.inf)
+    for w in widths:
+        hw = max(w/df/2, 1)
+        x = np.arange(-int(4*hw), int(4*hw) + 1)
+        t = 1/(1 + (x/hw)**2)
+        t -= t.mean()
+        t /= np.linalg.norm(t)
+        out = fftconvolve(d, t, mode='same') # symmetric template
+        std = 1.4826*np.median(np.abs(out - np.median(out)))
+        np.maximum(s, out/std, out=s)
+
+    # prominence: not the shoulders of deep dips
+    i_peaks, _ = find_peaks(
+        s, height=snr, prominence=snr, distance=max(int(distance/df), 1))
+
+    return f[i_peaks]
+
+# ============================================================================ #
+# _findResonatorsChunked
+def _findResonatorsChunked(finder, S21, chunk_bins=64, overlap_bins=4,
+                           merge_tol=5e3, **kwargs):
+    """Run a vna resonator finder over overlapping windows of whole comb bins
+    (sweep_steps samples, as stitched by the finders), so memory is bounded
+    by the window rather than the sweep. Each window keeps the peaks in its
+    core; peaks closer than merge_tol across core edges are merged.
+
+    finder:       (function) e.g. _findResonators_alt, finder(f, Z, **kwargs).
+    S21:          (2D array) f, Z as saved by vnaSweep (e.g. memory mapped).
+    chunk_bins:   (int) Comb bins in each window core.
+    overlap_bins: (int) Comb bins added each side (filter edge effects).
+    merge_tol:    (float) Merge distance across core edges [Hz].
+    """
+
+    import numpy as np
+
+    N = cfg_b.sweep_steps
+    n_bins = S21.shape[1]//N
+    chunk_bins, overlap_bins = int(chunk_bins), int(overlap_bins)
+
+    f_res = []
+    for b0 in range(0, n_bins, chunk_bins):
+        b1 = min(b0 + chunk_bins, n_bins)
+        w0, w1 = max(b0 - overlap_bins, 0), min(b1 + overlap_bins, n_bins)
+
+        # copies, so only this window is read from a memory map
+        f = np.array(S21[0, w0*N:w1*N])
+        Z = np.array(S21[1, w0*N:w1*N])
+
+        # core: from its first sample to the next core's first (shared) sample
+        lo = f[(b0 - w0)*N].real if b0 > 0 else -np.inf
+        hi = f[(b1 - w0)*N].real if b1 < n_bins else np.inf
+        fr = np.real(finder(f, Z, **kwargs))
+        f_res.append(fr[(fr >= lo) & (fr < hi)])
+
+        _releaseMapped(S21, (b1 - overlap_bins)*N) # not needed again
+
+    f_res = np.sort(np.concatenate(f_res))
+    if len(f_res) > 1:
+        f_res = f_res[np.concatenate(([True], np.diff(f_res) >= merge_tol))]
+
+    return f_res
+
+
+# ============================================================================ #
+# _releaseMapped
+def _releaseMapped(a, n):
+    """Drop the (read only) memory mapped pages of the rows of 2D array a
+    before sample n, so they don't stay resident. Nothing if a isn't mapped.
+    """
+
+    import mmap
+
+    m = getattr(a, '_mmap', None)
+    if m is None or n <= 0 or not hasattr(m, 'madvise'):
+        return
+
+    # a starts at its file offset within the map (mapped from a granularity)
+    start = a.offset % mmap.ALLOCATIONGRANULARITY
+    for r in range(a.shape[0]):
+        lo = start + r*a.strides[0]
+        hi = lo + n*a.strides[1]
+        lo = -(-lo//mmap.PAGESIZE)*mmap.PAGESIZE # whole pages within [lo, hi)
+        hi = hi//mmap.PAGESIZE*mmap.PAGESIZE
+        if hi > lo:
+            m.madvise(mmap.MADV_DONTNEED, lo, hi - lo)
+
 def _findMins(f, Z, stitch_bw=500):
     """Find the minimum (resonator peak) in each targ bin.
     """
@@ -240,19 +410,116 @@ def _findMins(f, Z, stitch_bw=500):
     return f_res.real
 
 
+# ============================================================================ #
+# _cachedResult
+def _cachedResult(name, files, params, compute):
+    """Result (array) of an analysis, through the analysis cache (see
+    wave_cache, cfg_b.analysis_cache_quota): reused if the analysis was run
+    on the same versions of its input files with the same parameters.
+
+    name:    (str) Analysis name.
+    files:   (tuple of dicts) Input files (see board_io.file).
+    params:  (tuple) Parameters (str or numbers), e.g. from _normParams.
+    compute: (function) No argument function computing the result.
+    """
+
+    import os
+    import numpy as np
+    import alcove_commands.wave_cache as wave_cache
+
+    # input file versions (paths include the drone) and this code's version
+    versions = [
+        f"{file['dname']}/{file['fname']}_{io.mostRecentTimestamp(file)}"
+        for file in files]
+    key = wave_cache.key(
+        name, os.path.getmtime(__file__), *versions, *map(str, params))
+
+    d = wave_cache.load(name, key, ['result'], cache='analysis')
+    if d is not None:
+        print(f"{name}: cached result.")
+        return np.array(d['result'])
+
+    result = compute()
+    wave_cache.save(name, key, {'result':result}, cache='analysis')
+
+    return result
+
+
+# ============================================================================ #
+# _normParams
+def _normParams(func, kwargs):
+    """Arguments of func as a canonical str, with defaults filled in.
+    Arguments from the queen arrive as strings, so values of numeric
+    parameters (number defaults) are compared as floats.
+    """
+
+    import inspect
+    import numbers
+
+    sig = inspect.signature(func)
+    b = sig.bind_partial(**kwargs)
+    b.apply_defaults()
+
+    def norm(k, v):
+        d = sig.parameters[k].default
+        if isinstance(d, numbers.Number) and not isinstance(d, bool):
+            try: return float(v)
+            except (TypeError, ValueError): pass
+        return v
+
+    return ', '.join(
+        f'{k}={norm(k, v)!r}' for k, v in sorted(b.arguments.items()))
+
+
+# ============================================================================ #
+# _findVnaResonators
+def _findVnaResonators(finder, **kwargs):
+    """Run a vna resonator finder on the vnaSweep S21 (chunked if
+    cfg_b.vna_chunk_bins).
+    """
+
+    S21 = io.load(io.file.s21_vna, mmap_mode='r') # read as needed
+
+    if cfg_b.vna_chunk_bins:
+        return _findResonatorsChunked(
+            finder, S21, cfg_b.vna_chunk_bins, cfg_b.vna_overlap_bins, **kwargs)
+
+    f, Z = S21
+    return finder(f, Z, **kwargs)
+
+
 # ============================================================================ #
 # findVnaResonators
-def findVnaResonators(**kwargs):
+def findVnaResonators(method=None, **kwargs):
     """Find the resonator peak frequencies from vnaSweep S21.
     See findResonators() for possible arguments.
     Note that vnaSweep must be run first.
+
+    method: (str) 'alt' (_findResonators_alt) or 'mf' (matched filter,
+        _findResonators_mf); kwargs are passed to it.
+        Default is cfg_b.vna_finder, passed only the kwargs it takes
+        (callers may give the arguments of both finders).
     """
 
-    f, Z = io.load(io.file.s21_vna)
+    import inspect
+
+    default = method is None
+    method = cfg_b.vna_finder if default else method
+    finder = _findResonators_mf if method == 'mf' else _findResonators_alt
+    if default: # only the kwargs this finder takes
+        params = inspect.signature(finder).parameters
+        kwargs = {k:v for k, v in kwargs.items() if k in params}
+
     # f_res = _findResonators(f, Z, **kwargs)
-    f_res = _findResonators_alt(f, Z, **kwargs)
+    f_res = _cachedResult(
+        'findVnaResonators', (io.file.s21_vna,),
+        (method, cfg_b.vna_chunk_bins, cfg_b.vna_overlap_bins,
+         _normParams(finder, kwargs)),
+        lambda: _findVnaResonators(finder, **kwargs))
 
     io.save(io.file.f_res_vna, f_res)
+    if cfg_b.res_catalog_auto:
+        _catalogResonators('vna')
 
     return io.returnWrapper(io.file.f_res_vna, f_res)
 
@@ -264,27 +531,300 @@ def findTargResonators(**kwargs):
     See findResonators() for possible arguments.
     Note that targSweep must be run first.
     """
-    f, Z = io.load(io.file.s21_targ)
-    f_res = _findMins(f, Z, **kwargs)
+    f_res = _cachedResult(
+        'findTargResonators', (io.file.s21_targ,), (_normParams(_findMins, kwargs),),
+        lambda: _findMins(*io.load(io.file.s21_targ), **kwargs))
 
     io.save(io.file.f_res_targ, f_res)
+    if cfg_b.res_catalog_auto:
+        _catalogResonators('targ')
 
     return io.returnWrapper(io.file.f_res_targ, f_res)
 
 
+
 # ============================================================================ #
-# findCalTones
-def findCalTones(f_lo=0.1, f_hi=50, tol=2, max_tones=10):
-    """Determine the indices of calibration tones.
-    
-    f_hi:      (float) Highpass filter cutoff frequency (data units).
-    f_lo:      (float) lowpass filter cutoff frequency (data units).
-    tol:       (float) Reject tones tol*std_noise from continuum.
-    max_tones: (int) Maximum number of tones to return.
+# fitTargResonators
+def fitTargResonators(update_f_res=False):
+    """Fit the resonator S21 model to every tone of the targSweep S21.
+    Gives sub-step resonance frequencies and Q values (see resonator_fit).
+    Note that targSweep must be run first.
+
+    update_f_res: (bool) Also save the fitted f0 (where converged) as
+        f_res_targ, in place of the findTargResonators minima.
+
+    Return: (2D array) One row per resonator_fit.FIT_PARAMS, one column per tone.
+    """
+
+    import time
+    import numpy as np
+    from alcove_commands import resonator_fit
+
+    update_f_res = str(update_f_res) in {True, 1, '1', 'True', 'true'}
+
+    f, Z = io.load(io.file.s21_targ)
+    try:
+        N_steps = int(io.load(io.file.s21_targ_meta)['N_steps'])
+    except Exception: # sweeps from before the meta file
+        N_steps = cfg_b.sweep_steps
+
+    t0 = time.perf_counter()
+    p = resonator_fit.fitResonators(
+        f.real.reshape(-1, N_steps), Z.reshape(-1, N_steps))
+    fit = np.array([p[k] for k in resonator_fit.FIT_PARAMS], dtype=float)
+    print(f"fitTargResonators: {fit.shape[1]} resonators in "
+          f"{time.perf_counter() - t0:.1f} s, "
+          f"{np.count_nonzero(p['converged'])} converged.")
+
+    io.save(io.file.fit_res_targ, fit)
+
+    if update_f_res:
+        f_res = np.where(p['converged'], p['f0'], _findMins(f, Z, N_steps))
+        io.save(io.file.f_res_targ, f_res)
+
+    return io.returnWrapper(io.file.fit_res_targ, fit)
+
+# ============================================================================ #
+# _saveIqCal
+def _saveIqCal(f, Z, N_steps):
+    """Calibrate the IQ loops of a targ sweep (see iq_cal) and save the table.
+    """
+
+    import time
+    import numpy as np
+    from alcove_commands import iq_cal
+
+    t0 = time.perf_counter()
+    cal = iq_cal.calibrate(f.real.reshape(-1, N_steps), Z.reshape(-1, N_steps))
+    print(f"IQ calibration: {cal.shape[1]} tones in "
+          f"{(time.perf_counter() - t0)*1e3:.0f} ms, "
+          f"{np.count_nonzero(np.isnan(cal[5]))} without slope.")
+
+    io.save(io.file.iq_cal, cal)
+
+    return cal
+
+
+# ============================================================================ #
+# calibrateTargSweep
+def calibrateTargSweep():
+    """IQ loop calibration (circle centre, rotation, phase slope) of every
+    tone of the targSweep S21, for timestream to frequency shift conversion.
+    Runs after every targSweep if cfg_b.iq_cal_auto.
+    Note that targSweep must be run first.
+
+    Return: (2D array) One row per iq_cal.CAL_PARAMS, one column per tone.
+    """
+
+    f, Z = io.load(io.file.s21_targ)
+    try:
+        N_steps = int(io.load(io.file.s21_targ_meta)['N_steps'])
+    except Exception: # sweeps from before the meta file
+        N_steps = cfg_b.sweep_steps
+
+    cal = _saveIqCal(f, Z, N_steps)
+
+    return io.returnWrapper(io.file.iq_cal, cal)
+
+
+# ============================================================================ #
+# _tonePowerTable
+def _tonePowerTable(method='asym', target=None):
+    """optimizeTonePowers table (see tone_power.POWER_PARAMS) of the
+    latest targetSweepPower series.
+    """
+
+    import time
+    import numpy as np
+    from alcove_commands import tone_power
+
+    S21 = io.load(io.file.s21_power)  # (sweeps, 2, tones x steps)
+    amps = io.load(io.file.a_power)   # (sweeps, tones)
+    N_steps = int(io.load(io.file.s21_power_meta)['N_steps'])
+    P, R = amps.shape
+    f = S21[:, 0].real.reshape(P, R, N_steps)
+    Z = S21[:, 1].reshape(P, R, N_steps)
+
+    t0 = time.perf_counter()
+    if method == 'asym':
+        metric, law = np.abs(tone_power.asymmetry(np.abs(Z))), None
+    elif method == 'fit':
+        metric, law = tone_power.nonlinearity(f, Z), 2
+    else:
+        raise ValueError(f"Unknown method '{method}'. Options: ['asym', 'fit']")
+
+    amps_opt, state = tone_power.optimalAmps(amps, metric, target, power_law=law)
+    print(f"optimizeTonePowers: {P} sweeps of {R} tones in "
+          f"{time.perf_counter() - t0:.1f} s, {np.count_nonzero(state == 0)} "
+          f"at target, {np.count_nonzero(state == 1)} below, "
+          f"{np.count_nonzero(state == -1)} past.")
+
+    return np.vstack((amps_opt, state, metric))
+
+
+# ============================================================================ #
+# optimizeTonePowers
+def optimizeTonePowers(method=None, target=None, write_comb=True):
+    """Choose the amplitude of every resonator tone from the latest
+    targetSweepPower series (all tones at once, see tone_power): where its
+    dip skew (nonlinearity) first reaches target, below bifurcation.
+    The current comb with these amplitudes is saved as the custom comb
+    and written. Note that targetSweepPower must be run first.
+
+    method:     (str) Metric: 'asym' (dip asymmetry, fast) or 'fit'
+        (fitted nonlinearity a, see resonator_fit).
+        Default cfg_b.tone_power_method.
+    target:     (float) Metric to drive each tone at.
+        Default cfg_b.tone_power_targets[method].
+    write_comb: (bool) Save and write the custom comb (True).
+
+    Return: (2D array) Rows tone_power.POWER_PARAMS, then the metric of
+        each sweep. One column per resonator tone.
+    """
+
+    import numpy as np
+
+    write_comb = str(write_comb) in {True, 1, '1', 'True', 'true'}
+    method = method if method else cfg_b.tone_power_method
+    target = float(target) if target else cfg_b.tone_power_targets[method]
+
+    table = _cachedResult(
+        'optimizeTonePowers', (io.file.s21_power, io.file.a_power),
+        (method, target), lambda: _tonePowerTable(method, target))
+
+    io.save(io.file.tone_power, table)
+
+    if write_comb:
+        from alcove_commands.tones import writeCombFromCustomList
+
+        amps_opt = table[0]
+        R = len(amps_opt)
+        a_comb = io.load(io.file.a_tones_comb).astype(float)
+        a_comb[:R] = amps_opt # resonator tones first, as targetSweepPower
+        createCustomCombFiles(
+            freqs_rf=io.load(io.file.f_rf_tones_comb), amps=a_comb,
+            phis=io.load(io.file.p_tones_comb))
+        io.save(io.file.a_res_targ, amps_opt) # kept by writeTargCombFromTargSweep
+        writeCombFromCustomList()
+
+    return io.returnWrapper(io.file.tone_power, table)
+
+
+# ============================================================================ #
+# _vnaResonatorWindows
+def _vnaResonatorWindows(S21, f_res, half=200, sw=5):
+    """Stitched |S21| windows (2*half samples) about each resonator of a
+    (memory mapped) vnaSweep S21, reading only the windows and bin ends.
+
+    Return: (f, m) 2D arrays of floats, one window per row.
+    """
+
+    import numpy as np
+    from alcove_commands import freq_index
+
+    N = cfg_b.sweep_steps
+    Zb = S21[1].reshape(-1, N)
+    g = _ratioGains(np.abs(np.concatenate((Zb[:, :sw], Zb[:, -sw:]), axis=1)), sw)
+
+    i = freq_index.windows(S21[0], f_res, half)
+
+    return S21[0][i].real, np.abs(S21[1][i])*g[i//N]
+
+
+# ============================================================================ #
+# _catalogResonators
+def _catalogResonators(kind, tol=None):
+    """Match the latest found resonators (kind 'vna' or 'targ') to the
+    resonator catalog (see res_catalog), save their IDs, and append the
+    sweep to the catalog history. Target resonators keep the IDs of their
+    tones (res_ids_targ, see tones._saveResTarg) where all are catalogued,
+    and are matched by frequency otherwise.
+
+    Return: (1D array of ints) Catalog ID of each resonator.
+    """
+
+    import numpy as np
+    from alcove_commands import res_catalog
+
+    tol = cfg_b.res_catalog_tol if tol is None else float(tol)
+
+    if kind == 'vna':
+        file_f_res, file_ids = io.file.f_res_vna, io.file.res_ids_vna
+        f_res = np.real(io.load(file_f_res))
+        S21 = io.load(io.file.s21_vna, mmap_mode='r')
+        f, m = _vnaResonatorWindows(S21, f_res)
+    else:
+        file_f_res, file_ids = io.file.f_res_targ, io.file.res_ids_targ
+        f_res = np.real(io.load(file_f_res))
+        f, Z = io.load(io.file.s21_targ)
+        f, m = f.real.reshape(len(f_res), -1), np.abs(Z).reshape(len(f_res), -1)
+    depth, Q = res_catalog.dipMetrics(f, m)
+
+    try:
+        cat = io.load(io.file.res_catalog)
+        sweeps = io.load(io.file.res_catalog_sweeps)
+    except OSError: # no catalog yet
+        cat, sweeps = None, []
+
+    # target tones carry their IDs from the comb
+    ids = None
+    if kind == 'targ' and cat is not None:
+        try:
+            ids = np.asarray(io.load(file_ids), dtype=int)
+        except (OSError, IndexError): # none yet
+            ids = None
+        if ids is not None and not (
+                len(ids) == len(f_res) and len(np.unique(ids)) == len(ids)
+                and np.all(np.isin(ids, cat[0]))):
+            ids = None # e.g. a custom comb
+
+    s = len(sweeps)
+    if ids is not None:
+        cat = res_catalog.updateCatalogById(cat, ids, f_res, depth, Q, s, tol)
+    else:
+        cat, ids = res_catalog.updateCatalog(cat, f_res, depth, Q, s, tol)
+    sweeps.append({
+        'kind':kind, 'timestamp':io.mostRecentTimestamp(file_f_res), 'n':len(ids)})
+
+    io.save(io.file.res_catalog, cat)
+    io.save(io.file.res_catalog_sweeps, sweeps)
+    h = io.file.res_history
+    res_catalog.appendHistory(
+        f"{h['dname']}/{h['fname']}.bin", s, ids, f_res, depth, Q)
+    io.save(file_ids, ids)
+
+    return ids
+
+
+# ============================================================================ #
+# catalogResonators
+def catalogResonators(kind='vna', tol=None):
+    """Give the resonators of the latest findVnaResonators or
+    findTargResonators stable IDs, matching them to previous sweeps.
+    Runs after each of those if cfg_b.res_catalog_auto.
+
+    kind: (str) 'vna' (f_res_vna) or 'targ' (f_res_targ).
+    tol:  (float) Max match distance [Hz], after removing the common
+        shift. Default is cfg_b.res_catalog_tol.
+
+    Return: (1D array of ints) Catalog ID of each resonator.
+    """
+
+    ids = _catalogResonators(kind, tol)
+
+    file = io.file.res_ids_vna if kind == 'vna' else io.file.res_ids_targ
+    return io.returnWrapper(file, ids)
+
+
+# ============================================================================ #
+# _findCalTones
+def _findCalTones(f_lo=0.1, f_hi=50, tol=2, max_tones=10):
+    """Calibration tone frequencies, see findCalTones.
     """
     
     import numpy as np
     from scipy.signal import iirfilter, sosfiltfilt
+    from alcove_commands import freq_index
 
     ## load data from file
     f, Z = io.load(io.file.s21_vna)
@@ -292,7 +832,7 @@ def findCalTones(f_lo=0.1, f_hi=50, tol=2, max_tones=10):
     freqs = io.load(io.file.f_res_vna).real
     
     fs  = abs(f[1] - f[0])                        ## sampling frequency
-    freqs_i = [np.abs(f - v).argmin() for v in freqs] ## indices of freqs
+    freqs_i = freq_index.nearest(f, freqs)        ## indices of freqs
     freqs_i = np.append(np.insert(freqs_i, 0, 0), len(f)) ## add end gaps
     
     ## isolate continuum w/ lowpass filter
@@ -319,7 +859,102 @@ def findCalTones(f_lo=0.1, f_hi=50, tol=2, max_tones=10):
     ## limit to max_tones
     cal_tones_i = cal_tones_i[:max_tones] 
 
-    f_cal_tones = f[cal_tones_i]
+    return f[cal_tones_i]
+
+
+# ============================================================================ #
+# analysisCache
+def analysisCache(clear=False):
+    """Analysis result cache use (hits and misses of this drone, entries and
+    size on the board), optionally clearing it.
+
+    clear: (bool) Remove all cache entries (of all drones on the board).
+
+    Return: (dict) hits, misses, entries, bytes, quota.
+    """
+
+    import alcove_commands.wave_cache as wave_cache
+
+    if str(clear) in {True, 1, '1', 'True', 'true'}:
+        wave_cache.clear(cache='analysis')
+
+    return wave_cache.stats(cache='analysis')
+
+
+# ============================================================================ #
+# OFFLOAD_INPUTS
+# input files (board_io names) of the analysis commands that can run on the
+# queen (see queen_commands/analysis_offload.py)
+OFFLOAD_INPUTS = {
+    'findVnaResonators' :('s21_vna',),
+    'findTargResonators':('s21_targ',),
+    'fitTargResonators' :('s21_targ', 's21_targ_meta'),
+    'calibrateTargSweep':('s21_targ', 's21_targ_meta'),
+    'findCalTones'      :('s21_vna', 'f_res_vna')}
+
+
+# ============================================================================ #
+# getAnalysisInputs
+def getAnalysisInputs(com):
+    """Return the (most recent) input files of an analysis command, so it
+    can run on the queen instead (see OFFLOAD_INPUTS).
+
+    com: (str) Analysis command name, e.g. 'findVnaResonators'.
+
+    Return: (list) returnWrapper of each input file, with the file version
+        as the timestamp.
+    """
+
+    files = [getattr(io.file, name) for name in OFFLOAD_INPUTS[com]]
+    rtn = io.returnWrapperMultiple(files, [io.load(file) for file in files])
+    for w, file in zip(rtn, files):
+        w['timestamp'] = io.mostRecentTimestamp(file) or w['timestamp']
+
+    return rtn
+
+
+# ============================================================================ #
+# putAnalysisResults
+def putAnalysisResults(key):
+    """Save analysis results computed on the queen (see getAnalysisInputs)
+    to this drone, as if the analysis had run here, e.g. f_res_vna.
+    The resonator catalog is updated as after the analysis commands.
+
+    key: (str) Redis key holding the results (list of returnWrapper).
+
+    Return: (list of str) Names of the files saved.
+    """
+
+    rtn = fetchData(key)
+
+    for w in rtn:
+        io.save(io.fileByName(w['filename']), w['data'])
+
+    names = [w['filename'] for w in rtn]
+    if cfg_b.res_catalog_auto:
+        for kind in ('vna', 'targ'):
+            if f'f_res_{kind}' in names:
+                _catalogResonators(kind)
+
+    return names
+
+
+# ============================================================================ #
+# findCalTones
+def findCalTones(f_lo=0.1, f_hi=50, tol=2, max_tones=10):
+    """Determine the indices of calibration tones.
+    
+    f_hi:      (float) Highpass filter cutoff frequency (data units).
+    f_lo:      (float) lowpass filter cutoff frequency (data units).
+    tol:       (float) Reject tones tol*std_noise from continuum.
+    max_tones: (int) Maximum number of tones to return.
+    """
+
+    args = {'f_lo':f_lo, 'f_hi':f_hi, 'tol':tol, 'max_tones':max_tones}
+    f_cal_tones = _cachedResult(
+        'findCalTones', (io.file.s21_vna, io.file.f_res_vna),
+        (_normParams(_findCalTones, args),),
+        lambda: _findCalTones(**args))
 
     io.save(io.file.f_cal_tones, f_cal_tones)
     
@@ -71,6 +71,24 @@ class file:
                 'use_timestamp' :True}
     s21_vna = _s21_vna()
 
+    class _s21_vna_part: # partial sweep chunks (published, not saved)
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'s21_vna_part',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.src_dir+'/tmp',
+                'use_timestamp' :True}
+    s21_vna_part = _s21_vna_part()
+
+    class _s21_vna_meta: # sweep settings (e.g. profile)
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'sweep_meta_vna',
+                'file_type'     :'json', 
+                'dname'         :cfg_b.drone_dir+'/vna',
+                'use_timestamp' :True}
+    s21_vna_meta = _s21_vna_meta()
+
     class _f_res_vna:
         def __get__(self, obj, cls):
             return {
@@ -140,6 +158,87 @@ class file:
                 'use_timestamp' :True}
     s21_targ = _s21_targ()
 
+    class _s21_targ_part: # partial sweep chunks (published, not saved)
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'s21_targ_part',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.src_dir+'/tmp',
+                'use_timestamp' :True}
+    s21_targ_part = _s21_targ_part()
+
+    class _s21_targ_meta: # sweep settings (e.g. profile)
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'sweep_meta_targ',
+                'file_type'     :'json', 
+                'dname'         :cfg_b.drone_dir+'/targ',
+                'use_timestamp' :True}
+    s21_targ_meta = _s21_targ_meta()
+
+    class _fit_res_targ: # resonator fits, see resonator_fit.FIT_PARAMS
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'fit_res_targ',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.drone_dir+'/targ',
+                'use_timestamp' :True}
+    fit_res_targ = _fit_res_targ()
+
+    class _s21_power: # targ sweeps at a series of tone powers
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'s21_power',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.drone_dir+'/targ',
+                'use_timestamp' :True}
+    s21_power = _s21_power()
+
+    class _a_power: # resonator tone amplitudes of each s21_power sweep
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'a_power',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.drone_dir+'/targ',
+                'use_timestamp' :True}
+    a_power = _a_power()
+
+    class _s21_power_meta: # power series settings (e.g. step_db)
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'sweep_meta_power',
+                'file_type'     :'json', 
+                'dname'         :cfg_b.drone_dir+'/targ',
+                'use_timestamp' :True}
+    s21_power_meta = _s21_power_meta()
+
+    class _tone_power: # optimizeTonePowers, see tone_power.POWER_PARAMS
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'tone_power',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.drone_dir+'/targ',
+                'use_timestamp' :True}
+    tone_power = _tone_power()
+
+    class _tune_targ: # tuneTargets, see loops.TUNE_PARAMS
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'tune_targ',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.drone_dir+'/targ',
+                'use_timestamp' :True}
+    tune_targ = _tune_targ()
+
+    class _iq_cal: # IQ loop calibration table, see iq_cal.CAL_PARAMS
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'iq_cal',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.drone_dir+'/targ',
+                'use_timestamp' :True}
+    iq_cal = _iq_cal()
+
     class _f_cal_tones:
         def __get__(self, obj, cls):
             return {
@@ -150,6 +249,56 @@ class file:
     f_cal_tones = _f_cal_tones()
 
 
+# ============================================================================ #
+# Resonator catalog (see res_catalog.py)
+# ============================================================================ #
+
+    class _res_catalog: # current table, see res_catalog.CATALOG_PARAMS
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'res_catalog',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.drone_dir+'/catalog',
+                'use_timestamp' :False}
+    res_catalog = _res_catalog()
+
+    class _res_catalog_sweeps: # sweeps catalogued (kind, f_res timestamp)
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'res_catalog_sweeps',
+                'file_type'     :'json', 
+                'dname'         :cfg_b.drone_dir+'/catalog',
+                'use_timestamp' :False}
+    res_catalog_sweeps = _res_catalog_sweeps()
+
+    class _res_history: # appended records, see res_catalog.HISTORY_FIELDS
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'res_history',
+                'file_type'     :'bin', 
+                'dname'         :cfg_b.drone_dir+'/catalog',
+                'use_timestamp' :False}
+    res_history = _res_history()
+
+    class _res_ids_vna: # catalog ID of each f_res_vna
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'res_ids_vna',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.drone_dir+'/vna',
+                'use_timestamp' :True}
+    res_ids_vna = _res_ids_vna()
+
+    class _res_ids_targ: # catalog ID of each f_res_targ
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'res_ids_targ',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.drone_dir+'/targ',
+                'use_timestamp' :True}
+    res_ids_targ = _res_ids_targ()
+
+
 # ============================================================================ #
 # Current comb
 # ============================================================================ #
@@ -181,6 +330,24 @@ class file:
                 'use_timestamp' :True}
     p_tones_comb = _p_tones_comb()
 
+    class _tone_plan: # tone planning report, see tone_plan.py
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'tone_plan',
+                'file_type'     :'json', 
+                'dname'         :cfg_b.drone_dir+'/comb',
+                'use_timestamp' :True}
+    tone_plan = _tone_plan()
+
+    class _res_plan: # full resonator list of the target comb, see tone_plan.RES_PLAN_PARAMS
+        def __get__(self, obj, cls):
+            return {
+                'fname'         :'res_plan',
+                'file_type'     :'npy', 
+                'dname'         :cfg_b.drone_dir+'/targ',
+                'use_timestamp' :True}
+    res_plan = _res_plan()
+
 
 # ============================================================================ #
 # Custom comb files
@@ -243,4 +410,35 @@ class file:
                 'file_type'     :'npy', 
                 'dname'         :cfg_b.src_dir+'/tmp',
                 'use_timestamp' :True}
-    sys_info_v = _sys_info_v()
\ No newline at end of file
+    sys_info_v = _sys_info_v()
+
+
+
+
+# ============================================================================ #
+# FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# fileAttrs
+def fileAttrs():
+    """All file attributes (see file class), by name.
+    """
+
+    return {
+        name:getattr(file, name) 
+        for name in vars(file) if not name.startswith('_')}
+
+
+# ============================================================================ #
+# fileByName
+def fileByName(fname):
+    """File attributes with the given fname (e.g. a returnWrapper filename).
+    """
+
+    for f in fileAttrs().values():
+        if f['fname'] == fname:
+            return f
+
+    raise KeyError(f"No board file named {fname}.")
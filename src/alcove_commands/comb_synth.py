@@ -0,0 +1,188 @@
+# ============================================================================ #
+# comb_synth.py
+# Comb synthesis on the board comb service (comb_service.py).
+# CCAT Prime 2024
+# ============================================================================ #
+
+#############################################################
+### Drones send synthesis jobs (freqs, amps, phis) to the ###
+### service over a unix socket and get back DDR4 words in ###
+### shared memory, owned by the service. The block is     ###
+### freed when every drone that asked for it is done.     ###
+#############################################################
+
+import os
+
+try: from config import board as cfg_b
+except ImportError: cfg_b = None
+
+
+
+# ============================================================================ #
+# SynthComb
+class SynthComb:
+    def __init__(self, conn, reply):
+        '''A comb synthesized by the comb service.
+        Close when written, so the service can free the shared memory.
+
+        conn:  (Connection) Open connection to the service.
+        reply: (dict) Service reply, see comb_service._handle.
+
+        words:       (1D array of uint32) DDR4 words (in shared memory).
+        dphi:        (1D array of floats) As generateWaveDdr4.
+        freq_actual: (1D array of floats) As generateWaveDdr4.
+        '''
+
+        import numpy as np
+
+        self._conn = conn
+        self._shm = _attach(reply['shm'])
+        self.words = np.ndarray(reply['n'], dtype=np.uint32, buffer=self._shm.buf)
+        self.dphi = reply['dphi']
+        self.freq_actual = reply['freq_actual']
+
+
+    def waveIQ(self):
+        '''The int16 I/Q samples (wave_real, wave_imag) of words.
+        Inverse of tones._ddr4Words: (I << 16) + Q.
+        '''
+
+        import numpy as np
+
+        w16 = self.words.view(np.int16)
+        wave_real = w16[0::2].copy()                    # low half is Q
+        wave_imag = w16[1::2] + (wave_real < 0)         # Q < 0 borrowed 1 from I
+
+        return wave_real, wave_imag.astype(np.int16)
+
+
+    def close(self):
+        self.words = None
+        try:
+            self._shm.close()
+        except BufferError: # views still held, freed with them
+            pass
+        try:
+            self._conn.send('done')
+        except OSError:
+            pass
+        self._conn.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+# ============================================================================ #
+# EXTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# request
+def request(freqs, amps, phis):
+    '''Synthesize a comb on the comb service.
+
+    freqs: (1D array of floats) Tone frequencies [Hz].
+    amps:  (1D array of floats) Tone amplitudes.
+    phis:  (1D array of floats) Tone phases.
+
+    Return: (SynthComb) or None if the service is not running or failed,
+        in which case the caller should synthesize the comb itself.
+    '''
+
+    import numpy as np
+    from multiprocessing.connection import Client
+
+    sock = getattr(cfg_b, 'comb_service_socket', None)
+    if not sock or not os.path.exists(sock):
+        return None
+
+    try:
+        conn = Client(sock, family='AF_UNIX')
+    except OSError: # stale socket, service not running
+        return None
+
+    try:
+        conn.send({
+            'freqs':np.real(freqs), 'amps':np.real(amps), 'phis':np.real(phis)})
+        if not conn.poll(cfg_b.comb_service_timeout):
+            raise TimeoutError("No reply from comb service.")
+        reply = conn.recv()
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return SynthComb(conn, reply)
+
+    except Exception as e:
+        print(f"comb_synth.request: {e}")
+        conn.close()
+        return None
+
+
+# ============================================================================ #
+# synthJob
+def synthJob(shm_name, freqs, amps, phis):
+    '''Synthesize a comb into the DDR4 words of a shared memory block.
+    Runs in the comb service worker processes.
+
+    shm_name: (str) Shared memory block (wf_lut_len uint32 words).
+
+    Return: (dphi, freq_actual)
+    '''
+
+    import numpy as np
+    from alcove_commands import tones
+
+    # through the on-board cache, shared with the drones
+    wave_real, wave_imag, dphi, freq_actual = tones._generateWaveCached(freqs, amps, phis)
+
+    # workers share the service's resource tracker, which owns the block
+    shm = _attach(shm_name, untrack=False)
+    try:
+        words = np.ndarray(len(wave_real), dtype=np.uint32, buffer=shm.buf)
+        words[:] = tones._ddr4Words(wave_real, wave_imag)
+        del words
+    finally:
+        shm.close()
+
+    return np.asarray(dphi), np.asarray(freq_actual)
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _attach
+def _attach(name, untrack=True):
+    '''Attach to an existing shared memory block.
+
+    untrack: (bool) Don't let this process' resource tracker unlink
+        the block on exit (python < 3.13 registers attached blocks).
+    '''
+
+    from multiprocessing import shared_memory
+
+    if untrack:
+        try:
+            return shared_memory.SharedMemory(name, track=False) # python >= 3.13
+        except TypeError:
+            pass
+
+    shm = shared_memory.SharedMemory(name)
+
+    if untrack:
+        from multiprocessing import resource_tracker
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+
+    return shm
@@ -0,0 +1,169 @@
+# ============================================================================ #
+# freq_index.py
+# Vectorized index lookups on sorted sweep frequency grids.
+# CCAT Prime 2024
+# ============================================================================ #
+
+#############################################################
+### Sweep frequency axes are non-decreasing (VNA sweeps   ###
+### repeat the frequency at each comb bin edge), so index ###
+### lookups are binary searches (searchsorted), O(M log N)###
+### for M frequencies on an N point grid, instead of an   ###
+### O(N) scan per frequency. Complex grids use the real   ###
+### part; memory mapped grids are only read where needed. ###
+#############################################################
+
+
+
+# ============================================================================ #
+# EXTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# nearest
+def nearest(f, freqs):
+    '''Index of the nearest grid point to each frequency.
+    Same as np.abs(f - v).argmin() for each v (first index on ties).
+
+    f:     (1D array) Non-decreasing frequency grid.
+    freqs: (float or array of floats) Frequencies to look up.
+
+    Return: (int or array of ints) Indices into f.
+    '''
+
+    import numpy as np
+
+    f = np.real(f)
+    v = np.real(freqs)
+    n = len(f)
+
+    j = np.clip(np.searchsorted(f, v), 1, n - 1)   # first f[j] >= v
+    lo, hi = f[j - 1], f[j]
+    i = np.where(np.abs(v - lo) <= np.abs(hi - v), j - 1, j)
+    i = np.where(n > 1, i, 0)
+
+    # first of repeated grid values
+    return np.searchsorted(f, f[i])
+
+
+# ============================================================================ #
+# inRange
+def inRange(f, f_lo, f_hi):
+    '''Index ranges of the grid points in [f_lo, f_hi),
+    i.e. f[lo:hi] for each pair of limits.
+
+    f:    (1D array) Non-decreasing frequency grid.
+    f_lo, f_hi: (floats or arrays of floats) Range limits.
+
+    Return: (lo, hi) (ints or arrays of ints) Slice limits into f.
+    '''
+
+    import numpy as np
+
+    f = np.real(f)
+
+    return np.searchsorted(f, np.real(f_lo)), np.searchsorted(f, np.real(f_hi))
+
+
+# ============================================================================ #
+# windows
+def windows(f, freqs, half):
+    '''Indices of the 2*half grid points about each frequency (from the
+    nearest point, clipped at the grid ends), for gathering windows
+    e.g. Z[windows(f, f_res, 100)].
+
+    f:     (1D array) Non-decreasing frequency grid.
+    freqs: (array of floats) Window centres.
+    half:  (int) Points each side.
+
+    Return: (2D array of ints) One window per row.
+    '''
+
+    import numpy as np
+
+    i = np.atleast_1d(nearest(f, freqs))
+
+    return np.clip(i[:, None] + np.arange(-int(half), int(half))[None], 0, len(f) - 1)
+
+
+# ============================================================================ #
+# binOf
+def binOf(f, freqs, bw):
+    '''Comb bin (sweep of one tone, bw points of the grid) of the nearest
+    grid point to each frequency.
+
+    f:     (1D array) Non-decreasing frequency grid, bins of bw points.
+    freqs: (float or array of floats) Frequencies to look up.
+    bw:    (int) Points per bin (e.g. sweep_steps).
+
+    Return: (int or array of ints) Bin indices.
+    '''
+
+    return nearest(f, freqs)//int(bw)
+
+
+# ============================================================================ #
+# rowNearest
+def rowNearest(f, freqs):
+    '''Index of the nearest point to freqs[r] within row r of f, all rows
+    at once (e.g. target sweeps, one tone per row).
+
+    f:     (2D array) One frequency grid per row, each non-decreasing.
+    freqs: (1D array of floats) One frequency per row.
+
+    Return: (1D array of ints) Column indices.
+    '''
+
+    import numpy as np
+
+    f = np.real(f)
+    v = np.real(freqs)
+    R, N = f.shape
+
+    # rows placed end to end (offset by more than the widest row) are one
+    # non-decreasing grid; each query is clipped to its own row
+    f0 = f[:, 0]
+    w = f[:, -1] - f0
+    off = (np.max(w) + 1)*np.arange(R) if R else 0
+    g = (f - f0[:, None] + np.reshape(off, (-1, 1))).ravel()
+    q = np.clip(v - f0, 0, w) + off
+
+    return nearest(g, q) - N*np.arange(R)
+
+
+
+# ============================================================================ #
+# Testing
+# ============================================================================ #
+
+def testNearest(N=2_000_000, M=1000, bw=2000, seed=0):
+    '''Check nearest and rowNearest against argmin on a VNA like grid
+    (bins of bw points sharing their edge frequency) and time them.
+    '''
+
+    import time
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    df = 255.
+    f = (np.arange(N) - np.arange(N)//bw)*df + 400e6   # repeats at bin edges
+    v = rng.uniform(f[0] - 1e3, f[-1] + 1e3, M)
+    v[:10] = f[rng.integers(0, N, 10)] + df/2          # exact ties
+
+    t0 = time.perf_counter()
+    i_brute = np.array([np.abs(f - x).argmin() for x in v])
+    t1 = time.perf_counter()
+    i = nearest(f, v)
+    t2 = time.perf_counter()
+
+    F = f.reshape(-1, bw)
+    r = rng.integers(0, len(F), M)
+    vr = F[r, 0] + rng.uniform(-1e3, (bw + 4)*df, M)
+    j_brute = np.array([np.abs(F[k] - x).argmin() for k, x in zip(r, vr)])
+    j = rowNearest(F[r], vr)
+
+    print(f"nearest: {M} of {N} in {(t2 - t1)*1e3:.2f} ms "
+          f"(argmin {(t1 - t0)*1e3:.0f} ms), "
+          f"{np.count_nonzero(i != i_brute)} differ")
+    print(f"rowNearest: {np.count_nonzero(j != j_brute)} of {M} differ")
@@ -0,0 +1,174 @@
+# ============================================================================ #
+# hw_context.py
+# Per drone hardware context: cached memory maps and register handles.
+# CCAT Prime 2024
+# ============================================================================ #
+
+import os
+
+try: from config import board as cfg_b
+except ImportError: cfg_b = None
+
+
+
+# ============================================================================ #
+# CONSTANTS
+# ============================================================================ #
+
+# wide BRAM (snap capture) base addresses
+_base_addr_wide = {
+    1:0x00_A007_0000, 2:0x00_B000_0000, 3:0x00_B000_8000, 4:0x00_8200_0000}
+_wide_bytes = 32768
+
+# dphi BRAM base addresses
+_base_addr_dphis = {1:0xa004c000, 2:0xa0040000, 3:0xa0042000, 4:0xa004e000}
+_dphis_bytes = 512*4 # 32 bit address slots
+
+# DDR4 waveform memory, shared by all drones (interleaved)
+_base_addr_ddr4 = 0x4_0000_0000 #0x5_0000_0000
+_ddr4_bytes = 2**32
+_ddr4_words = 4194304
+
+# fabric (fine) nclo register offsets in mix_freq_set_0
+_mix_offsets = {1:0, 2:4, 3:8, 4:12}
+
+# rf data converter tiles/blocks: adc tile; adc block; dac tile; dac block
+_tb_indices_v13 = {1:[1,0,1,3], 2:[1,1,1,2], 3:[0,1,1,0], 4:[0,0,1,1]}
+_tb_indices     = {1:[0,0,1,3], 2:[0,1,1,2], 3:[1,0,1,1], 4:[1,1,1,0]}
+
+_contexts = {} # chan: HwContext, see hwContext
+
+
+
+# ============================================================================ #
+# HwContext
+class HwContext:
+    def __init__(self, chan, firmware=None, firmware_file=None):
+        '''Memory maps, register handles and converter blocks for a drone.
+        Built once per loaded firmware and reused by every alcove command.
+
+        chan:          (int) Drone/channel (1-4).
+        firmware:      (Overlay) Loaded firmware. Default cfg_b.firmware.
+        firmware_file: (str) Firmware file name. Default cfg_b.firmware_file.
+        '''
+
+        from pynq import MMIO # type: ignore
+
+        if chan not in _base_addr_wide:
+            raise ValueError(f"HwContext: Invalid chan ({chan}).")
+
+        self.chan = chan
+        self.firmware = firmware if firmware is not None else cfg_b.firmware
+        fw = self.firmware
+        fw_chan = getattr(fw, f'chan{chan}')
+
+        # registers
+        # 0x00 -  fft_shift[9 downto 0], load_bins[22 downto 12], lut_counter_rst[11 downto 11]
+        # 0x04 -  bin_num[9 downto 0]
+        # 0x08 -  accum_len[23 downto 0], accum_rst[24 downto 24], sync_in[26 downto 26] (start dac)
+        # 0x0c -  dds_shift[8 downto 0]
+        self.dsp_regs = fw_chan.dsp_regs_0
+        self.axi_wide = fw_chan.axi_wide_ctrl # 0x0 max count, 0x8 capture rising edge trigger
+        self.ddr4mux  = fw.axi_ddr4_mux
+        self.mix      = fw.mix_freq_set_0
+        self.mix_offset = _mix_offsets[chan]
+
+        # last DDC bin table written (None is unknown), see tones._loadBinList
+        self.bin_table = None
+
+        # last comb written (None is unknown), see tones._writeComb
+        self.comb = None
+
+        # other last written values by name (missing is unknown), see loaded
+        # 'nclo', 'fine_nclo', 'chan_count', 'fft_shift'
+        self.state = {}
+
+        # memory maps
+        self.wide_bram = MMIO(_base_addr_wide[chan], _wide_bytes)
+        self.wide_data = self.wide_bram.array[0:_wide_bytes//4] # bram depth*word_bits/32bits
+        self.dphis = MMIO(_base_addr_dphis[chan], _dphis_bytes)
+        self.ddr4  = MMIO(_base_addr_ddr4, _ddr4_bytes)
+        self.ddr4_data = self.ddr4.array[0:_ddr4_words]
+
+        # rf data converter blocks (nclo)
+        ii = tileIndices(firmware_file)[chan]
+        rf_data_conv = fw.usp_rf_data_converter_0
+        self.adc = rf_data_conv.adc_tiles[ii[0]].blocks[ii[1]]
+        self.dac = rf_data_conv.dac_tiles[ii[2]].blocks[ii[3]]
+
+
+    def loaded(self, name, value):
+        '''True if value is known to be loaded in hardware as name,
+        i.e. writing it again would change nothing.
+        Always False if cfg_b.hw_skip_unchanged is False.
+        '''
+
+        if not getattr(cfg_b, 'hw_skip_unchanged', True):
+            return False
+
+        return name in self.state and self.state[name] == value
+
+
+    def setLoaded(self, name, value=None):
+        '''Record value as loaded in hardware as name.
+        None marks it as unknown (call before writing, in case of interruption).
+        '''
+
+        if value is None:
+            self.state.pop(name, None)
+        else:
+            self.state[name] = value
+
+
+
+# ============================================================================ #
+# tileIndices
+def tileIndices(firmware_file=None):
+    '''RF data converter tile/block indices by chan for the firmware version.
+    Firmware v13 onwards uses a different mapping.
+
+    firmware_file: (str) Firmware file name, e.g. 'tetra_v13p1_impl_5.bit'.
+        Default cfg_b.firmware_file.
+    '''
+
+    if firmware_file is None:
+        firmware_file = cfg_b.firmware_file
+    name = os.path.splitext(os.path.basename(firmware_file))[0]
+
+    return _tb_indices_v13 if int(name[7:9]) >= 13 else _tb_indices
+
+
+# ============================================================================ #
+# hwContext
+def hwContext(chan=None):
+    '''The hardware context for chan, created on first use.
+    Recreated if the firmware has been (re)loaded since.
+
+    chan: (int) Drone/channel (1-4). Default cfg_b.drid.
+    '''
+
+    if chan is None:
+        chan = cfg_b.drid
+
+    hw = _contexts.get(chan)
+    if hw is None or hw.firmware is not cfg_b.firmware:
+        hw = initHwContext(chan)
+
+    return hw
+
+
+# ============================================================================ #
+# initHwContext
+def initHwContext(chan=None):
+    '''(Re)create the hardware context for chan from the loaded firmware.
+    Called by the drone after loading firmware.
+
+    chan: (int) Drone/channel (1-4). Default cfg_b.drid.
+    '''
+
+    if chan is None:
+        chan = cfg_b.drid
+
+    _contexts[chan] = HwContext(chan)
+
+    return _contexts[chan]
@@ -8,6 +8,14 @@
 from alcove_commands.alcove_base import *
 
 
+# ============================================================================ #
+# CONSTANTS
+# ============================================================================ #
+
+# tuneTargets table rows (one column per resonator tone)
+TUNE_PARAMS = ('f', 'amp', 'f_step', 'amp_step', 'asym', 'sweeps', 'converged')
+
+
 # ============================================================================ #
 # targetSweepLoop
 '''
@@ -171,4 +179,213 @@ def fullLoop(max_loops_full=2, max_loops_funcs=2, verbose=False):
         
         fullSuccess(l)
         break
-'''
\ No newline at end of file
+'''
+
+
+# ============================================================================ #
+# tuneTargets
+def tuneTargets(f_tol=None, a_tol=None, max_iters=None, time_budget=None,
+                shrink=None, profile=None):
+    """Iteratively retune the target tones (frequency and amplitude), with
+    per resonator convergence: each iteration sweeps only the tones not
+    yet converged, with the bandwidth and points shrinking by shrink, and
+    stops early on the time budget. The target comb is written with the
+    result. Note that the target comb must be written first.
+
+    Each swept tone moves to its |S21| minimum (within cfg_b.tune_max_move
+    and half way to its neighbouring tones), and its amplitude is
+    reduced where the dip asymmetry (see tone_power) is over
+    cfg_b.tone_power_targets['asym'] (amplitudes never increase; see
+    optimizeTonePowers). A tone converges when both steps are in tolerance.
+    Moves are limited to positions the tone plan accepts (see tone_plan),
+    so every comb swept and written is valid; a tone with neither its new
+    nor its old position free is dropped from the comb (kept in res_plan).
+    If cancelled, the table is saved as it stands and the comb is left as
+    the last iteration's (see writeTargCombFromTargSweep).
+
+    f_tol:       (float) Frequency step tolerance [Hz]. Default cfg_b.tune_f_tol.
+    a_tol:       (float) Relative amplitude step tolerance. Default cfg_b.tune_a_tol.
+    max_iters:   (int) Max iterations (sweeps). Default cfg_b.tune_max_iters.
+    time_budget: (float) No iteration is started that would end after this
+        [s]. Default cfg_b.tune_time_budget.
+    shrink:      (float) Bandwidth and points factor per iteration, down to
+        cfg_b.tune_min_bw and cfg_b.tune_min_steps. Default cfg_b.tune_shrink.
+    profile:     (str) Sweep speed/SNR profile, see targetSweep.
+
+    Return: (2D array) One row per TUNE_PARAMS, one column per resonator
+        tone as written (f_res_targ); tones new to the comb are untuned.
+    """
+
+    import time
+    import numpy as np
+    from alcove_commands.sweeps import _sweep, _sweepProfile
+    from alcove_commands.tones import (
+        _writeComb, _loadResPlan, _resPlanWritten, _saveResTarg,
+        writeTargCombFromTargSweep)
+    from alcove_commands.tone_power import asymmetry
+
+    t_start = time.perf_counter()
+
+    chan = cfg_b.drid
+    p = _sweepProfile(profile)
+    f_tol = float(f_tol) if f_tol else cfg_b.tune_f_tol
+    a_tol = float(a_tol) if a_tol else cfg_b.tune_a_tol
+    max_iters = int(max_iters) if max_iters else cfg_b.tune_max_iters
+    time_budget = float(time_budget) if time_budget else cfg_b.tune_time_budget
+    shrink = float(shrink) if shrink else cfg_b.tune_shrink
+    target = cfg_b.tone_power_targets['asym']
+
+    f_center = io.load(io.file.f_center_vna) # Hz
+
+    # the tones in the comb (columns idx of the full resonator list)
+    plan = _loadResPlan()
+    idx = np.flatnonzero(plan[3])
+    f, amps, phis = (plan[k, idx].copy() for k in range(3))
+    R = len(f)
+
+    # per tone state
+    f_step = np.full(R, np.nan)
+    amp_step = np.full(R, np.nan)
+    asym = np.full(R, np.nan)
+    sweeps = np.zeros(R, dtype=int)
+    converged = np.zeros(R, dtype=bool)
+    dropped = np.zeros(R, dtype=bool)
+    table = lambda: np.array(
+        [f, amps, f_step, amp_step, asym, sweeps, converged], dtype=float)
+
+    bw, N_steps = float(cfg_b.target_chan_bw), int(cfg_b.sweep_steps)
+    dt_last = None
+    try:
+        for it in range(max_iters):
+            active = np.flatnonzero(~converged & ~dropped)
+            if len(active) == 0:
+                break
+
+            # time budget: the last iteration's time, scaled by points
+            elapsed = time.perf_counter() - t_start
+            if dt_last is not None and elapsed + dt_last*N_steps/N_last > time_budget:
+                print(f"tuneTargets: time budget reached ({elapsed:.0f} s).")
+                break
+
+            # sweep the unconverged tones only
+            t0 = time.perf_counter()
+            _writeComb(chan, f[active] - f_center, amps[active], phis[active])
+            S21 = _sweep(chan, f_center/1e6, f[active] - f_center, N_steps,
+                chan_bandwidth=bw, N_accums=p['accums'],
+                settle_time=p['settle_time'], discard=p['discard'],
+                accum_length=p['accum_length'])
+            fs = S21[0].real.reshape(len(active), N_steps)
+            m = np.abs(S21[1]).reshape(len(active), N_steps)
+            sweeps[active] += 1
+
+            # only near the tone: tones don't jump to (or onto) neighbours
+            o = np.argsort(f)
+            d = np.diff(f[o])
+            gap = np.empty(R)
+            gap[o] = np.minimum(np.r_[np.inf, d], np.r_[d, np.inf])
+            reach = np.maximum(
+                np.minimum(gap[active]/2, cfg_b.tune_max_move), bw*1e6/N_steps)
+            near = np.abs(fs - f[active, None]) <= reach[:, None]
+            m = np.where(near, m, np.median(m, axis=1)[:, None])
+
+            # frequency: |S21| minimum (5 point boxcar)
+            k = min(5, N_steps)
+            c = np.concatenate((np.zeros((len(m), 1)), np.cumsum(m, axis=1)), axis=1)
+            i_min = np.argmin(c[:, k:] - c[:, :-k], axis=1) + k//2
+            f_new = fs[np.arange(len(active)), i_min]
+
+            # amplitude: down to the asymmetry target (at most halved)
+            asym[active] = np.abs(asymmetry(m))
+            g = np.sqrt(target/np.maximum(asym[active], target))
+            amps_new = amps[active]*np.maximum(np.nan_to_num(g, nan=1), 0.5)
+
+            # only where the tone plan accepts (the other tones fixed)
+            if getattr(cfg_b, 'tone_plan', False):
+                f_all = f.copy()
+                f_all[active] = f_new
+                placed = _planMoves(f, f_all, active, f_center)
+                dropped |= np.isnan(placed)
+                f_new = np.where(dropped[active], f[active], placed[active])
+
+            f_step[active] = f_new - f[active]
+            amp_step[active] = amps_new/amps[active] - 1
+            converged[active] = (
+                (np.abs(f_step[active]) < f_tol) & (np.abs(amp_step[active]) < a_tol)
+                & ~dropped[active])
+            f[active], amps[active] = f_new, amps_new
+
+            dt_last, N_last = time.perf_counter() - t0, N_steps
+            print(f"tuneTargets: iteration {it+1}, {len(active)} tones swept "
+                  f"({bw:.3f} MHz, {N_steps} points) in {dt_last:.1f} s, "
+                  f"{np.count_nonzero(converged)} of {R} converged"
+                  f"{f', {np.count_nonzero(dropped)} dropped' if dropped.any() else ''}.")
+            publishPartial(io.file.tune_targ, table())
+
+            # narrower and fewer points for the (fewer) remaining tones
+            bw = max(bw*shrink, cfg_b.tune_min_bw)
+            N_steps = max(int(N_steps*shrink), cfg_b.tune_min_steps)
+
+    except CommandCancelled:
+        # the table as it stands (the comb is the last iteration's)
+        io.save(io.file.tune_targ, table())
+        raise
+
+    # full target comb from the tuned tones (dropped ones left out)
+    k = np.flatnonzero(~dropped)
+    _saveResTarg(_resPlanWritten(plan, idx[k], f[k], amps[k], phis[k]))
+    writeTargCombFromTargSweep()
+
+    # table of the tones as written (tones new to the comb untuned)
+    kept = np.flatnonzero(io.load(io.file.res_plan)[3])
+    i = np.clip(np.searchsorted(idx, kept), 0, R - 1)
+    tuned = (idx[i] == kept) & ~dropped[i]
+    t = np.full((len(TUNE_PARAMS), len(kept)), np.nan)
+    t[:, tuned] = table()[:, i[tuned]]
+    t[0] = io.load(io.file.f_res_targ).real
+    t[1] = io.load(io.file.a_res_targ)
+    t[5:, ~tuned] = 0 # sweeps, converged
+    io.save(io.file.tune_targ, t)
+
+    print(f"tuneTargets: {np.count_nonzero(converged)} of {R} converged in "
+          f"{time.perf_counter() - t_start:.0f} s, {sweeps.sum()} tone sweeps "
+          f"(vs {R*sweeps.max()} sweeping all), {np.count_nonzero(dropped)} "
+          f"dropped, {len(kept) - np.count_nonzero(tuned)} new to the comb.")
+
+    return io.returnWrapper(io.file.tune_targ, t)
+
+
+# ============================================================================ #
+# _planMoves
+def _planMoves(f, f_new, moved, f_center):
+    '''Positions of tones moved from f to f_new that the tone plan accepts,
+    with the other tones fixed (see tone_plan.planTones). A move it does
+    not accept goes back to f, unless that is taken by an accepted move.
+
+    f, f_new: (1D arrays of floats) Tone frequencies before and after [Hz].
+    moved:    (1D array of ints) Indices of the moved tones.
+    f_center: (float) Center LO frequency [Hz].
+
+    Return: (1D array of floats) Planned frequencies [Hz], nan if dropped.
+    '''
+
+    import numpy as np
+    from alcove_commands.tone_plan import planTones
+
+    def plan(f_try, fixed):
+        r = planTones(f_try - f_center, first=fixed)
+        placed = np.full(len(f_try), np.nan)
+        placed[r['keep']] = r['freqs'] + f_center
+        return placed
+
+    is_moved = np.zeros(len(f), dtype=bool)
+    is_moved[moved] = True
+
+    placed = plan(np.where(is_moved, f_new, f), np.flatnonzero(~is_moved))
+
+    # not accepted: back, around the accepted moves
+    back = is_moved & np.isnan(placed)
+    if back.any():
+        f_try = np.where(np.isnan(placed), f, placed)
+        placed = plan(f_try, np.flatnonzero(~np.isnan(placed)))
+
+    return placed
@@ -0,0 +1,368 @@
+# ============================================================================ #
+# res_catalog.py
+# Resonator identity catalog: stable IDs across sweeps.
+# CCAT Prime 2024
+# ============================================================================ #
+
+#############################################################
+### Each sweep's resonators are matched to the catalog by ###
+### frequency (after removing a common shift): sorted     ###
+### nearest neighbours within tol, with an assignment     ###
+### step where candidates overlap. Unmatched resonators   ###
+### get new IDs; IDs are never reused. Target sweeps      ###
+### keep the IDs of their tones (updateCatalogById).      ###
+### Every sweep is appended to a compact fixed record     ###
+### history file.                                         ###
+#############################################################
+
+try: from config import board as cfg_b
+except ImportError: cfg_b = None
+
+
+
+# ============================================================================ #
+# CONSTANTS
+# ============================================================================ #
+
+# catalog table rows (one column per resonator), see updateCatalog
+CATALOG_PARAMS = ('id', 'f0', 'depth', 'Q', 'n_seen', 'last_sweep')
+
+# history file records (one per resonator per sweep)
+HISTORY_FIELDS = [
+    ('sweep', '<u4'), ('id', '<u4'), ('f0', '<f8'), ('depth', '<f4'), ('Q', '<f4')]
+
+
+
+# ============================================================================ #
+# EXTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# match
+def match(f_ref, f_new, tol, max_shift=None, k=2):
+    '''Match new resonator frequencies to reference ones (one to one).
+
+    f_ref: (1D array of floats) Reference (catalog) frequencies [Hz].
+    f_new: (1D array of floats) New frequencies [Hz].
+    tol:   (float) Max distance of a match, after the shift [Hz].
+    max_shift: (float) Search range of the common shift (e.g. loading),
+        removed first [Hz]. Default 5*tol, 0 for none.
+    k:     (int) Neighbours each side (in the sorted reference) considered.
+
+    Return: (idx, df) idx: (1D array of ints) Index into f_ref of each
+        f_new, -1 if unmatched. df: (float) Common shift removed [Hz].
+    '''
+
+    import numpy as np
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.optimize import linear_sum_assignment
+    from alcove_commands import freq_index
+
+    f_ref = np.asarray(np.real(f_ref), dtype=float)
+    f_new = np.asarray(np.real(f_new), dtype=float)
+    idx = np.full(len(f_new), -1)
+    if len(f_ref) == 0 or len(f_new) == 0:
+        return idx, 0.
+
+    order = np.argsort(f_ref)
+    fs = f_ref[order]
+
+    # common shift: the most common offset of all pairs within max_shift,
+    # refined by the median offset of the nearest neighbours
+    max_shift = 5*tol if max_shift is None else float(max_shift)
+    df = 0.
+    if max_shift > 0:
+        df = _modeOffset(fs, f_new, max_shift, tol/2)
+        d = f_new - df - fs[freq_index.nearest(fs, f_new - df)]
+        ok = np.abs(d) < tol
+        if np.count_nonzero(ok) >= 3:
+            df += np.median(d[ok])
+    f = f_new - df
+
+    # candidate pairs: k sorted neighbours each side, within tol
+    j = np.searchsorted(fs, f)[:, None] + np.arange(-k, k)[None]
+    i = np.broadcast_to(np.arange(len(f))[:, None], j.shape)
+    ok = (j >= 0) & (j < len(fs))
+    i, j = i[ok], j[ok]
+    cost = np.abs(f[i] - fs[j])
+    ok = cost < tol
+    i, j, cost = i[ok], j[ok], cost[ok]
+    if len(i) == 0:
+        return idx, df
+
+    # independent groups of overlapping candidates (bipartite components)
+    n = len(f)
+    g = coo_matrix((np.ones(len(i)), (i, n + j)), shape=(n + len(fs),)*2)
+    _, comp = connected_components(g, directed=False)
+    c = comp[i]
+
+    # unambiguous: the only pair in its group
+    single = np.bincount(c, minlength=comp.max() + 1)[c] == 1
+    idx[i[single]] = order[j[single]]
+
+    # ambiguous: min total squared distance assignment within each group
+    # (squared keeps the order of close pairs, they don't cross)
+    for cc in np.unique(c[~single]):
+        p = c == cc
+        ii, ri = np.unique(i[p], return_inverse=True)
+        jj, rj = np.unique(j[p], return_inverse=True)
+        C = np.full((len(ii), len(jj)), 1e3*tol**2)
+        C[ri, rj] = cost[p]**2
+        r, s = linear_sum_assignment(C)
+        ok = C[r, s] < tol**2
+        idx[ii[r[ok]]] = order[jj[s[ok]]]
+
+    return idx, df
+
+
+# ============================================================================ #
+# updateCatalog
+def updateCatalog(cat, f0, depth, Q, sweep, tol):
+    '''Match a sweep's resonators to the catalog and update it.
+
+    cat:   (2D array) Catalog table, one row per CATALOG_PARAMS
+        (None or empty for a new catalog).
+    f0, depth, Q: (1D arrays of floats) The sweep's resonators.
+    sweep: (int) Sweep number.
+    tol:   (float) Max match distance [Hz], see match.
+
+    Return: (cat, ids) Updated catalog, and the ID of each resonator.
+    '''
+
+    import numpy as np
+
+    if cat is None or np.size(cat) == 0:
+        cat = np.zeros((len(CATALOG_PARAMS), 0))
+    cat = np.array(cat, dtype=float)
+    f0, depth, Q = (np.asarray(np.real(x), dtype=float) for x in (f0, depth, Q))
+    p = {k:r for k, r in zip(CATALOG_PARAMS, cat)} # views into cat
+
+    idx, df = match(p['f0'], f0, tol)
+    m = idx >= 0
+
+    ids = np.empty(len(f0), dtype=int)
+    ids[m] = p['id'][idx[m]]
+    next_id = int(p['id'].max()) + 1 if len(p['id']) else 0
+    ids[~m] = next_id + np.arange(np.count_nonzero(~m))
+
+    # missed: assume they moved with the rest
+    missed = np.ones(cat.shape[1], dtype=bool)
+    missed[idx[m]] = False
+    p['f0'][missed] += df
+
+    # matched: latest values
+    j = idx[m]
+    p['f0'][j], p['depth'][j], p['Q'][j] = f0[m], depth[m], Q[m]
+    p['n_seen'][j] += 1
+    p['last_sweep'][j] = sweep
+
+    # new
+    new = np.array([
+        ids[~m], f0[~m], depth[~m], Q[~m],
+        np.ones(np.count_nonzero(~m)), np.full(np.count_nonzero(~m), sweep)])
+    cat = np.concatenate((cat, new), axis=1)
+
+    print(f"Resonator catalog: sweep {sweep}, {np.count_nonzero(m)} matched "
+          f"(shift {df:.0f} Hz), {np.count_nonzero(~m)} new, "
+          f"{np.count_nonzero(missed)} missed.")
+
+    return cat, ids
+
+
+# ============================================================================ #
+# updateCatalogById
+def updateCatalogById(cat, ids, f0, depth, Q, sweep, tol):
+    '''Update the catalog with a sweep's resonators of known IDs
+    (e.g. the target comb tones, see updateCatalog for the others).
+    Resonators farther than tol from their catalog entry (after the
+    common shift, e.g. a neighbouring dip) keep their ID but do not
+    update it.
+
+    cat:   (2D array) Catalog table, one row per CATALOG_PARAMS.
+    ids:   (1D array of ints) Catalog ID of each resonator.
+    f0, depth, Q: (1D arrays of floats) The sweep's resonators.
+    sweep: (int) Sweep number.
+    tol:   (float) Max distance of an update [Hz].
+
+    Return: (2D array) Updated catalog.
+    '''
+
+    import numpy as np
+
+    cat = np.array(cat, dtype=float)
+    f0, depth, Q = (np.asarray(np.real(x), dtype=float) for x in (f0, depth, Q))
+    p = {k:r for k, r in zip(CATALOG_PARAMS, cat)} # views into cat
+
+    j = np.searchsorted(p['id'], ids) # IDs are ascending
+    d = f0 - p['f0'][j]
+    df = np.median(d) if len(d) else 0.
+    ok = np.abs(d - df) < tol
+    if np.count_nonzero(ok) >= 3:
+        df = np.median(d[ok])
+    ok = np.abs(d - df) < tol
+
+    # missed (or too far): assume they moved with the rest
+    missed = np.ones(cat.shape[1], dtype=bool)
+    missed[j[ok]] = False
+    p['f0'][missed] += df
+
+    j = j[ok]
+    p['f0'][j], p['depth'][j], p['Q'][j] = f0[ok], depth[ok], Q[ok]
+    p['n_seen'][j] += 1
+    p['last_sweep'][j] = sweep
+
+    print(f"Resonator catalog: sweep {sweep}, {len(j)} by ID "
+          f"(shift {df:.0f} Hz), {np.count_nonzero(~ok)} too far, "
+          f"{np.count_nonzero(missed)} missed.")
+
+    return cat
+
+
+# ============================================================================ #
+# dipMetrics
+def dipMetrics(f, m, edge=0.1):
+    '''Depth and rough Q of the dip in each row (window about a resonator).
+
+    f: (2D array of floats) Frequencies [Hz], one window per row.
+    m: (2D array of floats) |S21|, same shape.
+    edge: (float) Fraction of points at each edge used as the continuum.
+
+    Return: (depth, Q) depth: 1 - min/continuum. Q: f0/FWHM, from the
+        points below the half power level (nan if fewer than 2).
+    '''
+
+    import numpy as np
+
+    f, m = np.real(f), np.asarray(m, dtype=float)
+    e = max(int(m.shape[1]*edge), 1)
+    base = np.median(np.concatenate((m[:, :e], m[:, -e:]), axis=1), axis=1)
+    i_min = np.argmin(m, axis=1)
+    m_min = m[np.arange(len(m)), i_min]
+    f_min = f[np.arange(len(m)), i_min]
+
+    level = np.sqrt((base**2 + m_min**2)/2)
+    n = np.count_nonzero(m < level[:, None], axis=1)
+    step = np.abs(f[:, -1] - f[:, 0])/(f.shape[1] - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Q = np.where(n >= 2, f_min/(n*step), np.nan)
+
+    return 1 - m_min/base, Q
+
+
+# ============================================================================ #
+# appendHistory
+def appendHistory(path, sweep, ids, f0, depth, Q):
+    '''Append a sweep's resonators to the history file (fixed size records,
+    see HISTORY_FIELDS).
+    '''
+
+    import numpy as np
+    from pathlib import Path
+
+    rec = np.empty(len(ids), dtype=np.dtype(HISTORY_FIELDS))
+    rec['sweep'], rec['id'] = sweep, ids
+    rec['f0'], rec['depth'], rec['Q'] = np.real(f0), depth, Q
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'ab') as fh:
+        rec.tofile(fh)
+
+
+# ============================================================================ #
+# loadHistory
+def loadHistory(path, ids=None):
+    '''Load the history file (memory mapped).
+
+    ids: (int or array of ints) Only these resonator IDs (copied), or all.
+
+    Return: (structured array) Records, see HISTORY_FIELDS.
+    '''
+
+    import os
+    import numpy as np
+
+    dt = np.dtype(HISTORY_FIELDS)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dt)
+
+    h = np.memmap(path, dtype=dt, mode='r')
+    if ids is not None:
+        h = h[np.isin(h['id'], ids)]
+
+    return h
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _modeOffset
+def _modeOffset(sorted_f, f, max_shift, bw):
+    '''Most common offset f - sorted_f of all pairs within max_shift
+    (histogram mode, bins of bw), 0 if there are none.
+    '''
+
+    import numpy as np
+    from alcove_commands import freq_index
+
+    lo, hi = freq_index.inRange(sorted_f, f - max_shift, f + max_shift)
+    n = hi - lo
+    if n.sum() == 0:
+        return 0.
+
+    # all pairs, flattened (i repeated n times, j counting up from lo)
+    i = np.repeat(np.arange(len(f)), n)
+    j = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + lo[i]
+    h, e = np.histogram(
+        f[i] - sorted_f[j], bins=max(int(2*max_shift/bw), 1),
+        range=(-max_shift, max_shift))
+    c = np.argmax(h)
+
+    return (e[c] + e[c+1])/2
+
+
+
+# ============================================================================ #
+# Testing
+# ============================================================================ #
+
+def testMatch(R=1000, sweeps=5, tol=20e3, jitter=2e3, shift=15e3,
+              p_miss=0.02, n_spurious=10, seed=0):
+    '''Catalog simulated sweeps (firmware_sim resonators) with a common
+    shift per sweep, jitter, missed and spurious detections, shuffled
+    order. Prints the fraction of true resonators keeping their first ID.
+    '''
+
+    import time
+    import numpy as np
+    from firmware_sim import SimResonators
+
+    rng = np.random.default_rng(seed)
+    f_true = SimResonators(num_res=R, f_min=400e6, f_max=800e6, seed=seed).f0
+
+    cat, first, kept, dt = None, {}, [], 0
+    for s in range(sweeps):
+        seen = rng.random(R) > p_miss
+        f = f_true[seen] + rng.uniform(-1, 1)*shift + rng.normal(0, jitter, seen.sum())
+        f = np.concatenate((f, rng.uniform(400e6, 800e6, n_spurious)))
+        true = np.concatenate((np.flatnonzero(seen), np.full(n_spurious, -1)))
+        order = rng.permutation(len(f))
+
+        t0 = time.perf_counter()
+        cat, ids = updateCatalog(cat, f[order], np.ones(len(f)), np.ones(len(f)), s, tol)
+        dt += time.perf_counter() - t0
+
+        n_ok = 0
+        for t, i in zip(true[order], ids):
+            if t < 0:
+                continue
+            n_ok += first.setdefault(t, i) == i
+        kept.append(n_ok/np.count_nonzero(true >= 0))
+
+    print(f"{sweeps} sweeps of {R} resonators in {dt*1e3:.0f} ms, "
+          f"IDs kept: {', '.join(f'{k:.4f}' for k in kept)}")
@@ -0,0 +1,444 @@
+# ============================================================================ #
+# resonator_fit.py
+# Batched resonator S21 fitting (Levenberg-Marquardt).
+# CCAT Prime 2024
+# ============================================================================ #
+
+#############################################################
+### S21 = A exp(i(alpha - 2 pi (f-fc) tau))               ###
+###       (1 - (Qr/Qc) exp(i phi0) / (1 + 2i y))          ###
+### y = y0 + a/(1 + 4y^2), y0 = Qr (f - f0)/f0            ###
+### (as firmware_sim.SimResonators, upwards sweep).       ###
+### All resonators of a sweep are fitted together, with   ###
+### analytic Jacobians; stragglers are refitted one by    ###
+### one (scipy) on a process pool.                        ###
+#############################################################
+
+# numpy is imported at module level (not in functions as elsewhere)
+# since the batched model and Jacobian run every iteration
+import numpy as np
+
+try: from config import board as cfg_b
+except ImportError: cfg_b = None
+
+
+
+# ============================================================================ #
+# CONSTANTS
+# ============================================================================ #
+
+# fit result rows, see fitResonators
+FIT_PARAMS = (
+    'f0', 'Qr', 'Qc', 'Qi', 'phi0', 'a', 'amp', 'alpha', 'tau', 'resid', 'converged')
+
+_N_P   = 8    # internal parameters, see _unpack
+_A_MAX = 0.75 # max nonlinearity (bifurcation at ~0.77)
+
+
+
+# ============================================================================ #
+# EXTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# fitResonators
+def fitResonators(f, Z, window=6, max_iter=100, tol=1e-8, batch_size=128,
+                  straggler_resid=5, workers=None):
+    '''Fit the resonator S21 model to each row of f, Z.
+
+    f:  (2D array of floats) Frequencies [Hz], one resonator per row.
+    Z:  (2D array of complex) S21, same shape.
+    window:     (float) Fit points within this many (initial guess)
+        linewidths of the resonance, keeping neighbouring resonators in
+        the sweep out of the fit. None fits all points.
+    max_iter:   (int) Max LM iterations.
+    tol:        (float) Relative cost change (or step) for convergence.
+    batch_size: (int) Resonators fitted together (bounds memory).
+    straggler_resid: (float) Rows not converged, or with resid above this
+        multiple of the median, are refitted one by one.
+    workers:    (int) Processes for refitting, default cfg_b.fit_workers.
+        0 refits in this process.
+
+    Return: (dict) name: 1D array (one per row), see FIT_PARAMS.
+        Qi from 1/Qi = 1/Qr - cos(phi0)/Qc.
+        tau [s]. resid is rms residual relative to amp.
+    '''
+
+    f = np.asarray(np.real(f), dtype=float)
+    Z = np.asarray(Z, dtype=complex)
+    R = f.shape[0]
+
+    x, x0 = np.zeros((R, _N_P)), np.zeros((R, _N_P))
+    fc, s = np.zeros((R, 1)), np.zeros((R, 1))
+    cost = np.zeros(R)
+    converged = np.zeros(R, dtype=bool)
+    w = np.ones(f.shape)
+
+    for i in range(0, R, batch_size):
+        b = slice(i, i + batch_size)
+        fc[b], s[b], x0[b] = _initialGuess(f[b], Z[b])
+        if window is not None:
+            w[b] = np.abs(f[b] - fc[b]) <= float(window)*s[b]
+        x[b], cost[b], converged[b] = _lm(
+            x0[b], f[b], Z[b], w[b], fc[b], s[b], max_iter, tol)
+
+    # stragglers, one by one (from the initial guess)
+    n = w.sum(axis=1)
+    resid = _resid(x, cost, n)
+    med = np.median(resid[converged]) if np.any(converged) else np.inf
+    redo = np.flatnonzero(~converged | (resid > straggler_resid*med))
+    if len(redo):
+        x[redo], cost[redo], converged[redo] = _refit(
+            x[redo], x0[redo], f[redo], Z[redo], w[redo], fc[redo], s[redo],
+            cost[redo], converged[redo], workers)
+
+    # resonance left the fit window: likely fitted a neighbour
+    if window is not None:
+        converged &= np.abs(x[:, 0]) <= float(window)
+
+    return _results(x, fc, s, cost, converged, n)
+
+
+# ============================================================================ #
+# modelS21
+def modelS21(f, f0, Qr, Qc, phi0=0, a=0, amp=1, alpha=0, tau=0, fc=None):
+    '''The fitted S21 model at frequencies f (for one resonator).
+
+    fc: (float) Reference frequency of alpha and tau. Default f0.
+    '''
+
+    f = np.atleast_2d(np.asarray(f, dtype=float))
+    fc = f0 if fc is None else fc
+    s = f0/Qr
+    x = np.array([[(f0 - fc)/s, np.log(Qr), np.log(Qc), phi0, a,
+                   np.log(amp), alpha, tau*1e9]])
+
+    S, _ = _model(x, f, np.array([[fc]]), np.array([[s]]), jac=False)
+
+    return S[0]
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _unpack
+def _unpack(x, fc, s):
+    '''Physical parameters from internal ones (R, _N_P).
+    Internal: f0 offset (in initial linewidths s), log Qr, log Qc, phi0, a,
+    log amp, alpha, tau [ns]; scaled so the LM steps are well conditioned.
+    '''
+
+    c = lambda j: x[:, j:j+1]
+    return (fc + c(0)*s, np.exp(c(1)), np.exp(c(2)), c(3), c(4),
+            np.exp(c(5)), c(6), c(7)*1e-9)
+
+
+# ============================================================================ #
+# _solveY
+def _solveY(y0, a, iterations=8):
+    '''Nonlinear detuning y = y0 + a/(1 + 4y^2), Newton from y0.
+    Unique for a below bifurcation.
+
+    Return: (y, dF/dy) with F(y) = y - y0 - a/(1 + 4y^2).
+    '''
+
+    y = y0.copy()
+    for _ in range(iterations):
+        u = 1 + 4*y**2
+        Fp = 1 + 8*a*y/u**2
+        y -= (y - y0 - a/u)/Fp
+
+    u = 1 + 4*y**2
+
+    return y, 1 + 8*a*y/u**2
+
+
+# ============================================================================ #
+# _model
+def _model(x, f, fc, s, jac=True):
+    '''Model S21 and its Jacobian for each row.
+
+    x: (R, _N_P) Internal parameters.
+    f: (R, N) Frequencies.
+    fc, s: (R, 1) Reference frequency and f0 scale.
+
+    Return: (S, J) (R, N) and (R, N, _N_P) complex (J None if not jac).
+    '''
+
+    f0, Qr, Qc, phi0, a, amp, alpha, tau = _unpack(x, fc, s)
+
+    y0 = Qr*(f - f0)/f0
+    y, Fp = _solveY(y0, a)
+    u = 1 + 4*y**2
+
+    g = (Qr/Qc)*np.exp(1j*phi0)
+    D = 1 + 2j*y
+    gD = g/D
+    E = amp*np.exp(1j*(alpha - 2*np.pi*(f - fc)*tau))
+    S = E*(1 - gD)
+
+    if not jac:
+        return S, None
+
+    J = np.empty(f.shape + (_N_P,), dtype=complex)
+    EgD2 = 2j*E*gD/D # dS/dy
+
+    dy0_df0 = -Qr*f/f0**2 # d y0 / d f0
+    J[..., 0] = EgD2*(dy0_df0*s)/Fp       # f0 offset
+    J[..., 1] = -E*gD + EgD2*y0/Fp        # log Qr (in g and y0)
+    J[..., 2] = E*gD                      # log Qc
+    J[..., 3] = -1j*E*gD                  # phi0
+    J[..., 4] = EgD2/(u*Fp)               # a
+    J[..., 5] = S                         # log amp
+    J[..., 6] = 1j*S                      # alpha
+    J[..., 7] = -2j*np.pi*(f - fc)*1e-9*S # tau [ns]
+
+    return S, J
+
+
+# ============================================================================ #
+# _initialGuess
+def _initialGuess(f, Z):
+    '''Initial internal parameters from the sweep shape.
+    Delay from the edge phase slope, amp and rotation from the edges,
+    f0 at min |S21|, Qr from the dip width, Qc from its depth.
+
+    Return: (fc, s, x0)
+    '''
+
+    R, N = f.shape
+    m = max(N//10, 1)   # edge points
+
+    # cable delay from the (unwrapped) phase slope between the edges
+    ph = np.unwrap(np.angle(Z), axis=1)
+    slope = (ph[:, -m:].mean(1) - ph[:, :m].mean(1)) \
+          / (f[:, -m:].mean(1) - f[:, :m].mean(1))
+    tau = -slope/(2*np.pi)
+
+    fc = f[:, N//2:N//2+1]
+    Zc = Z*np.exp(2j*np.pi*(f - fc)*tau[:, None])
+
+    e = np.concatenate((Zc[:, :m], Zc[:, -m:]), axis=1).mean(1)
+    zn = np.abs(Zc/e[:, None])
+
+    i_min = np.argmin(zn, axis=1)
+    rows = np.arange(R)
+    f0 = f[rows, i_min]
+    m_min = zn[rows, i_min]
+    depth = np.clip(1 - m_min, 0.05, 0.99)
+
+    # full width at half (power) depth
+    df = np.abs(f[:, 1] - f[:, 0])
+    half = (1 + m_min**2)/2
+    fwhm = np.maximum(np.count_nonzero(zn**2 < half[:, None], axis=1), 2)*df
+    Qr = f0/fwhm
+    Qc = Qr/depth
+
+    fc = f0[:, None]
+    s = (f0/Qr)[:, None]
+    x0 = np.stack((
+        np.zeros(R), np.log(Qr), np.log(Qc), np.zeros(R), np.zeros(R),
+        np.log(np.abs(e)), np.angle(e) + 2*np.pi*(f0 - f[:, N//2])*tau, tau*1e9), axis=1)
+
+    return fc, s, x0
+
+
+# ============================================================================ #
+# _lm
+def _lm(x, f, Z, w, fc, s, max_iter, tol):
+    '''Batched Levenberg-Marquardt, one damping per row.
+    w: (R, N) Point weights (0 or 1, see fitResonators window).
+    Rows stop when the cost change (relative) or the step is below tol,
+    or the damping blows up.
+
+    Return: (x, cost, converged)
+    '''
+
+    x = x.copy()
+    R = len(x)
+    lam = np.full(R, 1e-3)
+    converged = np.zeros(R, dtype=bool)
+
+    S, J = _model(x, f, fc, s)
+    r = w*(S - Z)
+    J *= w[..., None]
+    cost = np.sum(np.abs(r)**2, axis=1)
+
+    active = np.arange(R)
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        a = active
+
+        # normal equations, real parameters: Re(J^H J), Re(J^H r)
+        JH = J.conj().transpose(0, 2, 1)
+        JJ = (JH @ J).real
+        Jr = (JH @ r[..., None])[..., 0].real
+        d = np.einsum('rpp->rp', JJ) + 1e-12
+        M = JJ + (lam[a][:, None]*d)[:, :, None]*np.eye(_N_P)
+
+        # a held at its bound when the descent direction points out of it
+        xa, ga = x[a, 4], Jr[:, 4]
+        hold = ((xa <= 0) & (ga > 0)) | ((xa >= _A_MAX) & (ga < 0))
+        M[hold, 4, :] = M[hold, :, 4] = 0
+        M[hold, 4, 4] = 1
+        Jr[hold, 4] = 0
+
+        try:
+            dx = -np.linalg.solve(M, Jr[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            dx = -np.array([np.linalg.lstsq(Mi, Ji, rcond=None)[0] for Mi, Ji in zip(M, Jr)])
+
+        x_new = x[a] + dx
+        x_new[:, 4] = np.clip(x_new[:, 4], 0, _A_MAX)
+        S_new, J_new = _model(x_new, f[a], fc[a], s[a])
+        r_new = w[a]*(S_new - Z[a])
+        J_new *= w[a][..., None]
+        cost_new = np.sum(np.abs(r_new)**2, axis=1)
+
+        better = np.isfinite(cost_new) & (cost_new < cost[a])
+        small = (cost[a] - cost_new < tol*cost[a]) | (np.max(np.abs(dx), axis=1) < tol)
+        done = (better & small) | (lam[a] > 1e10)
+
+        b = a[better]
+        x[b], cost[b] = x_new[better], cost_new[better]
+        r[better], J[better] = r_new[better], J_new[better]
+        lam[b] /= 3
+        lam[a[~better]] *= 4
+        converged[a[done]] = lam[a[done]] <= 1e10
+
+        keep = ~done
+        active, J, r = a[keep], J[keep], r[keep]
+
+    return x, cost, converged
+
+
+# ============================================================================ #
+# _refit
+def _refit(x, x0, f, Z, w, fc, s, cost, converged, workers=None):
+    '''Refit rows one by one with scipy least_squares, in a process pool,
+    from the initial guesses x0.
+    Keeps the better (lower cost) of the batched and refitted results.
+    '''
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    if workers is None:
+        workers = getattr(cfg_b, 'fit_workers', 0)
+
+    jobs = [(x0[i], f[i][w[i] > 0], Z[i][w[i] > 0], fc[i], s[i]) for i in range(len(x))]
+    if workers and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            out = list(pool.map(_fitOne, *zip(*jobs)))
+    else:
+        out = [_fitOne(*job) for job in jobs]
+
+    x, cost, converged = x.copy(), cost.copy(), converged.copy()
+    for i, (xi, ci, ok) in enumerate(out):
+        if ci < cost[i]:
+            x[i], cost[i] = xi, ci
+            converged[i] = ok
+
+    return x, cost, converged
+
+
+# ============================================================================ #
+# _fitOne
+def _fitOne(x0, f, Z, fc, s):
+    '''Fit one resonator with scipy least_squares (trust region reflective).
+
+    Return: (x, cost, success)
+    '''
+
+    from scipy.optimize import least_squares
+
+    f, Z = f[None], Z[None]
+    fc, s = fc.reshape(1, 1), s.reshape(1, 1)
+
+    def fun(xi):
+        S, _ = _model(xi[None], f, fc, s, jac=False)
+        r = (S - Z)[0]
+        return np.concatenate((r.real, r.imag))
+
+    def jac(xi):
+        _, J = _model(xi[None], f, fc, s)
+        return np.concatenate((J[0].real, J[0].imag))
+
+    lo = np.full(_N_P, -np.inf); lo[4] = 0
+    hi = np.full(_N_P, np.inf); hi[4] = _A_MAX
+    x0 = np.clip(x0, lo, hi)
+
+    try:
+        res = least_squares(fun, x0, jac=jac, bounds=(lo, hi), method='trf')
+    except Exception:
+        return x0, np.inf, False
+
+    return res.x, 2*res.cost, bool(res.success)
+
+
+# ============================================================================ #
+# _resid
+def _resid(x, cost, n):
+    '''rms residual relative to the fitted amplitude.'''
+
+    return np.sqrt(cost/n)/np.exp(x[:, 5])
+
+
+# ============================================================================ #
+# _results
+def _results(x, fc, s, cost, converged, n):
+    '''Fit results by name, see FIT_PARAMS.'''
+
+    f0, Qr, Qc, phi0, a, amp, alpha, tau = (v[:, 0] for v in _unpack(x, fc, s))
+
+    with np.errstate(divide='ignore'):
+        Qi = 1/(1/Qr - np.cos(phi0)/Qc)
+
+    return {
+        'f0':f0, 'Qr':Qr, 'Qc':Qc, 'Qi':Qi, 'phi0':phi0, 'a':a,
+        'amp':amp, 'alpha':alpha, 'tau':tau,
+        'resid':_resid(x, cost, n), 'converged':converged}
+
+
+
+# ============================================================================ #
+# Testing
+# ============================================================================ #
+
+def testFitResonators(R=1000, N=500, noise=0.01, a_max=0.5, seed=0):
+    '''Fit simulated resonators (firmware_sim model) and compare
+    with the true parameters. Prints time and median relative errors.
+    '''
+
+    import time
+    from firmware_sim import SimResonators
+
+    rng = np.random.default_rng(seed)
+    res = SimResonators(num_res=R, f_min=400e6, f_max=800e6, a_max=a_max, seed=seed)
+
+    # 1 MHz around each (slightly off) resonance, isolated resonators
+    fc = res.f0 + rng.uniform(-50e3, 50e3, R)
+    f = fc[:, None] + np.linspace(-0.5e6, 0.5e6, N)[None]
+    tau = 50e-9
+    Z = np.empty_like(f, dtype=complex)
+    for i in range(R):
+        Z[i] = res._s21(f[i], np.full(N, i), 1)
+    Z *= 1e3*np.exp(1j*1.0)*np.exp(-2j*np.pi*f*tau)
+    Z += 1e3*noise*(rng.normal(size=Z.shape) + 1j*rng.normal(size=Z.shape))
+
+    t0 = time.perf_counter()
+    p = fitResonators(f, Z, workers=0)
+    dt = time.perf_counter() - t0
+
+    rel = lambda a, b: np.median(np.abs(a/b - 1))
+    print(f"{R} resonators ({N} points) fitted in {dt:.2f} s, "
+          f"{np.count_nonzero(p['converged'])} converged")
+    print(f"f0 median error: {np.median(np.abs(p['f0'] - res.f0)):.1f} Hz")
+    print(f"Qr, Qc median relative error: {rel(p['Qr'], res.Qr):.4f}, {rel(p['Qc'], res.Qc):.4f}")
+    print(f"a median error: {np.median(np.abs(p['a'] - res.a)):.4f}")
+    print(f"tau median error: {np.median(np.abs(p['tau'] - tau))*1e9:.2f} ns")
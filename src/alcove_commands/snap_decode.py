@@ -0,0 +1,235 @@
+# ============================================================================ #
+# snap_decode.py
+# Decoding of wide BRAM snap captures (see alcove_base._getSnapData).
+# CCAT Prime 2024
+# ============================================================================ #
+
+# numpy is imported at module level (not in functions as elsewhere)
+# since decodeSnap runs every accumulator read of every sweep step
+import numpy as np
+
+
+
+# ============================================================================ #
+# CONSTANTS
+# ============================================================================ #
+
+_N_WORDS   = 8192 # wide BRAM words read per capture (32 bit)
+_N_SAMPLES = 4096 # I/Q samples per capture
+_N_ROWS    = _N_WORDS//4 # 128 bit rows, 2 samples each
+
+# signed field (offset, bits) within the 96 bit row words[0:3]
+# in sample order (q0, i0, q1, i1)
+_fields = {
+    1: ((0, 18), (18, 18), (36, 18), (54, 18)), # pfb
+    2: ((0, 19), (19, 19), (38, 19), (57, 19)), # ddc
+}
+
+_buf = {} # reusable decode buffers, see _buffers
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _buffers
+def _buffers():
+    '''Decode buffers and their precomputed views.
+    Allocated once and reused by every decodeSnap call.
+    '''
+
+    if _buf:
+        return _buf
+
+    z = np.zeros(_N_SAMPLES, dtype=np.complex64)
+
+    # z as float32 [row, sample in row, re/im]
+    # sample 2m+k of the capture is z[2m+k] = zf[m,k,0] + 1j*zf[m,k,1]
+    zf = z.view(np.float32).reshape(_N_ROWS, 2, 2)
+
+    _buf.update({
+        'z'   :z,
+        'zf'  :zf,
+        # pfb/ddc fields by sample order (q0, i0, q1, i1)
+        'zfields' :(zf[:,0,1], zf[:,0,0], zf[:,1,1], zf[:,1,0]),
+        'c0'  :np.zeros(_N_ROWS, dtype=np.uint64), # words 1:0
+        'c1'  :np.zeros(_N_ROWS, dtype=np.uint64), # words 2:1
+        't'   :np.zeros(_N_ROWS, dtype=np.uint64), # field scratch
+    })
+
+    return _buf
+
+
+# ============================================================================ #
+# _signedField
+def _signedField(c, offset, bits, t, out):
+    '''Extract a signed (two's complement) bit field into out, in place.
+
+    c:      (1D array of uint64) Packed words.
+    offset: (int) Field start bit in c.
+    bits:   (int) Field width.
+    t:      (1D array of uint64) Scratch, same length as c.
+    out:    (1D array of float32) Destination (may be a strided view).
+    '''
+
+    np.right_shift(c, np.uint64(offset), out=t)
+    np.left_shift(t, np.uint64(64 - bits), out=t) # field sign bit to bit 63
+    ts = t.view(np.int64)
+    np.right_shift(ts, 64 - bits, out=ts)         # arithmetic, sign extends
+    np.copyto(out, ts, casting='unsafe')
+
+
+
+# ============================================================================ #
+# EXTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# decodeSnap
+def decodeSnap(wide_data, mux_sel):
+    '''Decode a wide BRAM capture into complex I+jQ samples.
+
+    wide_data: (1D array of uint32) 8192 captured words.
+    mux_sel:   (int) 0-adc, 1-pfb, 2-ddc, 3-accum.
+
+    Return: (1D array of complex64) I+jQ, 4096 samples (4092 for accum).
+        This is a view into a buffer reused by the next call,
+        so copy it if it needs to persist.
+    '''
+
+    b = _buffers()
+    z, zf = b['z'], b['zf']
+    w = np.asarray(wide_data)[:_N_WORDS]
+
+    if mux_sel == 0:
+        # adc: int16 pairs, words 0/1 of each row are Q/I
+        v = w.view(np.int16).reshape(_N_ROWS, 8)
+        np.copyto(zf[:,:,0], v[:,2:4], casting='unsafe') # I
+        np.copyto(zf[:,:,1], v[:,0:2], casting='unsafe') # Q
+
+    elif mux_sel == 1 or mux_sel == 2:
+        # pfb/ddc: signed fields packed across words 0-2 of each row
+        w = w.reshape(_N_ROWS, 4)
+        c0, c1, t = b['c0'], b['c1'], b['t']
+
+        np.copyto(c0, w[:,1], casting='unsafe')
+        np.left_shift(c0, np.uint64(32), out=c0)
+        np.bitwise_or(c0, w[:,0], out=c0, casting='unsafe')
+
+        np.copyto(c1, w[:,2], casting='unsafe')
+        np.left_shift(c1, np.uint64(32), out=c1)
+        np.bitwise_or(c1, w[:,1], out=c1, casting='unsafe')
+
+        for (offset, bits), out in zip(_fields[mux_sel], b['zfields']):
+            if offset + bits <= 64:
+                _signedField(c0, offset, bits, t, out)
+            else: # field starts in word 1
+                _signedField(c1, offset - 32, bits, t, out)
+
+    elif mux_sel == 3:
+        # accum: int32 words are already interleaved (i0, q0, i1, q1)
+        v = w.view(np.int32).reshape(_N_ROWS, 2, 2)
+        np.copyto(zf, v, casting='unsafe')
+        return z[4:] # first samples are stale
+
+    else:
+        raise ValueError(f"decodeSnap: Invalid mux_sel ({mux_sel}).")
+
+    return z
+
+
+
+# ============================================================================ #
+# Testing
+# ============================================================================ #
+
+def _decodeSnapRef(wide_data, mux_sel):
+    '''Reference decoder: the original alcove_base._getSnapData parsing.'''
+
+    if mux_sel==0:
+        #adc parsing
+        up0, lw0 = np.int16(wide_data[0::4] >> 16), np.int16(wide_data[0::4] & 0x0000ffff)
+        up1, lw1 = np.int16(wide_data[1::4] >> 16), np.int16(wide_data[1::4] & 0x0000ffff)
+        I = np.zeros(4096)
+        Q = np.zeros(4096)
+        Q[0::2] = lw0
+        Q[1::2] = up0
+        I[0::2] = lw1
+        I[1::2] = up1
+    elif mux_sel==1:
+        # pfb
+        chunk0 = (np.uint64(wide_data[1::4]) << np.uint64(32)) + np.uint64(wide_data[0::4])
+        chunk1 = (np.uint64(wide_data[2::4]) << np.uint64(32)) + np.uint64(wide_data[1::4])
+        q0 = np.int64((chunk0 & 0x000000000003ffff)<<np.uint64(46))/2**32
+        i0 = np.int64(((chunk0>>18) & 0x000000000003ffff)<<np.uint64(46))/2**32
+        q1 = np.int64(((chunk1>>4)  & 0x000000000003ffff)<<np.uint64(46))/2**32
+        i1 = np.int64(((chunk1>>22)  & 0x000000000003ffff)<<np.uint64(46))/2**32
+        I = np.zeros(4096)
+        Q = np.zeros(4096)
+        Q[0::2] = q0/2**14
+        Q[1::2] = q1/2**14
+        I[0::2] = i0/2**14
+        I[1::2] = i1/2**14
+    elif mux_sel==2:
+        # ddc
+        chunk0 = (np.uint64(wide_data[1::4]) << np.uint64(32)) + np.uint64(wide_data[0::4])
+        chunk1 = (np.uint64(wide_data[2::4]) << np.uint64(32)) + np.uint64(wide_data[1::4])
+        q0 = np.int64((chunk0 & 0x00000000000fffff)<<np.uint64(45))/2**32
+        i0 = np.int64(((chunk0>>19) & 0x00000000000fffff)<<np.uint64(45))/2**32
+        q1 = np.int64(((chunk1>>6)  & 0x00000000000fffff)<<np.uint64(45))/2**32
+        i1 = np.int64(((chunk1>>25)  & 0x00000000000fffff)<<np.uint64(45))/2**32
+        I = np.zeros(4096)
+        Q = np.zeros(4096)
+        Q[0::2] = q0/2**13
+        Q[1::2] = q1/2**13
+        I[0::2] = i0/2**13
+        I[1::2] = i1/2**13
+    elif mux_sel==3:
+        # accum
+        q0 = (np.int32(wide_data[1::4])).astype("float")
+        i0 = (np.int32(wide_data[0::4])).astype("float")
+        q1 = (np.int32(wide_data[3::4])).astype("float")
+        i1 = (np.int32(wide_data[2::4])).astype("float")
+        I = np.zeros(4096)
+        Q = np.zeros(4096)
+        Q[0::2] = q0
+        Q[1::2] = q1
+        I[0::2] = i0
+        I[1::2] = i1
+        I, Q = I[4:], Q[4:]
+
+    return I, Q
+
+
+def testDecodeSnap(N=20, seed=0):
+    '''Compare decodeSnap against the reference decoder for all mux modes.
+    Uses random words plus all-zero, all-one and alternating bit patterns.
+    adc, pfb, and ddc must match exactly; accum to float32 precision.
+    '''
+
+    rng = np.random.default_rng(seed)
+    patterns = [np.full(_N_WORDS, p, dtype=np.uint32)
+                for p in (0, 0xFFFFFFFF, 0xAAAAAAAA, 0x55555555, 0x80000000)]
+    patterns += [rng.integers(0, 2**32, _N_WORDS, dtype=np.uint32)
+                 for _ in range(N)]
+
+    for mux_sel in range(4):
+        n_bad = 0
+        for wide_data in patterns:
+            I, Q = _decodeSnapRef(wide_data, mux_sel)
+            z = decodeSnap(wide_data, mux_sel)
+            if mux_sel == 3: # int32 does not fit float32 exactly
+                tol = np.finfo(np.float32).eps*np.max(np.abs([I, Q]))
+            else:
+                tol = 0
+            bad = (np.max(np.abs(z.real - I)) > tol) or (np.max(np.abs(z.imag - Q)) > tol)
+            n_bad += int(bad or len(z) != len(I))
+        print(f"mux_sel={mux_sel}: {len(patterns) - n_bad}/{len(patterns)} match.")
+
+    z0 = decodeSnap(patterns[0], 3)
+    z1 = decodeSnap(patterns[1], 3)
+    print(f"Buffer reused: {np.shares_memory(z0, z1)}")
@@ -6,6 +6,7 @@
 # ============================================================================ #
 
 from alcove_commands.alcove_base import *
+from alcove_commands.alcove_base import _setAccumLength
 
 try: from config import board as cfg_b
 except ImportError: cfg_b = None 
@@ -37,12 +38,12 @@ def _toneFreqsAndAmpsFromSweepData(f, Z, amps, N_steps, mod_amps=False):
 
     if mod_amps:
         # Power
-        # np.gradient provides the slope at each point.
         # The asymmetry of the resonator shape in frequency space 
         # can be characterized by the sum of the max and min slopes.
-        y_grad = np.gradient(y_res, axis=1)         # slope at each point
-        a = np.max(y_grad, axis=1) + np.min(y_grad, axis=1)  # sum max and min slopes
-        a /= np.max(np.abs(y_grad), axis=1)         # normalize
+        # See targetSweepPower and analysis.optimizeTonePowers for
+        # the full (power series) optimization.
+        from alcove_commands.tone_power import asymmetry
+        a = asymmetry(y_res, smooth=1, span=N_steps) # all points
         amps_new = (1 + a)*amps
     else:
         amps_new = amps
@@ -50,9 +51,40 @@ def _toneFreqsAndAmpsFromSweepData(f, Z, amps, N_steps, mod_amps=False):
     return (freqs, amps_new)
 
 
+# ============================================================================ #
+# _sweepProfile
+def _sweepProfile(profile=None):
+    """
+    Resolve a sweep speed/SNR profile (see cfg_b.sweep_profiles).
+
+    profile:         (str) Profile name. Default is cfg_b.sweep_profile.
+
+    RETURN: (dict) Sweep settings with keys
+        profile, accum_length, accums, settle_time [s], discard.
+    """
+
+    profile = profile if profile else cfg_b.sweep_profile
+    if profile not in cfg_b.sweep_profiles:
+        raise ValueError(
+            f"Unknown sweep profile '{profile}'. "
+            f"Options: {list(cfg_b.sweep_profiles.keys())}")
+
+    p = cfg_b.sweep_profiles[profile]
+    accum_length = int(p['accum_length'])
+
+    return {
+        'profile'      :profile,
+        'accum_length' :accum_length,
+        'accums'       :int(p['accums'] if p['accums'] else cfg_b.sweep_accums),
+        'settle_time'  :float(p['settle_periods'])*accumPeriod(accum_length),
+        'discard'      :int(p['discard'])}
+
+
 # ============================================================================ #
 # _sweep
-def _sweep(chan, f_center, freqs, N_steps, chan_bandwidth=None, N_accums=5):
+def _sweep(chan, f_center, freqs, N_steps, chan_bandwidth=None, N_accums=5, 
+           part_file=None, chunk_steps=None, 
+           settle_time=0.003, discard=1, accum_length=None):
     """
     Perform a stepped LO frequency sweep with existing comb centered at f_center.
     
@@ -61,10 +93,21 @@ def _sweep(chan, f_center, freqs, N_steps, chan_bandwidth=None, N_accums=5):
     freqs:           (1D array of floats) Comb frequencies [Hz].
     N_steps:         (int) Number of LO frequencies to divide each channel into.
     chan_bandwidth:  (float) Bandwidth of each channel [MHz].
+    part_file:       (dict) File attributes for partial results.
+        If given, S21 is published in chunks as it is acquired.
+    chunk_steps:     (int) Number of LO steps per published chunk.
+    settle_time:     (float) Wait before each accumulator read [s].
+        Should exceed one accumulation period (see accumPeriod).
+    discard:         (int) Accumulator reads discarded after each LO step.
+    accum_length:    (int) Accumulator length for this sweep.
+        Restored to cfg_b.accum_length after the sweep. None leaves as is.
     
-    RETURN: tuple(f, S21)
+    RETURN: (2D array of complex) S21, shape (2, N_tones*N_steps).
     f:               (1D array of floats) Central frequency for each bin.
     Z:               (1D array of complex) S_21 complex I+jQ for each bin.
+    Unpacks as f, Z = S21. Both rows are tone-major (all steps of tone 0 first).
+
+    Raises CommandCancelled if the queen requests a cancel mid sweep.
     """
 
     import numpy as np
@@ -73,6 +116,10 @@ def _sweep(chan, f_center, freqs, N_steps, chan_bandwidth=None, N_accums=5):
     N_steps  = int(N_steps)
     f_center = float(f_center)
     N_accums = int(N_accums)
+    discard  = int(discard)
+    settle_time = float(settle_time)
+    chunk_steps = int(chunk_steps) if chunk_steps else N_steps
+    N_tones  = len(freqs)
 
     # if getNCLO(chan) != f_center:
     #     print(f"Warning: Set NCLO (={getNCLO(chan)}) differs from f_center (={f_center}).")
@@ -82,55 +129,86 @@ def _sweep(chan, f_center, freqs, N_steps, chan_bandwidth=None, N_accums=5):
     else:                      # LO bandwidth is tone difference
         bw = np.diff(freqs)[0]/1e6 # MHz
     flos = np.linspace(f_center-bw/2., f_center+bw/2., N_steps)
+
+    # preallocated sweep buffer: [f, Z] x tones x steps
+    # this is the final (saved) layout so everything below writes in place
+    # and the flattened return is a view, not a copy
+    S21 = np.zeros((2, N_tones, N_steps), dtype=np.complex128)
+    f, Z = S21[0].real, S21[1]
+    np.add.outer(np.real(freqs), flos*1e6, out=f) # bin frequencies (one row per tone)
+
+    if accum_length is not None:
+        _setAccumLength(chan, int(accum_length))
+        sleep(settle_time)
+
     _, _ = getSnapData(3, wrap=False) # discard previously collected accum samples
     It, Qt = getSnapData(3, wrap=False) # grab new accumulator samples for template
-    def _Z(lofreq, Naccums=N_accums):
+    def _Z(j, lofreq, Naccums=N_accums):
         setFineNCLO(lofreq)
         # _setNCLO2(chan, lofreq)
         # after setting nclo sleep to let old data pass
         # read accumulator snap block a few times to assure
         # new data
-        Is, Qs = 0, 0
-        I, Q = getSnapData(3, wrap=False) #
+        Zj = Z[:, j]       # column view into sweep buffer
+        for i in range(discard):
+            I, Q = getSnapData(3, wrap=False) #
         for i in range(Naccums):
             #I, Q = _getCleanAccum(It, Qt)
-            sleep(0.003)
+            sleep(settle_time)
             I, Q = getSnapData(3, wrap=False) #
-            Is += I/Naccums
-            Qs += Q/Naccums
-        Z = Is + 1j*Qs     # convert I and Q to complex
-        return Z[0:len(freqs)] # only return relevant slice
+            Zj.real += I[:N_tones] # accumulate in place
+            Zj.imag += Q[:N_tones] # (only relevant slice)
+        Zj *= 1/Naccums
     
     # loop over _Z for each LO freq
-    # and flatten
-    Z = (np.array([_Z(lofreq-f_center) for lofreq in flos]).T).flatten()
-    
-    # build and flatten all bin frequencies
-    f = np.array([flos*1e6 + ftone for ftone in freqs]).flatten()
-        
-    setFineNCLO(0)
-    # _setNCLO2(chan, 0)
-
-    return (f, Z)
+    # publishing chunks and checking for cancel between steps
+    try:
+        for j, lofreq in enumerate(flos):
+            checkCancelled()
+            _Z(j, lofreq-f_center)
+
+            if part_file and ((j+1) % chunk_steps == 0 or j+1 == N_steps):
+                j0 = (j // chunk_steps) * chunk_steps # chunk start step
+                publishPartial(
+                    dict(part_file, fname=f"{part_file['fname']}_{j0}"), {
+                    'steps':(j0, j+1), 'N_steps':N_steps, 
+                    'f':f[:, j0:j+1], 'Z':Z[:, j0:j+1]})
+    finally:
+        setFineNCLO(0)
+        # _setNCLO2(chan, 0)
+        if accum_length is not None:
+            _setAccumLength(chan) # back to configured length
+
+    return S21.reshape(2, -1) # flatten tones x steps (view)
 
 
 # ============================================================================ #
 # vnaSweep
-def vnaSweep():
+def vnaSweep(profile=None):
     """Perform a stepped frequency sweep with current comb, save as vna sweep.
+
+    profile:    (str) Sweep speed/SNR profile, e.g. 'fast', 'standard', 'deep'.
+        Default is cfg_b.sweep_profile. See cfg_b.sweep_profiles.
     """
 
     import numpy as np
 
     chan = cfg_b.drid
+    p = _sweepProfile(profile)
 
     f_center = io.load(io.file.f_center_vna)
     freqs_bb = io.load(io.file.freqs_vna)
 
-    S21 = np.array(_sweep(chan, f_center/1e6, freqs_bb,cfg_b.sweep_steps, N_accums=cfg_b.sweep_accums)) # f, Z
+    S21 = _sweep(
+        chan, f_center/1e6, freqs_bb, cfg_b.sweep_steps, 
+        N_accums=p['accums'], settle_time=p['settle_time'], 
+        discard=p['discard'], accum_length=p['accum_length'], 
+        part_file=io.file.s21_vna_part, chunk_steps=cfg_b.sweep_chunk_steps) # f, Z
 
     io.save(io.file.s21_vna, S21)
     io.save(io.file.f_center_vna, f_center)
+    io.save(io.file.s21_vna_meta, dict(
+        p, N_steps=int(cfg_b.sweep_steps), f_center=float(f_center)))
 
     return io.returnWrapper(io.file.s21_vna, S21)
 
@@ -160,7 +238,12 @@ def vnaSweepFull(f_center, N_steps=500):
 
 # ============================================================================ #
 # targetSweep
-def targetSweep():
+def targetSweep(profile=None):
+    """Perform a stepped frequency sweep around target tones, save as targ sweep.
+
+    profile:    (str) Sweep speed/SNR profile, e.g. 'fast', 'standard', 'deep'.
+        Default is cfg_b.sweep_profile. See cfg_b.sweep_profiles.
+    """
 
     # assume comb is written
     # assume nclo is written
@@ -168,28 +251,40 @@ def targetSweep():
     import numpy as np
 
     chan = cfg_b.drid
+    p = _sweepProfile(profile)
     
     f_center = io.load(io.file.f_center_vna) # Hz
     freqs_rf = io.load(io.file.f_res_targ)
     freqs_bb = freqs_rf - f_center
 
-    S21 = np.array(_sweep(chan, f_center/1e6, freqs_bb, 
-                          cfg_b.sweep_steps, chan_bandwidth=cfg_b.target_chan_bw, N_accums=cfg_b.sweep_accums)) 
+    S21 = _sweep(chan, f_center/1e6, freqs_bb, 
+                 cfg_b.sweep_steps, chan_bandwidth=cfg_b.target_chan_bw, 
+                 N_accums=p['accums'], settle_time=p['settle_time'], 
+                 discard=p['discard'], accum_length=p['accum_length'], 
+                 part_file=io.file.s21_targ_part, chunk_steps=cfg_b.sweep_chunk_steps) 
 
     io.save(io.file.s21_targ, S21)
+    io.save(io.file.s21_targ_meta, dict(
+        p, N_steps=int(cfg_b.sweep_steps), f_center=float(f_center), 
+        chan_bandwidth=float(cfg_b.target_chan_bw)))
+
+    if cfg_b.iq_cal_auto:
+        from alcove_commands.analysis import _saveIqCal
+        _saveIqCal(*S21, cfg_b.sweep_steps)
 
     return io.returnWrapper(io.file.s21_targ, S21)
 
 
 # ============================================================================ #
 # customSweep
-def customSweep(bw=1.):
+def customSweep(bw=1., profile=None):
     # assume comb is written
     # assume nclo is written
 
     import numpy as np
 
     chan = cfg_b.drid
+    p = _sweepProfile(profile)
 
     bw = float(bw)
     
@@ -197,13 +292,73 @@ def customSweep(bw=1.):
     freqs_rf = io.load(io.file.f_rf_tones_comb_cust)
     freqs_bb = freqs_rf - f_center
 
-    S21 = np.array(_sweep(
+    S21 = _sweep(
         chan, f_center/1e6, freqs_bb, cfg_b.sweep_steps, 
-        chan_bandwidth=bw, N_accums=cfg_b.sweep_accums)) 
+        chan_bandwidth=bw, N_accums=p['accums'], settle_time=p['settle_time'], 
+        discard=p['discard'], accum_length=p['accum_length']) 
 
     return io.returnWrapper(io.file.s21_custom, S21)
 
 
+# ============================================================================ #
+# targetSweepPower
+def targetSweepPower(n_sweeps=None, step_db=None, profile=None):
+    """Target sweeps at a series of resonator tone powers, from the current
+    comb amplitudes down by step_db per sweep, for optimizeTonePowers.
+    Calibration tones are unchanged. The comb is restored afterwards.
+    Note that the target comb must be written first.
+
+    n_sweeps:   (int) Sweeps in the series. Default cfg_b.tone_power_sweeps.
+    step_db:    (float) Tone power step per sweep [dB].
+        Default cfg_b.tone_power_step_db.
+    profile:    (str) Sweep speed/SNR profile, see targetSweep.
+    """
+
+    import numpy as np
+    from alcove_commands.tones import _writeComb
+
+    chan = cfg_b.drid
+    p = _sweepProfile(profile)
+    n_sweeps = int(n_sweeps) if n_sweeps else cfg_b.tone_power_sweeps
+    step_db = float(step_db) if step_db else cfg_b.tone_power_step_db
+
+    f_center = io.load(io.file.f_center_vna) # Hz
+    freqs_bb = io.load(io.file.f_res_targ).real - f_center
+    f_comb_bb = io.load(io.file.f_rf_tones_comb) - f_center
+    a_comb = io.load(io.file.a_tones_comb)
+    p_comb = io.load(io.file.p_tones_comb)
+
+    # resonator tones are first in the target comb (calibration tones after)
+    R = len(freqs_bb)
+    if len(a_comb) < R:
+        raise Exception("The current comb is not the target comb.")
+
+    gains = 10**(step_db*np.arange(n_sweeps)/20)
+    S21 = []
+    try:
+        for i, g in enumerate(gains):
+            amps = a_comb.copy()
+            amps[:R] *= g
+            _writeComb(chan, f_comb_bb, amps, p_comb)
+            S21.append(_sweep(chan, f_center/1e6, freqs_bb, 
+                cfg_b.sweep_steps, chan_bandwidth=cfg_b.target_chan_bw, 
+                N_accums=p['accums'], settle_time=p['settle_time'], 
+                discard=p['discard'], accum_length=p['accum_length']).copy())
+            print(f"targetSweepPower: sweep {i+1} of {n_sweeps} "
+                  f"({20*np.log10(g):.1f} dB)")
+    finally:
+        _writeComb(chan, f_comb_bb, a_comb, p_comb)
+
+    S21 = np.array(S21)
+    io.save(io.file.s21_power, S21)
+    io.save(io.file.a_power, a_comb[:R][None]*gains[:, None])
+    io.save(io.file.s21_power_meta, dict(
+        p, N_steps=int(cfg_b.sweep_steps), f_center=float(f_center), 
+        chan_bandwidth=float(cfg_b.target_chan_bw), step_db=step_db))
+
+    return io.returnWrapper(io.file.s21_power, S21)
+
+
 # ============================================================================ #
 # targetSweepFull
 '''
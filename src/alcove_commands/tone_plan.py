@@ -0,0 +1,350 @@
+# ============================================================================ #
+# tone_plan.py
+# Comb tone planning: fft bin collisions, bin edges, and tone spacing.
+# CCAT Prime 2024
+# ============================================================================ #
+
+#############################################################
+### Each tone is read out through one fft (pfb) bin, see  ###
+### tones._loadBinList. Two tones in one bin, tones near  ###
+### a bin edge, and tones too close together (overlapping ###
+### ddc channels) give broken channels. planTones nudges  ###
+### such tones (by as little as possible) or drops them.  ###
+#############################################################
+
+import bisect
+
+try: from config import board as cfg_b
+except ImportError: cfg_b = None
+
+
+
+# ============================================================================ #
+# CONSTANTS
+# ============================================================================ #
+
+# res_plan table rows (one column per resonator of the full list,
+# including the tones the plan dropped; kept is 1 for tones in the comb,
+# id the resonator catalog ID, -1 if not catalogued)
+RES_PLAN_PARAMS = ('f', 'amp', 'phi', 'kept', 'id')
+
+
+
+# ============================================================================ #
+# EXTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# planTones
+def planTones(freqs, n_priority=None, edge_margin=None, min_spacing=None,
+              max_nudge=None, max_nudge_low=None, first=None):
+    '''Plan comb tone placement.
+    Tones are snapped to the LUT grid (wf_fs/wf_lut_len) and then nudged
+    off fft bin edges, out of shared bins, and apart, or dropped if that
+    takes more than the max nudge.
+
+    freqs:       (1D array of floats) Baseband tone frequencies [Hz].
+    n_priority:  (int) Tones freqs[:n_priority] (e.g. resonators) are placed
+        before the rest (e.g. calibration tones), which give way and are
+        allowed max_nudge_low. Default all tones.
+    edge_margin: (float) Min distance of a tone from its bin edge [Hz].
+    min_spacing: (float) Min distance between tones [Hz].
+    max_nudge:   (float) Max nudge of a priority tone [Hz].
+    max_nudge_low: (float) Max nudge of the other tones [Hz].
+        Defaults are cfg_b.tone_edge_margin, tone_min_spacing,
+        tone_max_nudge, tone_max_nudge_cal.
+    first:       (1D array of ints) Priority tones placed before the other
+        priority tones (e.g. tones already in the comb, which returning
+        tones give way to). Default none.
+
+    Return: (dict) Report:
+        freqs:   (1D array of floats) Planned frequencies of kept tones.
+        keep:    (1D array of ints) Indices (into freqs) of kept tones, in order.
+        nudge:   (1D array of floats) Nudge of each kept tone [Hz].
+        dropped: (list of dicts) index, freq, reason; for each dropped tone.
+        n_tones, n_kept, n_nudged, n_dropped: (int) Counts.
+    '''
+
+    import numpy as np
+
+    freqs = np.asarray(np.real(freqs), dtype=float)
+    n = len(freqs)
+    n_priority = n if n_priority is None else int(n_priority)
+
+    edge_margin = _default(edge_margin, 'tone_edge_margin')
+    min_spacing = _default(min_spacing, 'tone_min_spacing')
+    max_nudge = _default(max_nudge, 'tone_max_nudge')
+    max_nudge_low = _default(max_nudge_low, 'tone_max_nudge_cal')
+
+    g = _grid()
+    lim = np.floor((g['bw']/2 - edge_margin)/g['df'])*g['df'] # max offset from bin centre
+    cap = np.where(np.arange(n) < n_priority, max_nudge, max_nudge_low)
+
+    # LUT grid, then off bin edges (into own bin, always nearest)
+    f = np.round(freqs/g['df'])*g['df']
+    c = np.round(f/g['bw'])*g['bw']
+    f = np.clip(f, c - lim, c + lim)
+    reasons = np.where(np.abs(f - freqs) > cap, 'bin edge', '').astype(object)
+
+    # bin collisions and spacing: priority tones (first ones first),
+    # then the rest around them
+    placed = np.full(n, np.nan)
+    p = dict(lim=lim, min_spacing=min_spacing, **g)
+    is_first = np.zeros(n, dtype=bool)
+    if first is not None:
+        is_first[np.asarray(first, dtype=int)] = True
+    prio = np.arange(n) < n_priority
+    for group in (
+            np.flatnonzero(prio & is_first), np.flatnonzero(prio & ~is_first),
+            np.arange(n_priority, n)):
+        group = group[reasons[group] == '']
+        _placeGroup(f, freqs, cap, group, placed, reasons, p)
+
+    keep = np.flatnonzero(~np.isnan(placed))
+    nudge = placed[keep] - freqs[keep]
+    dropped = [
+        {'index':int(i), 'freq':float(freqs[i]), 'reason':reasons[i]}
+        for i in np.flatnonzero(np.isnan(placed))]
+
+    return {
+        'freqs'    :placed[keep],
+        'keep'     :keep,
+        'nudge'    :nudge,
+        'dropped'  :dropped,
+        'n_tones'  :n,
+        'n_kept'   :len(keep),
+        'n_nudged' :int(np.count_nonzero(np.abs(nudge) >= g['df'])),
+        'n_dropped':len(dropped)}
+
+
+# ============================================================================ #
+# reportSummary
+def reportSummary(report, f_center=0):
+    '''Plan report as json-able dict (counts, dropped, and nudged tones).
+
+    f_center: (float) Added to frequencies (e.g. for RF) [Hz].
+    '''
+
+    import numpy as np
+
+    nudged = np.flatnonzero(np.abs(report['nudge']) >= _grid()['df'])
+
+    return {
+        'n_tones'  :report['n_tones'],
+        'n_kept'   :report['n_kept'],
+        'n_nudged' :report['n_nudged'],
+        'n_dropped':report['n_dropped'],
+        'dropped'  :[
+            dict(d, freq=d['freq'] + f_center) for d in report['dropped']],
+        'nudged'   :[
+            {'index':int(report['keep'][i]),
+             'freq' :float(report['freqs'][i] + f_center),
+             'nudge':float(report['nudge'][i])} for i in nudged]}
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _default
+def _default(value, name):
+    return float(getattr(cfg_b, name) if value is None else value)
+
+
+# ============================================================================ #
+# _grid
+def _grid():
+    '''LUT grid step (df), fft bin width (bw), and fft length.'''
+
+    return {
+        'df'     :cfg_b.wf_fs/cfg_b.wf_lut_len,
+        'bw'     :cfg_b.wf_fs/cfg_b.wf_fft_len,
+        'fft_len':cfg_b.wf_fft_len}
+
+
+# ============================================================================ #
+# _placeGroup
+def _placeGroup(f, freqs, cap, group, placed, reasons, p):
+    '''Place the tones of group (indices): tones with no conflict (shared
+    or used bin, spacing within group or to placed tones) at f, vectorized,
+    then the conflicting clusters one by one in frequency order.
+    Writes placed (frequency, nan if dropped) and reasons in place.
+    '''
+
+    import numpy as np
+
+    if len(group) == 0:
+        return
+
+    others = np.sort(placed[~np.isnan(placed)])
+    other_bins = _bins(others, p)
+
+    # conflicts from the sorted tones (spacing) and their bins
+    order = np.argsort(f[group], kind='stable')
+    gs, fs_ = group[order], f[group][order]
+    bins = _bins(fs_, p)
+    _, inv, cnt = np.unique(bins, return_inverse=True, return_counts=True)
+    bad = (
+        (cnt[inv] > 1) | np.isin(bins, other_bins)
+        | (_nearest(others, fs_) < p['min_spacing']))
+    close = np.diff(fs_) < p['min_spacing']
+    bad[:-1] |= close
+    bad[1:] |= close
+
+    # vectorized: the rest, as is
+    placed[gs[~bad]] = fs_[~bad]
+    if not bad.any():
+        return
+
+    # conflicting clusters one by one, around the rest
+    placed_f = np.sort(np.concatenate((others, fs_[~bad]))).tolist()
+    used = set(other_bins.tolist()) | set(bins[~bad].tolist())
+    for i in gs[bad]:
+        fi = _placeTone(f[i], freqs[i], cap[i], placed_f, used, p)
+        if fi is None:
+            reasons[i] = _reason(f[i], placed_f, used, p)
+            continue
+        placed[i] = fi
+        bisect.insort(placed_f, fi)
+        used.add(int(_bins(fi, p)))
+
+
+# ============================================================================ #
+# _placeTone
+def _placeTone(f0, f_req, cap, placed_f, used, p):
+    '''Nearest valid position for one tone, or None.
+
+    f0:    (float) Position on the grid, off bin edges.
+    f_req: (float) Requested frequency (nudges are measured from it).
+    cap:   (float) Max nudge.
+    placed_f: (sorted list of floats) Placed tones.
+    used:  (set of ints) Bins of placed tones.
+    '''
+
+    bw, lim, s = p['bw'], p['lim'], p['min_spacing']
+    b = round(f0/bw)
+
+    # candidates: as is, nearest allowed point of this and neighbouring bins,
+    # and just clear of the neighbouring placed tones
+    cands = [f0]
+    for bb in (b-1, b, b+1):
+        cands.append(min(max(f0, bb*bw - lim), bb*bw + lim))
+    j = bisect.bisect_left(placed_f, f0)
+    if j > 0:
+        cands.append(_ceilGrid(placed_f[j-1] + s, p))
+    if j < len(placed_f):
+        cands.append(_floorGrid(placed_f[j] - s, p))
+
+    for fc in sorted(set(cands), key=lambda x:abs(x - f_req)):
+        if abs(fc - f_req) > cap:
+            break
+        if _valid(fc, placed_f, used, p):
+            return fc
+
+    return None
+
+
+# ============================================================================ #
+# _valid
+def _valid(fc, placed_f, used, p):
+    '''Tone at fc is off its bin edge, alone in its bin, and spaced.'''
+
+    bw = p['bw']
+    if abs(fc - round(fc/bw)*bw) > p['lim']:
+        return False
+    if int(_bins(fc, p)) in used:
+        return False
+    j = bisect.bisect_left(placed_f, fc)
+    if j > 0 and fc - placed_f[j-1] < p['min_spacing']:
+        return False
+    if j < len(placed_f) and placed_f[j] - fc < p['min_spacing']:
+        return False
+
+    return True
+
+
+# ============================================================================ #
+# _reason
+def _reason(f0, placed_f, used, p):
+    '''Why a tone at f0 could not be placed.'''
+
+    if int(_bins(f0, p)) in used:
+        return 'bin collision'
+    return 'spacing'
+
+
+# ============================================================================ #
+# _bins
+def _bins(f, p):
+    '''fft bin of f (as _loadBinList, modulo fft_len).'''
+
+    import numpy as np
+
+    return np.int64(np.round(np.asarray(f)/p['bw'])) % p['fft_len']
+
+
+# ============================================================================ #
+# _nearest
+def _nearest(sorted_f, f):
+    '''Distance from each f to the nearest of sorted_f (inf if empty).'''
+
+    import numpy as np
+
+    if len(sorted_f) == 0:
+        return np.full(len(f), np.inf)
+
+    j = np.searchsorted(sorted_f, f)
+    lo = sorted_f[np.clip(j - 1, 0, len(sorted_f) - 1)]
+    hi = sorted_f[np.clip(j, 0, len(sorted_f) - 1)]
+
+    return np.minimum(np.abs(f - lo), np.abs(hi - f))
+
+
+# ============================================================================ #
+# _ceilGrid, _floorGrid
+def _ceilGrid(f, p):
+    import math
+    return math.ceil(f/p['df'])*p['df']
+
+def _floorGrid(f, p):
+    import math
+    return math.floor(f/p['df'])*p['df']
+
+
+
+# ============================================================================ #
+# Testing
+# ============================================================================ #
+
+def testPlanTones(N=2000, seed=0):
+    '''Plan random tones and check that the planned comb has no shared bins,
+    no tones near bin edges or too close, and no nudge over the max.
+    '''
+
+    import time
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    freqs = rng.uniform(-255e6, 255e6, N)
+
+    t0 = time.perf_counter()
+    r = planTones(freqs, n_priority=N - 10)
+    dt = time.perf_counter() - t0
+
+    g = _grid()
+    f = r['freqs']
+    lim = g['bw']/2 - cfg_b.tone_edge_margin
+    off = f - np.round(f/g['bw'])*g['bw']
+    cap = np.where(r['keep'] < N - 10, cfg_b.tone_max_nudge, cfg_b.tone_max_nudge_cal)
+
+    print(f"{N} tones planned in {dt*1e3:.1f} ms: "
+          f"{r['n_kept']} kept, {r['n_nudged']} nudged, {r['n_dropped']} dropped")
+    print(f"bins unique: {len(np.unique(_bins(f, g))) == len(f)}")
+    print(f"off edges: {np.all(np.abs(off) <= lim)}")
+    print(f"spaced: {np.all(np.diff(np.sort(f)) >= cfg_b.tone_min_spacing)}")
+    print(f"nudges within max: {np.all(np.abs(r['nudge']) <= cap)}")
+    print(f"on grid: {np.allclose(f/(g['df']), np.round(f/g['df']))}")
@@ -0,0 +1,223 @@
+# ============================================================================ #
+# tone_power.py
+# Per tone drive power optimization from target sweep power series.
+# CCAT Prime 2024
+# ============================================================================ #
+
+#############################################################
+### A resonator's dip skews as its tone power rises (the  ###
+### nonlinear detuning a grows with power) until it       ###
+### bifurcates at a ~ 0.77. The skew of every tone in     ###
+### every sweep of a power series is measured at once,    ###
+### and each tone's amplitude is set where its skew first ###
+### reaches a target, interpolated in log amplitude       ###
+### between the sweeps of the series.                     ###
+#############################################################
+
+try: from config import board as cfg_b
+except ImportError: cfg_b = None
+
+
+
+# ============================================================================ #
+# CONSTANTS
+# ============================================================================ #
+
+# optimizeTonePowers table rows (one column per resonator tone),
+# followed by the metric of each sweep of the series
+POWER_PARAMS = ('amp', 'state')
+
+
+
+# ============================================================================ #
+# EXTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# asymmetry
+def asymmetry(m, smooth=5, span=2):
+    '''Dip asymmetry: (max + min)/max |slope| of |S21| near the dip
+    (as sweeps._toneFreqsAndAmpsFromSweepData). 0 for a symmetric (linear)
+    dip, towards -1 (upwards sweep) as the resonator nears bifurcation.
+
+    m:      (array of floats) |S21|, sweep points along the last axis
+        (e.g. sweeps x tones x points).
+    smooth: (int) Boxcar length applied first [points] (noise).
+    span:   (float) Only points within span FWHM of the minimum are used
+        (keeps neighbouring resonators in the sweep out).
+
+    Return: (array of floats) Asymmetry, shape m.shape[:-1].
+    '''
+
+    import numpy as np
+
+    m = np.asarray(m, dtype=float)
+    k = int(smooth)
+    if k > 1:
+        c = np.cumsum(m, axis=-1)
+        c = np.concatenate((np.zeros(c.shape[:-1] + (1,)), c), axis=-1)
+        m = (c[..., k:] - c[..., :-k])/k
+    N = m.shape[-1]
+
+    # half depth width about the minimum
+    e = max(N//10, 1)
+    base = np.median(np.concatenate((m[..., :e], m[..., -e:]), axis=-1), axis=-1)
+    i_min = np.argmin(m, axis=-1)
+    m_min = np.take_along_axis(m, i_min[..., None], axis=-1)[..., 0]
+    w = np.count_nonzero(m < ((base + m_min)/2)[..., None], axis=-1)
+    near = np.abs(np.arange(N) - i_min[..., None]) <= (span*w + 1)[..., None]
+
+    g = np.gradient(m, axis=-1)
+    g_max = np.max(np.where(near, g, -np.inf), axis=-1)
+    g_min = np.min(np.where(near, g, np.inf), axis=-1)
+    g_abs = np.max(np.where(near, np.abs(g), 0), axis=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (g_max + g_min)/g_abs
+
+
+# ============================================================================ #
+# nonlinearity
+def nonlinearity(f, Z, **kwargs):
+    '''Fitted nonlinearity parameter a (see resonator_fit) of every sweep
+    and tone, all fitted together.
+
+    f:  (array of floats) Frequencies [Hz], sweep points along the last axis.
+    Z:  (array of complex) S21, same shape.
+    kwargs: Passed to resonator_fit.fitResonators.
+
+    Return: (array of floats) a, shape f.shape[:-1] (nan if not converged).
+    '''
+
+    import numpy as np
+    from alcove_commands import resonator_fit
+
+    f, Z = np.real(f), np.asarray(Z)
+    p = resonator_fit.fitResonators(
+        f.reshape(-1, f.shape[-1]), Z.reshape(-1, Z.shape[-1]), **kwargs)
+    a = np.where(p['converged'], p['a'], np.nan)
+
+    return a.reshape(f.shape[:-1])
+
+
+# ============================================================================ #
+# optimalAmps
+def optimalAmps(amps, metric, target, power_law=None, max_drop_db=10,
+                collapse=0.1):
+    '''Amplitude of each tone where its metric first reaches target in a
+    power series, interpolated in log amplitude between the sweeps.
+    Amplitudes are never above the highest of the series (untested power).
+
+    amps:   (2D array of floats) Tone amplitudes, one sweep per row.
+    metric: (2D array of floats) Metric rising with power (e.g. |asymmetry|
+        or fitted a), same shape. nan is ignored.
+    target: (float) Metric to drive each tone at.
+    power_law: (float) metric ~ amp**power_law (2 for a), to extrapolate
+        tones already past target at the lowest amplitude (down to
+        max_drop_db below it). None keeps the lowest amplitude.
+    collapse: (float) A metric falling by this fraction of its peak at a
+        higher amplitude marks bifurcation (the dip asymmetry collapses
+        past it): the tone is past target from there.
+
+    Return: (amps_opt, state) 1D arrays, one per tone.
+        state: 0 interpolated, 1 below target at every amplitude (highest
+        amplitude), -1 past target at every amplitude (lowest/extrapolated).
+    '''
+
+    import numpy as np
+
+    amps = np.asarray(amps, dtype=float)
+    metric = np.asarray(metric, dtype=float)
+    P, R = amps.shape
+    if P < 2:
+        raise ValueError("optimalAmps: a power series needs at least 2 sweeps.")
+
+    # ascending amplitude, metric made non-decreasing (first crossing)
+    order = np.argsort(amps, axis=0)
+    la = np.log(np.take_along_axis(amps, order, axis=0))
+    m_raw = np.take_along_axis(metric, order, axis=0)
+    m = np.fmax.accumulate(np.where(np.isnan(m_raw), -np.inf, m_raw), axis=0)
+
+    # collapsed (bifurcated): past target from there
+    with np.errstate(invalid='ignore'):
+        m[np.logical_or.accumulate(m_raw < (1 - collapse)*m, axis=0)] = np.inf
+
+    over = m >= target
+    k = np.argmax(over, axis=0)
+    r = np.arange(R)
+
+    # between the sweeps either side of the crossing
+    k1 = np.clip(k, 1, P - 1)
+    m0, m1 = m[k1 - 1, r], m[k1, r]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.nan_to_num(np.clip((target - m0)/(m1 - m0), 0, 1), nan=1)
+    la_opt = la[k1 - 1, r] + t*(la[k1, r] - la[k1 - 1, r])
+    state = np.zeros(R, dtype=int)
+
+    # never reaches target: highest amplitude
+    under = ~over.any(axis=0)
+    la_opt[under] = la[-1, under]
+    state[under] = 1
+
+    # past target from the lowest amplitude
+    past = over[0]
+    la_ext = la[0].copy()
+    if power_law:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            la_ext = la[0] + np.log(target/m[0])/float(power_law)
+        la_ext = np.clip(
+            np.nan_to_num(la_ext, nan=la[0]), la[0] - max_drop_db*np.log(10)/20, la[0])
+    la_opt[past] = la_ext[past]
+    state[past] = -1
+
+    return np.exp(la_opt), state
+
+
+
+# ============================================================================ #
+# Testing
+# ============================================================================ #
+
+def testOptimalAmps(R=500, N=2000, P=11, step_db=-1, noise=1e-3, a_max=1.5,
+                    targets={'asym':0.6, 'fit':0.5}, seed=0):
+    '''Optimize simulated (firmware_sim) resonators from a power series
+    (highest amplitude gives each resonator a up to a_max) with both
+    metrics. Prints time, the resulting nonlinearity a of each resonator
+    at its chosen amplitude (percentiles), and how many are over 0.77.
+    '''
+
+    import time
+    import numpy as np
+    from firmware_sim import SimResonators
+
+    rng = np.random.default_rng(seed)
+    res = SimResonators(num_res=R, f_min=400e6, f_max=800e6, a_max=a_max, seed=seed)
+    lw = res.f0/res.Qr
+
+    # one target sweep window per resonator (1 MHz), tone near f0
+    f_tone = res.f0 + rng.uniform(-0.3, 0.3, R)*lw
+    f = f_tone[:, None] + np.linspace(-0.5e6, 0.5e6, N)[None]
+    j = np.broadcast_to(np.arange(R)[:, None], f.shape).ravel()
+
+    # power series, from the reference amplitude (a as drawn) down
+    amps = np.ones((P, R))*10**(step_db*np.arange(P)/20)[:, None]
+    Z = np.array([res._s21(f.ravel(), j, np.repeat(a**2, N)).reshape(R, N) for a in amps])
+    Z += noise*(rng.normal(size=Z.shape) + 1j*rng.normal(size=Z.shape))
+    F = np.broadcast_to(f, Z.shape)
+
+    for method in ('asym', 'fit'):
+        t0 = time.perf_counter()
+        if method == 'asym':
+            metric, law = np.abs(asymmetry(np.abs(Z))), None
+        else:
+            metric, law = nonlinearity(F, Z, workers=0), 2
+        amps_opt, state = optimalAmps(amps, metric, targets[method], power_law=law)
+        dt = time.perf_counter() - t0
+
+        a = res.a*amps_opt**2 # nonlinearity at the chosen amplitude
+        q = np.percentile(a, [5, 50, 95])
+        print(f"{method}: {P} sweeps of {R} tones in {dt:.2f} s, "
+              f"a at chosen amps (5/50/95%): {q[0]:.2f}/{q[1]:.2f}/{q[2]:.2f}, "
+              f"{np.count_nonzero(a > 0.77)} over 0.77, "
+              f"states (-1/0/1): {[int(np.sum(state == s)) for s in (-1, 0, 1)]}")
@@ -6,6 +6,7 @@
 # ============================================================================ #
 
 from alcove_commands.alcove_base import *
+from alcove_commands.alcove_base import _setAccumLength
 
 try: from config import board as cfg_b
 except ImportError: cfg_b = None 
@@ -13,9 +14,17 @@ except ImportError: cfg_b = None
 
 # ============================================================================ #
 # _loadBinList
-def _loadBinList(chan, freq_list):
+def _loadBinList(chan, freq_list, force=False):
+    """Load the DDC bin table for the given tone frequencies.
+    Only addresses that differ from the last table written are rewritten.
+
+    force: (bool) Rewrite all addresses.
+        A full write is also done when the last table is unknown,
+        e.g. after (re)loading firmware.
+    """
 
     import numpy as np
+    from alcove_commands.hw_context import hwContext
 
     fs = cfg_b.wf_fs # 512e6 
     lut_len = cfg_b.wf_lut_len # 2**20
@@ -27,164 +36,248 @@ def _loadBinList(chan, freq_list):
     if np.size(pos_bin_idx) > 0:
         bin_list[pos_bin_idx] = fft_len - bin_list[pos_bin_idx]
     bin_list = np.abs(bin_list)
+
+    # full table: tone bins then zeros
+    bin_table = np.zeros(fft_len, dtype=np.int64)
+    bin_table[:np.size(bin_list)] = bin_list[:fft_len]
+
     # DSP REGS
-    if chan == 1:
-        dsp_regs = cfg_b.firmware.chan1.dsp_regs_0
-    elif chan == 2:
-        dsp_regs = cfg_b.firmware.chan2.dsp_regs_0
-    elif chan == 3:
-        dsp_regs = cfg_b.firmware.chan3.dsp_regs_0
-    elif chan == 4:
-        dsp_regs = cfg_b.firmware.chan4.dsp_regs_0
-    else:
-        return "Does not compute"
+    hw = hwContext(chan)
     # 0x00 -  fft_shift[9 downto 0], load_bins[22 downto 12], lut_counter_rst[11 downto 11] 
     # 0x04 -  bin_num[9 downto 0]
     # 0x08 -  accum_len[23 downto 0], accum_rst[24 downto 24], sync_in[26 downto 26] (start dac)
     # 0x0c -  dds_shift[8 downto 0]
-    
-    # initialization 
-    # sync_in = 2**26
-    # accum_rst = 2**24  # (active low)
-    # accum_length = (2**19)-1
 
-    # # Load DDC bins
-    # offs=0
-    
-    # only write tones to bin list
-    for addr in range(fft_len):
-        if addr<(np.size(bin_list)):
-            #print("addr = {}, bin# = {}".format(addr, bin_list[addr]))
-            dsp_regs.write(0x04,int(bin_list[addr]))
-            dsp_regs.write(0x00, ((addr<<1)+1)<<12)
-            dsp_regs.write(0x00, 0)
-        else:
-            dsp_regs.write(0x04, 0)
-            dsp_regs.write(0x00, ((addr<<1)+1)<<12)
-            dsp_regs.write(0x00, 0)
+    # only write addresses that changed
+    if force or hw.bin_table is None or len(hw.bin_table) != fft_len:
+        addrs = np.arange(fft_len)
+    else:
+        addrs = np.flatnonzero(bin_table != hw.bin_table)
+
+    hw.bin_table = None # unknown if interrupted
+    if len(addrs) > 0:
+        hw.setLoaded('fft_shift', None) # load_bins strobes clear 0x00
+    _writeBins(hw.dsp_regs, addrs, bin_table[addrs])
+    hw.bin_table = bin_table
+
     return
 
 
+# ============================================================================ #
+# _writeBins
+def _writeBins(dsp_regs, addrs, bins):
+    """Write bins to the DDC bin table at addrs (same length).
+    Each address takes a bin_num write and a load_bins strobe.
+    """
+
+    write = dsp_regs.write
+    for addr, b in zip(addrs.tolist(), bins.tolist()):
+        write(0x04, b)
+        write(0x00, ((addr<<1)+1)<<12)
+        write(0x00, 0)
+
+
 # ============================================================================ #
 # _resetAccumAndSync
 def _resetAccumAndSync(chan, freqs):
-    if chan == 1:
-        dsp_regs = cfg_b.firmware.chan1.dsp_regs_0
-    elif chan == 2:
-        dsp_regs = cfg_b.firmware.chan2.dsp_regs_0
-    elif chan == 3:
-        dsp_regs = cfg_b.firmware.chan3.dsp_regs_0
-    elif chan == 4:
-        dsp_regs = cfg_b.firmware.chan4.dsp_regs_0
-    else:
-        return "Does not compute"
+    from alcove_commands.hw_context import hwContext
+    hw = hwContext(chan)
+    dsp_regs = hw.dsp_regs
     # dsp_regs bitfield map
     # 0x00 -  fft_shift[9 downto 0], load_bins[22 downto 12], lut_counter_rst[11 downto 11] 
     # 0x04 -  bin_num[9 downto 0]
     # 0x08 -  accum_len[23 downto 0], accum_rst[24 downto 24], sync_in[26 downto 26] (start dac)
     # 0x0c -  dds_shift[8 downto 0]
     # initialization
-    sync_in = 2**26
-    accum_rst = 2**24  # (active rising edge)
-    accum_length = (2**19)-1
-    
     fft_shift=0
     if len(freqs)<400:
         fft_shift = 2**9-1 #2**9-1
     else:
         fft_shift = 2**5-1 #2**2-1
-    dsp_regs.write(0x00, fft_shift) # set fft shift
+    if not hw.loaded('fft_shift', fft_shift):
+        dsp_regs.write(0x00, fft_shift) # set fft shift
+        hw.setLoaded('fft_shift', fft_shift)
     ########################
-    dsp_regs.write(0x08, accum_length | sync_in)
-    dsp_regs.write(0x08, accum_length | accum_rst | sync_in)
+    _setAccumLength(chan, cfg_b.accum_length)
     dsp_regs.write(0x0c, 180) # 260)
     return
 
 
 # ============================================================================ #
-# _loadDdr4
-def _loadDdr4(chan, wave_real, wave_imag, dphi):
+# _stageDdr4
+def _stageDdr4(wave_real, wave_imag, dphi, words=None):
+    """Prepare a comb for upload: all work that can be done while
+    the previous comb is still playing.
+
+    words: (1D array of uint32) Already packed DDR4 words, if available
+        (e.g. from the comb service). Default packs wave_real/imag.
+
+    Return: (dphi_words, ddr4_words)
+        dphi BRAM words, and DDR4 words (4 samples per row).
+    """
 
     import numpy as np
-    from pynq import MMIO
-
-    if chan == 1:
-        base_addr_dphis = 0xa004c000
-    elif chan == 2:
-        base_addr_dphis = 0xa0040000
-    elif chan == 3:
-        base_addr_dphis = 0xa0042000
-    elif chan == 4:
-        base_addr_dphis = 0xa004e000
-    else:
-        return "Does not compute"
-    
-    # write dphi to bram
+
     dphi_16b = dphi.astype("uint16")
     dphi_stacked = ((np.uint32(dphi_16b[1::2]) << 16) + dphi_16b[0::2]).astype("uint32")
-    mem_size = 512 * 4 # 32 bit address slots
-    mmio_bram_phis = MMIO(base_addr_dphis, mem_size)
-    mmio_bram_phis.array[0:512] = dphi_stacked[0:512] # the [0:512] indexing is necessary on .array
+
+    if words is None:
+        words = _ddr4Words(wave_real, wave_imag)
+    words = words.reshape(-1, 4)
+
+    return dphi_stacked, words
+
+
+# ============================================================================ #
+# _loadDdr4
+def _loadDdr4(chan, wave_real, wave_imag, dphi, words=None):
+
+    import time
+    from alcove_commands.hw_context import hwContext
+
+    hw = hwContext(chan)
+
+    # pack everything before the ddr4 read mux is switched off
+    # as the tones (of all drones) are off until it is switched back
+    dphi_stacked, words = _stageDdr4(wave_real, wave_imag, dphi, words)
     
-    # slice waveform for uploading to ddr4
-    I0, I1, I2, I3 = wave_imag[0::4], wave_imag[1::4], wave_imag[2::4], wave_imag[3::4]
-    Q0, Q1, Q2, Q3 = wave_real[0::4], wave_real[1::4], wave_real[2::4], wave_real[3::4]
-    data0 = ((np.int32(I0) << 16) + Q0).astype("int32")
-    data1 = ((np.int32(I1) << 16) + Q1).astype("int32")
-    data2 = ((np.int32(I2) << 16) + Q2).astype("int32")
-    data3 = ((np.int32(I3) << 16) + Q3).astype("int32")
+    # write dphi to bram
+    hw.dphis.array[0:512] = dphi_stacked[0:512] # the [0:512] indexing is necessary on .array
+
+    # 16 word rows, 4 consecutive samples per drone (chan)
+    ddr4_rows = hw.ddr4_data.reshape(-1, 16) # mapped once, see hw_context
+    ddr4_chan = ddr4_rows[:, (chan-1)*4:chan*4]
+
     # write waveform to DDR4 memory
-    ddr4mux = cfg_b.firmware.axi_ddr4_mux
+    t0 = time.perf_counter()
+    ddr4mux = hw.ddr4mux
     ddr4mux.write(8,0) # set read valid 
     ddr4mux.write(0,0) # mux switch
-    base_addr_ddr4 = 0x4_0000_0000 #0x5_0000_0000
-    depth_ddr4 = 2**32
-    mmio_ddr4 = MMIO(base_addr_ddr4, depth_ddr4)
-        
-    mmio_ddr4.array[0:4194304][0 + (chan-1)*4::16] = data0
-    mmio_ddr4.array[0:4194304][1 + (chan-1)*4::16] = data1
-    mmio_ddr4.array[0:4194304][2 + (chan-1)*4::16] = data2
-    mmio_ddr4.array[0:4194304][3 + (chan-1)*4::16] = data3
+
+    ddr4_chan[:] = words
 
     ddr4mux.write(8,1) # set read valid 
     ddr4mux.write(0,1) # mux switch
+    print(f"_loadDdr4: ddr4 read off for {(time.perf_counter() - t0)*1e3:.1f} ms")
 
     return
 
 
+# ============================================================================ #
+# _ddr4Words
+_ddr4_words = {} # reused word workspaces by length
+def _ddr4Words(wave_real, wave_imag):
+    """Pack int16 I/Q samples into 32 bit DDR4 words: (I << 16) + Q.
+    Returns a workspace (uint32 view) that is reused by the next call.
+    """
+
+    import numpy as np
+
+    n = len(wave_real)
+    if n not in _ddr4_words:
+        _ddr4_words[n] = (np.empty(n, dtype=np.int32), np.empty(n, dtype=np.int32))
+    words, q = _ddr4_words[n]
+
+    np.copyto(words, wave_imag, casting='unsafe')
+    np.left_shift(words, 16, out=words)
+    np.copyto(q, wave_real, casting='unsafe')
+    words += q
+
+    return words.view(np.uint32)
+
+
+# ============================================================================ #
+# _lowCrestPhases
+def _lowCrestPhases(freqs, iterations=10, clip_ratio=1.0, crest_target=0, tol=0.01):
+    """Deterministic low crest factor phases for a comb of equal amplitudes.
+    Starts from Newman phases (by frequency order), then runs
+    clip-and-project iterations: clip the waveform magnitude to
+    clip_ratio*rms and keep the phases of the tone bins.
+
+    freqs:        (1D array of floats) Tone frequencies [Hz].
+    iterations:   (int) Max clip-and-project iterations.
+    clip_ratio:   (float) Clip level relative to the waveform rms.
+    crest_target: (float) Stop once the crest factor is at or below this.
+    tol:          (float) Stop when an iteration improves by less than this (relative).
+
+    Return: (phis, crest) Best phases (generateWaveDdr4 convention) 
+        and their crest factor (peak/rms of the complex waveform).
+    """
+
+    import numpy as np
+
+    lut_len = cfg_b.wf_lut_len # 2**20
+    k, _ = _combSpectrum(freqs, 1, 0)
+    N = len(k)
+    rms = np.sqrt(N) # unit amplitude tones
+
+    # Newman phases: pi*n^2/N for the n-th tone in frequency
+    n = np.empty(N)
+    n[np.argsort(k, kind='stable')] = np.arange(N)
+    phis = -np.pi*n**2/N # X = exp(-1j*phi)
+
+    X = np.zeros(lut_len, dtype=complex)
+    best = (np.inf, phis)
+    for i in range(int(iterations)+1):
+        X[k] = np.exp(-1j*phis)
+        x = np.fft.ifft(X)*lut_len
+        mag = np.abs(x)
+        crest = np.max(mag)/rms
+
+        improved = crest < best[0]*(1 - tol)
+        if crest < best[0]:
+            best = (crest, phis)
+        if crest <= crest_target or (i > 0 and not improved) or i == iterations:
+            break
+
+        # clip magnitude and project back onto the tone bins
+        x *= np.minimum(1, clip_ratio*rms/np.maximum(mag, 1e-12))
+        phis = -np.angle(np.fft.fft(x)[k])
+
+    return best[1], best[0]
+
+
 # ============================================================================ #
 # genAmpsAndPhis
 def genAmpsAndPhis(
         freqs, amp_max=(2**15-1), amp_factor_init=0.36, phase_loops=10):
     '''Generate the amps and phis from given freqs for a tone comb.
+    Phases are chosen for a low crest factor (see _lowCrestPhases),
+    and amplitudes are equal, as large as fits amp_max up to amp_factor_init.
     
     freqs: (1D array of floats) The tone placement frequencies. 
     amp_max: (float) The maximum waveform amplitude allowed (DAC limited). 
-    amp_factor_init (float) Initial amp_max factor to try.
-        0.36 usually has a quick solution (11+/-5 loops).
-    phase_loops: (float) Max number of loops with random phases.
+    amp_factor_init (float) Max amp_max factor (waveform rms/amp_max).
+    phase_loops: (float) Max number of phase optimization iterations.
     '''
     
     import numpy as np    
-    
-    def ampPeak(freqs, amps, phis):
-        x, _, _ = generateWaveDdr4(freqs, amps, phis)
-        x.real, x.imag = x.real.astype("int16"), x.imag.astype("int16")
-        return np.max(np.abs(x.real + 1j*x.imag))
+    import alcove_commands.wave_cache as wave_cache
     
     N = len(freqs)
-    
-    for amp_factor in np.arange(amp_factor_init, 0, -0.02):
-        amps = np.ones(N)*amp_max*amp_factor/np.sqrt(N)
-           
-        for _ in range(phase_loops):
-            phis = np.random.uniform(-np.pi, np.pi, N) # phases
 
-            if ampPeak(freqs, amps, phis) < amp_max:
-                return amps, phis
+    # phases only depend on the tone LUT indices
+    k, _ = _combSpectrum(freqs, 1, 0)
+    key = wave_cache.key(
+        cfg_b.wf_fs, cfg_b.wf_lut_len, k, amp_factor_init, phase_loops)
+    d = wave_cache.load('phis', key, ['phis', 'crest'])
+
+    if d is not None:
+        phis, crest = np.array(d['phis']), float(d['crest'])
+    else:
+        # stop optimizing once the comb fits at amp_factor_init
+        phis, crest = _lowCrestPhases(
+            freqs, iterations=phase_loops, crest_target=1/amp_factor_init)
+        wave_cache.save('phis', key, {'phis':phis, 'crest':crest})
+
+    # waveform is linear in amplitude so the largest amp_factor is direct
+    # (int16 truncation only lowers the peak)
+    amp_factor = min(amp_factor_init, 0.999/crest)
+    amps = np.ones(N)*amp_max*amp_factor/np.sqrt(N)
+
+    print(f"genAmpsAndPhis: crest factor {crest:.3f}, amp_factor {amp_factor:.3f}")
 
-## Refactor this function to optimize search algorithm
-# Use a binary search algorithm
+    return amps, phis
 
 
 # ============================================================================ #
@@ -208,27 +301,185 @@ def _waveAmpTest(wave, max_amp=2**15-1):
     print(f"max amplitude {maximum:.10f}")
 
 
+# ============================================================================ #
+# _combSpectrum
+def _combSpectrum(freqs, amps, phis):
+    """LUT indices and complex amplitudes of comb tones (as generateWaveDdr4).
+    """
+
+    import numpy as np
+
+    fs = cfg_b.wf_fs # 512e6 
+    lut_len = cfg_b.wf_lut_len # 2**20
+    k = np.int64(np.round(np.real(freqs)/(fs/lut_len)))
+    X = np.exp(-1j*np.real(phis))*np.real(amps)
+
+    return k, X
+
+
+# ============================================================================ #
+# _updateCombWave
+def _updateCombWave(comb, freqs, amps, phis, max_amp=2**15-1, max_exp_tones=8):
+    """Comb waveform from the previously written comb plus changed tones.
+    The waveform is linear in the tone phasors, so only the difference
+    of changed tones is added: a complex exponential per tone (few tones),
+    or an inverse FFT of the sparse difference spectrum (many tones).
+    The update itself is exact (~1e-11), but a base waveform read back
+    from the waveform cache or the comb service is int16, so samples
+    match a full regeneration to within 1 LSB (not bit-exact).
+
+    comb:      (dict) Previously written comb (see _writeComb), or None.
+    freqs, amps, phis: (1D arrays) New comb. Tone frequencies must match.
+    max_amp:   (float) Maximum allowed I or Q waveform amplitude.
+    max_exp_tones: (int) Maximum changed tones summed as exponentials.
+
+    Return: (wave, dphi, freq_actual) as generateWaveDdr4, or
+        None if a full regeneration is needed (no previous comb,
+        different tones, or max_amp would be exceeded).
+    """
+
+    import numpy as np
+
+    if comb is None:
+        return None
+
+    k, X = _combSpectrum(freqs, amps, phis)
+    if not np.array_equal(k, comb['k']) or len(np.unique(k)) != len(k):
+        return None # different (or duplicate) tones
+
+    lut_len = cfg_b.wf_lut_len # 2**20
+    dX = X - comb['X']
+    i_changed = np.flatnonzero(dX)
+    wave = comb['wave'].copy()
+
+    if 0 < len(i_changed) <= max_exp_tones:
+        # exp(2j*pi*k*n/lut_len) with n = m*B + r, as an outer product
+        # phases are reduced in integers so this is exact for any n
+        B = 2**(int(np.log2(lut_len))//2)
+        m = np.arange(lut_len//B, dtype=np.int64)
+        r = np.arange(B, dtype=np.int64)
+        wave_2d = wave.reshape(-1, B)
+        for i in i_changed:
+            hi = np.exp(2j*np.pi*((k[i]*B*m) % lut_len)/lut_len)
+            lo = np.exp(2j*np.pi*((k[i]*r) % lut_len)/lut_len)
+            wave_2d += np.multiply.outer(dX[i]*hi, lo)
+
+    elif len(i_changed) > max_exp_tones:
+        dspec = np.zeros(lut_len, dtype=complex)
+        dspec[k[i_changed]] = dX[i_changed]
+        wave += np.fft.ifft(dspec)*lut_len
+
+    # int16 headroom
+    if max(np.max(np.abs(wave.real)), np.max(np.abs(wave.imag))) > max_amp:
+        return None
+
+    return wave, comb['dphi'], comb['freq_actual']
+
+
+# ============================================================================ #
+# _combKey
+def _combKey(freqs, amps, phis):
+    """Content hash of a comb, see wave_cache.key.
+    Equal keys give equal waveforms.
+    """
+
+    import alcove_commands.wave_cache as wave_cache
+
+    k, _ = _combSpectrum(freqs, amps, phis)
+
+    return wave_cache.key(
+        cfg_b.wf_fs, cfg_b.wf_lut_len, cfg_b.wf_fft_len, k, amps, phis, decimals=9)
+
+
+# ============================================================================ #
+# _generateWaveCached
+def _generateWaveCached(freqs, amps, phis):
+    """generateWaveDdr4 as int16 I/Q, through the on-board waveform cache.
+
+    Return: (wave_real, wave_imag, dphi, freq_actual)
+    """
+
+    import alcove_commands.wave_cache as wave_cache
+
+    key = _combKey(freqs, amps, phis)
+
+    d = wave_cache.load(
+        'wave', key, ['wave_real', 'wave_imag', 'dphi', 'freq_actual'])
+    if d is None:
+        wave, dphi, freq_actual = generateWaveDdr4(freqs, amps, phis)
+        d = {
+            'wave_real'  :wave.real.astype("int16"),
+            'wave_imag'  :wave.imag.astype("int16"),
+            'dphi'       :dphi,
+            'freq_actual':freq_actual}
+        wave_cache.save('wave', key, d)
+
+    return d['wave_real'], d['wave_imag'], d['dphi'], d['freq_actual']
+
+
 # ============================================================================ #
 # _writeComb
 def _writeComb(chan, freqs, amps, phi):
    
     import numpy as np
+    import alcove_commands.comb_synth as comb_synth
+    from alcove_commands.hw_context import hwContext
 
     if np.size(freqs)<1:
         # what do we want to do if freqs empty?
         raise Exception("freqs must not be empty.")
 
+    hw = hwContext(chan)
+
     # freqs *= freqOffsetFixHackFactor() # Fequency offset fix
      # implemented in tones._writeComb and alcove_base._setNCLO
-    wave, dphi, freq_actual = generateWaveDdr4(freqs, amps, phi)
-    # write number of channels to 16 bit value in UDP packet
-    writeChannelCount(len(freqs))
-    #wave_real, wave_imag = _normWave(wave, max_amp=2**15-1)
-    wave_real, wave_imag = wave.real.astype("int16"), wave.imag.astype("int16") 
-    _waveAmpTest(wave, max_amp=2**15-1)
-    _loadDdr4(chan, wave_real, wave_imag, dphi)
-    _loadBinList(chan, freq_actual)
-    _resetAccumAndSync(chan, freq_actual)
+
+    key = _combKey(freqs, amps, phi)
+
+    if hw.comb is not None and hw.loaded('comb', key):
+        # comb already loaded: nothing to write
+        print("_writeComb: comb already loaded.")
+        freq_actual = hw.comb['freq_actual']
+        writeChannelCount(len(freqs))
+        _resetAccumAndSync(chan, freq_actual)
+
+    else:
+        # same tones as the current comb: only add the changed tones
+        # otherwise (or if out of headroom) generate on the board comb service
+        # or, if it is not running, here (or load from cache)
+        ret = _updateCombWave(hw.comb, freqs, amps, phi)
+        synth = None
+        if ret is not None:
+            wave, dphi, freq_actual = ret
+            #wave_real, wave_imag = _normWave(wave, max_amp=2**15-1)
+            wave_real, wave_imag = wave.real.astype("int16"), wave.imag.astype("int16") 
+        else:
+            synth = comb_synth.request(freqs, amps, phi)
+            if synth is not None:
+                wave_real, wave_imag = synth.waveIQ()
+                dphi, freq_actual = synth.dphi, synth.freq_actual
+            else:
+                wave_real, wave_imag, dphi, freq_actual = _generateWaveCached(freqs, amps, phi)
+            # int16 base: later incremental updates are within 1 LSB
+            wave = wave_real + 1j*wave_imag
+
+        try:
+            # write number of channels to 16 bit value in UDP packet
+            writeChannelCount(len(freqs))
+            _waveAmpTest(wave, max_amp=2**15-1)
+            hw.comb = None # unknown if interrupted
+            hw.setLoaded('comb', None)
+            _loadDdr4(chan, wave_real, wave_imag, dphi, 
+                      words=synth.words if synth is not None else None)
+        finally:
+            if synth is not None:
+                synth.close() # service frees the shared memory
+        _loadBinList(chan, freq_actual)
+        _resetAccumAndSync(chan, freq_actual)
+
+        k, X = _combSpectrum(freqs, amps, phi)
+        hw.comb = {'k':k, 'X':X, 'wave':wave, 'dphi':dphi, 'freq_actual':freq_actual}
+        hw.setLoaded('comb', key)
 
     f_center   = io.load(io.file.f_center_vna) # Hz
     freqs_rf_actual = freq_actual + f_center 
@@ -286,14 +537,25 @@ def writeNewVnaComb(freq_noise=5_000):
 
 # ============================================================================ #
 # _writeTargComb
-def _writeTargComb(f_center, freqs_rf, amps=None, phis=None, cal_tones=False):
+def _writeTargComb(f_center, freqs_rf, amps=None, phis=None, cal_tones=False,
+                   first=None):
     """Write the target comb from the given frequencies.
+    Tones are planned first (see tone_plan.py and cfg_b.tone_plan):
+    resonator tones may be nudged or dropped, calibration tones give way.
 
     f_center:   (float) Center LO frequency for sweep [Hz].
     freqs_rf:   (1D array of floats) Resonator frequencies [Hz].
+    amps, phis: (1D arrays of floats) Resonator tone amplitudes and phases,
+        generated if None (nan for single tones, e.g. new to the comb).
     cal_tones:  (bool) Include calibration tones (True).
         Note that findCalTones must be run first.
         Note that this will force new_amps_and_phis=True.
+    first:      (1D array of ints) Resonators planned first, see
+        tone_plan.planTones.
+
+    Return: (freqs_rf_actual, amps, phis, f_res, keep)
+        f_res: (1D array of floats) Planned resonator frequencies [Hz].
+        keep:  (1D array of ints) Indices of the kept resonators.
     """
 
     import numpy as np
@@ -303,22 +565,135 @@ def _writeTargComb(f_center, freqs_rf, amps=None, phis=None, cal_tones=False):
 
     chan = cfg_b.drid
 
-    freqs_bb = freqs_rf - f_center
+    freqs_rf = np.asarray(freqs_rf).real
+    n_res = len(freqs_rf)
 
     if cal_tones:
         f_cal_tones_rf = io.load(io.file.f_cal_tones).real
         freqs_rf = np.append(freqs_rf, f_cal_tones_rf)
-        freqs_bb = freqs_rf - f_center
         amps = None # force recalculation of amps and phis with cal tones
         phis = None
 
+    freqs_bb = freqs_rf - f_center
+    keep = np.arange(len(freqs_bb))
+
+    # nudge or drop colliding tones before they break channels
+    if getattr(cfg_b, 'tone_plan', False):
+        from alcove_commands.tone_plan import planTones, reportSummary
+        plan = planTones(freqs_bb, n_priority=n_res, first=first)
+        keep, freqs_bb = plan['keep'], plan['freqs']
+        if amps is not None and phis is not None:
+            amps, phis = np.asarray(amps)[keep], np.asarray(phis)[keep]
+        io.save(io.file.tone_plan, reportSummary(plan, f_center))
+        print(f"_writeTargComb: tone plan: {plan['n_nudged']} nudged, "
+              f"{plan['n_dropped']} dropped (of {plan['n_tones']}).")
+
     if amps is None or phis is None:
         amps, phis = genVariedAmpsAndPhis(freqs_bb)
+    elif np.any(np.isnan(amps) | np.isnan(phis)): # tones new to the comb
+        new = np.isnan(amps) | np.isnan(phis)
+        a, p = genVariedAmpsAndPhis(freqs_bb)
+        amps, phis = np.where(new, a, amps), np.where(new, p, phis)
 
     freqs_bb_actual = _writeComb(chan, freqs_bb, amps, phis)
     freqs_rf_actual = freqs_bb_actual + f_center 
 
-    return freqs_rf_actual, amps, phis
+    is_res = keep < n_res # kept in input order, resonators first
+    f_res = freqs_bb[is_res] + f_center
+
+    return freqs_rf_actual, amps, phis, f_res, keep[is_res]
+
+
+# ============================================================================ #
+# _loadResPlan
+def _loadResPlan():
+    """Full resonator list of the target comb (see tone_plan.RES_PLAN_PARAMS),
+    with the kept tones from the latest f_res_targ, a_res_targ, p_res_targ
+    (e.g. moved by findTargResonators since the comb was written).
+    All of f_res_targ if there is no list for it (e.g. older data).
+    """
+
+    import numpy as np
+
+    f = io.load(io.file.f_res_targ).real
+    amps = np.real(io.load(io.file.a_res_targ))
+    phis = np.real(io.load(io.file.p_res_targ))
+
+    try:
+        plan = np.array(io.load(io.file.res_plan), dtype=float)
+    except (OSError, IndexError): # none yet
+        plan = None
+
+    if plan is None or np.count_nonzero(plan[3]) != len(f):
+        ids = _resIds(io.file.res_ids_targ, io.file.f_res_targ, len(f))
+        return np.array([f, amps, phis, np.ones(len(f)), ids])
+
+    if len(plan) < 5: # no IDs (older data)
+        plan = np.vstack((plan, np.full(plan.shape[1], -1.)))
+
+    kept = np.flatnonzero(plan[3])
+    plan[0, kept], plan[1, kept], plan[2, kept] = f, amps, phis
+
+    return plan
+
+
+# ============================================================================ #
+# _resPlanWritten
+def _resPlanWritten(plan, keep, f_res, amps, phis):
+    """Full resonator list (see tone_plan.RES_PLAN_PARAMS) updated with
+    the written tones; the others are marked not kept.
+
+    keep: (1D array of ints) Indices into plan of the written tones.
+    f_res, amps, phis: (1D arrays of floats) The written tones.
+    """
+
+    import numpy as np
+
+    plan = np.array(plan, dtype=float)
+    plan[3] = 0
+    plan[:4, keep] = [f_res, amps, phis, np.ones(len(keep))]
+
+    return plan
+
+
+# ============================================================================ #
+# _saveResTarg
+def _saveResTarg(plan):
+    """Save the full resonator list (res_plan) and its kept tones as the
+    resonator tones (f_res_targ, a_res_targ, p_res_targ, res_ids_targ).
+    """
+
+    import numpy as np
+
+    kept = np.flatnonzero(plan[3])
+
+    io.save(io.file.res_plan, plan)
+    io.save(io.file.f_res_targ, plan[0, kept])
+    io.save(io.file.a_res_targ, plan[1, kept])
+    io.save(io.file.p_res_targ, plan[2, kept])
+    io.save(io.file.res_ids_targ, plan[4, kept].astype(int))
+
+
+# ============================================================================ #
+# _resIds
+def _resIds(file_ids, file_f_res, n):
+    """Catalog IDs (file_ids, see analysis.catalogResonators) of the
+    latest file_f_res resonators, all -1 if they were not catalogued since.
+
+    n: (int) Number of resonators.
+    """
+
+    import numpy as np
+
+    try:
+        ids = np.asarray(io.load(file_ids), dtype=float)
+        if (len(ids) == n and io.mostRecentTimestamp(file_ids)
+                >= io.mostRecentTimestamp(file_f_res)):
+            return ids
+    except (OSError, IndexError): # not catalogued
+        pass
+
+    return np.full(n, -1.)
 
 
 # ============================================================================ #
@@ -326,6 +701,8 @@ def _writeTargComb(f_center, freqs_rf, amps=None, phis=None, cal_tones=False):
 def writeTargCombFromVnaSweep(cal_tones=False):
     """Write the target comb from the vna sweep resonator frequencies.
     Note that vnaSweep and findVnaResonators must be run first.
+    Saves the full resonator list (res_plan), including the tones the
+    plan dropped, for later target comb writes.
 
     cal_tones:  (bool) Include calibration tones (True) or not (False).
     Note that findCalTones must be run first.
@@ -337,18 +714,20 @@ def writeTargCombFromVnaSweep(cal_tones=False):
 
     f_center   = io.load(io.file.f_center_vna) # Hz
     freqs_rf = io.load(io.file.f_res_vna).real
-    freqs_bb = freqs_rf - f_center
-
-    amps, phis = genVariedAmpsAndPhis(freqs_bb)
 
-    io.save(io.file.f_res_targ, freqs_rf)
-    io.save(io.file.a_res_targ, amps)
-    io.save(io.file.p_res_targ, phis)
-
-    freqs_rf_comb, amps_comb, phis_comb = _writeTargComb(
+    freqs_rf_comb, amps_comb, phis_comb, f_res, keep = _writeTargComb(
         f_center, freqs_rf, cal_tones=cal_tones)
     # these may have cal_tones added in (not just resonators)
 
+    # resonators as written (may be nudged or dropped, see tone_plan)
+    # resonator tones are first in the comb, cal tones after
+    # with their catalog IDs, kept through later target sweeps
+    n = len(keep)
+    plan = np.array([freqs_rf, *np.full((2, len(freqs_rf)), np.nan),
+                     np.zeros(len(freqs_rf)),
+                     _resIds(io.file.res_ids_vna, io.file.f_res_vna, len(freqs_rf))])
+    _saveResTarg(_resPlanWritten(plan, keep, f_res, amps_comb[:n], phis_comb[:n]))
+
     return io.returnWrapperMultiple(
         [io.file.f_rf_tones_comb, io.file.a_tones_comb, io.file.p_tones_comb], 
         [freqs_rf_comb, amps_comb, phis_comb])
@@ -359,6 +738,8 @@ def writeTargCombFromVnaSweep(cal_tones=False):
 def writeTargCombFromTargSweep(cal_tones=False, new_amps_and_phis=False):
     """Write the target comb from the target sweep resonator frequencies.
     Note that targSweep and findTargResonators must be run first.
+    The full resonator list (res_plan, see writeTargCombFromVnaSweep) is
+    planned again, so tones the plan dropped before may return.
 
     cal_tones:  (bool) Include calibration tones (True).
         Note that findCalTones must be run first.
@@ -371,19 +752,29 @@ def writeTargCombFromTargSweep(cal_tones=False, new_amps_and_phis=False):
     chan = cfg_b.drid
 
     f_center   = io.load(io.file.f_center_vna)
-    freqs_rf = io.load(io.file.f_res_targ).real
-    amps = io.load(io.file.a_res_targ)
-    phis = io.load(io.file.p_res_targ)
+
+    # full resonator list (re-planned, so dropped tones may return)
+    plan = _loadResPlan()
+    freqs_rf, amps, phis = plan[0], plan[1], plan[2]
 
     if new_amps_and_phis:   
         amps = None
         phis = None
 
-    freqs_rf_comb, amps_comb, phis_comb = _writeTargComb(
-        f_center, freqs_rf, amps, phis, cal_tones=cal_tones)
+    # tones in the comb are planned first (returning tones give way)
+    freqs_rf_comb, amps_comb, phis_comb, f_res, keep = _writeTargComb(
+        f_center, freqs_rf, amps, phis, cal_tones=cal_tones,
+        first=np.flatnonzero(plan[3]))
     # These will include cal tones (if cal_tones=True)
     # not just resonator tones.
 
+    # resonators as written (may be nudged or dropped, see tone_plan)
+    # resonator tones are first in the comb, cal tones after
+    n = len(keep)
+    new = _resPlanWritten(plan, keep, f_res, amps_comb[:n], phis_comb[:n])
+    if not np.array_equal(new, plan, equal_nan=True):
+        _saveResTarg(new)
+
     return io.returnWrapperMultiple(
         [io.file.f_rf_tones_comb, io.file.a_tones_comb, io.file.p_tones_comb], 
         [freqs_rf_comb, amps_comb, phis_comb])
@@ -400,8 +791,15 @@ def writeTargCombFromCustomList():
     This differs from tones.writeCombFromCustomList only in that it assumes these are resonator frequencies and writes f_res_targ (to be used in a target sweep).
     """
 
+    import numpy as np
+
     freqs_rf = io.load(io.file.f_rf_tones_comb_cust)
     io.save(io.file.f_res_targ, freqs_rf)
+    io.save(io.file.res_plan, np.array([
+        np.real(freqs_rf), io.load(io.file.a_tones_comb_cust),
+        io.load(io.file.p_tones_comb_cust), np.ones(len(freqs_rf)),
+        np.full(len(freqs_rf), -1.)]))
+    io.save(io.file.res_ids_targ, np.full(len(freqs_rf), -1)) # not catalogued
 
     return writeCombFromCustomList()
 
@@ -448,3 +846,63 @@ def writeCombFromCustomList():
     return io.returnWrapperMultiple(
         [io.file.f_rf_tones_comb, io.file.a_tones_comb, io.file.p_tones_comb], 
         [freqs_rf_comb, amps, phis])
+
+
+
+# ============================================================================ #
+# Testing
+# ============================================================================ #
+
+def _ddr4WordsRef(freqs, amps, phis):
+    """Reference DDR4 words from the original generateWaveDdr4 and _loadDdr4.
+    Word i*16 + j is sample 4*i + j (chan 1 layout, one drone).
+    """
+
+    import numpy as np
+
+    fs = cfg_b.wf_fs
+    lut_len = cfg_b.wf_lut_len
+    k = np.int64(np.round(freqs/(fs/lut_len)))
+    X = np.zeros(lut_len,dtype='complex')
+    for i in range(np.size(k)):
+        X[k[i]] = np.exp(-1j*phis[i])*amps[i]
+    x = np.fft.ifft(X) * lut_len
+    wave_real, wave_imag = x.real.astype("int16"), x.imag.astype("int16")
+
+    words = np.zeros(lut_len, dtype=np.uint32)
+    for j in range(4):
+        words[j::4] = ((np.int32(wave_imag[j::4]) << 16) + wave_real[j::4]).astype("int32")
+    return words
+
+
+def benchWaveDdr4(N=1000, repeats=3, seed=0):
+    """Time waveform synthesis and DDR4 packing against the original path
+    and count word mismatches (double precision must be bit-exact).
+    """
+
+    import time
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    freqs = rng.uniform(-250e6, 250e6, N)
+    amps, phis = genAmpsAndPhis(freqs)
+
+    def timed(f):
+        f() # warm up (workspaces, fft plans)
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            r = f()
+        return r, (time.perf_counter() - t0)/repeats
+
+    ref, t_ref = timed(lambda: _ddr4WordsRef(freqs, amps, phis))
+    print(f"original: {t_ref*1e3:.1f} ms")
+
+    for single in (False, True):
+        def new():
+            x, _, _ = generateWaveDdr4(freqs, amps, phis, single=single)
+            return _ddr4Words(x.real.astype("int16"), x.imag.astype("int16"))
+        words, t = timed(new)
+        n_bad = np.count_nonzero(words != ref)
+        print(f"{'single' if single else 'double'}: {t*1e3:.1f} ms, "
+              f"{n_bad} of {len(ref)} words differ")
+
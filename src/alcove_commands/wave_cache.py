@@ -0,0 +1,240 @@
+# ============================================================================ #
+# wave_cache.py
+# Content addressed on-board caches (comb waveforms, analysis results).
+# CCAT Prime 2024
+# ============================================================================ #
+
+#############################################################
+### Entries are directories of .npy files, named by kind  ###
+### and a hash of the (quantized) inputs. They are shared ###
+### by all drones on the board and evicted least recently ###
+### used first when the cache exceeds its quota. Each     ###
+### cache ('wave', 'analysis') has its own directory and  ###
+### quota in the board config: <cache>_cache_dir/_quota.  ###
+#############################################################
+
+import os
+
+try: from config import board as cfg_b
+except ImportError: cfg_b = None
+
+# hits and misses of this process, by cache
+_counts = {}
+
+# tmp dirs of saves older than this were left by a crashed save
+_tmp_max_age = 3600 # [s]
+
+
+
+# ============================================================================ #
+# EXTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# key
+def key(*arrays, decimals=6):
+    '''Content hash of the given arrays/values.
+    Floats are rounded to decimals so equal combs hash equally.
+
+    arrays: (arrays, scalars or str) Inputs, e.g. LUT indices, amps, phis.
+    decimals: (int) Float rounding.
+
+    Return: (str) Hex digest.
+    '''
+
+    import hashlib
+    import numpy as np
+
+    h = hashlib.sha1()
+    for a in arrays:
+        if isinstance(a, str):
+            h.update(f'str{len(a)}:{a}'.encode())
+            continue
+        a = np.asarray(np.real(a))
+        if a.dtype.kind == 'f':
+            a = np.round(a, decimals) + 0. # +0. avoids -0.
+        a = np.ascontiguousarray(a, dtype=np.int64 if a.dtype.kind in 'iub' else float)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+
+    return h.hexdigest()
+
+
+# ============================================================================ #
+# load
+def load(kind, k, names, cache='wave'):
+    '''Load a cache entry as memory mapped arrays.
+
+    kind:  (str) Entry kind, e.g. 'wave'.
+    k:     (str) Key (see key).
+    names: (list of str) Arrays of the entry, e.g. ['phis', 'crest'].
+    cache: (str) Cache, e.g. 'wave' or 'analysis'.
+
+    Return: (dict) name: array, or None if not cached
+        (or any of names is missing).
+    '''
+
+    import numpy as np
+
+    if not _enabled(cache):
+        return None
+
+    d = None
+    path = _entryPath(kind, k, cache)
+    if os.path.isdir(path):
+        try:
+            d = {
+                name:np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                for name in names}
+            os.utime(path) # mark as recently used
+        except (OSError, ValueError): # e.g. evicted while loading
+            d = None
+
+    c = _counts.setdefault(cache, {'hits':0, 'misses':0})
+    c['hits' if d is not None else 'misses'] += 1
+
+    return d
+
+
+# ============================================================================ #
+# save
+def save(kind, k, data, cache='wave'):
+    '''Save a cache entry and evict old entries if over quota.
+    Failures are printed and ignored (the cache is an optimization).
+
+    kind:  (str) Entry kind, e.g. 'wave'.
+    k:     (str) Key (see key).
+    data:  (dict) name: array.
+    cache: (str) Cache, e.g. 'wave' or 'analysis'.
+    '''
+
+    import shutil
+    import tempfile
+    import numpy as np
+
+    if not _enabled(cache):
+        return
+
+    path = _entryPath(kind, k, cache)
+    try:
+        os.makedirs(_cacheDir(cache), exist_ok=True)
+
+        # write to a tmp dir and rename so readers never see partial entries
+        tmp = tempfile.mkdtemp(dir=_cacheDir(cache), prefix='.tmp_')
+        for name, a in data.items():
+            np.save(os.path.join(tmp, f'{name}.npy'), np.asarray(a))
+        try:
+            os.rename(tmp, path)
+        except OSError: # already cached (e.g. by another drone)
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        _evict(getattr(cfg_b, f'{cache}_cache_quota'), cache)
+
+    except OSError as e:
+        print(f"wave_cache.save: {e}")
+
+
+# ============================================================================ #
+# clear
+def clear(cache='wave'):
+    '''Remove all cache entries.'''
+
+    _evict(0, cache)
+
+
+# ============================================================================ #
+# stats
+def stats(cache='wave'):
+    '''Cache use: hits and misses (of this process), entries and size.
+
+    Return: (dict) hits, misses, entries, bytes, quota.
+    '''
+
+    entries = _entries(cache)
+
+    return {
+        **_counts.get(cache, {'hits':0, 'misses':0}),
+        'entries':len(entries),
+        'bytes':sum(e[1] for e in entries),
+        'quota':getattr(cfg_b, f'{cache}_cache_quota', 0)}
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _enabled
+def _enabled(cache):
+    return bool(getattr(cfg_b, f'{cache}_cache_quota', 0))
+
+
+# ============================================================================ #
+# _cacheDir
+def _cacheDir(cache):
+    return os.path.join(cfg_b.dir_root, getattr(cfg_b, f'{cache}_cache_dir'))
+
+
+# ============================================================================ #
+# _entryPath
+def _entryPath(kind, k, cache):
+    return os.path.join(_cacheDir(cache), f'{kind}_{k}')
+
+
+# ============================================================================ #
+# _evict
+def _evict(quota, cache):
+    '''Remove least recently used entries until the cache is within quota.
+    Also removes stale tmp dirs left by crashed saves.
+
+    quota: (int) Max cache size [bytes].
+    '''
+
+    import time
+    import shutil
+
+    d = _cacheDir(cache)
+    if os.path.isdir(d):
+        for name in os.listdir(d):
+            path = os.path.join(d, name)
+            try:
+                if (name.startswith('.tmp_') and
+                        time.time() - os.path.getmtime(path) > _tmp_max_age):
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError: # removed meanwhile
+                continue
+
+    entries = _entries(cache)
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= quota:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+# ============================================================================ #
+# _entries
+def _entries(cache):
+    '''Cache entries as (last used, size, path).'''
+
+    d = _cacheDir(cache)
+    if not os.path.isdir(d):
+        return []
+
+    entries = [] # (last used, size, path)
+    for name in os.listdir(d):
+        path = os.path.join(d, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        try:
+            size = sum(
+                os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError: # removed meanwhile
+            continue
+
+    return entries
@@ -19,12 +19,14 @@ except ImportError: cfg_b = None
 
 # ============================================================================ #
 # save
-def save(file, data):
+def save(file, data, timestamp=None):
     """
     Save data to a file with given attributes.
 
     file: (dict) File attributes. See file class.
     data: The data to save to file. Data type dictated by file_type.
+    timestamp: (str) Version timestamp to use instead of now
+        (e.g. copies of files from elsewhere).
     """
 
     import numpy as np
@@ -43,35 +45,42 @@ def save(file, data):
     
     # timestamp modification
     if use_timestamp:
-        timestamp = _timestamp()
+        timestamp = timestamp or _timestamp()
         fname += f'_{timestamp}'
 
     if file_type == 'npy':
         np.save(f'{dname}/{fname}.npy', data)
 
+    elif file_type == 'json':
+        import json
+        with open(f'{dname}/{fname}.json', 'w') as f:
+            json.dump(data, f, indent=4)
+
 
 # ============================================================================ #
 # load
-def load(file):
+def load(file, mmap_mode=None):
     """
     Load file with given attributes.
     If file has a version history (timestamps), use most recent.
     Convenience wrapper for loadVersion().
 
     file: (dict) File attributes. See file class.
+    mmap_mode: (str) npy files only: memory map (e.g. 'r'), see np.load.
     """
 
-    return loadVersion(file, mostRecentTimestamp(file))
+    return loadVersion(file, mostRecentTimestamp(file), mmap_mode)
 
 
 # ============================================================================ #
 # loadVersion
-def loadVersion(file, timestamp):
+def loadVersion(file, timestamp, mmap_mode=None):
     """
     Load file with given attributes and specific timestamp.
 
     file:      (dict) File attributes. See file class.
     timestamp: (str) Version timestamp.
+    mmap_mode: (str) npy files only: memory map (e.g. 'r'), see np.load.
 
     Return:    Data loaded from file. Data type dictated by file_type. 
     """
@@ -89,7 +98,12 @@ def loadVersion(file, timestamp):
     
     if file_type == 'npy':
         # print(f'{dname}/{fname}.npy')
-        data = np.load(f'{dname}/{fname}.npy')
+        data = np.load(f'{dname}/{fname}.npy', mmap_mode=mmap_mode)
+
+    elif file_type == 'json':
+        import json
+        with open(f'{dname}/{fname}.json') as f:
+            data = json.load(f)
 
     else: # if not npy then try general load
         data = np.loadtxt(f'{dname}/{fname}')
@@ -0,0 +1,222 @@
+# ============================================================================ #
+# comb_service.py
+# Board level comb synthesis service, shared by the drones of a board.
+# CCAT Prime 2024
+# ============================================================================ #
+
+#############################################################
+### One process per board. Drones send synthesis jobs     ###
+### (see alcove_commands/comb_synth.py) which run on a    ###
+### bounded worker pool. Identical jobs in flight are     ###
+### synthesized once and share the same shared memory.    ###
+#############################################################
+
+
+
+# ============================================================================ #
+# IMPORTS
+# ============================================================================ #
+
+
+import os
+import logging
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from multiprocessing.connection import Listener
+
+from config import board as cfg_b
+import alcove_commands.comb_synth as comb_synth
+
+_jobs = {} # comb key: job, see _job
+_lock = threading.Lock()
+
+
+
+
+# ============================================================================ #
+# MAIN
+# ============================================================================ #
+
+
+def main():
+
+    logging.basicConfig(
+        filename='../logs/board.log', level=logging.DEBUG,
+        style='{', datefmt='%Y-%m-%d %H:%M:%S',
+        format='{asctime} {levelname} {filename}:{lineno}: {message}'
+    )
+
+    args = _setupArgparse()
+
+    serve(args.workers)
+
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# print monkeypatch
+_print = print
+def print(*args, **kw):
+    '''Override the print statement.
+    '''
+
+    msg = "comb_service: " + " ".join(map(str, args))
+    logging.info(msg)
+    _print(msg, **kw)
+
+
+# ============================================================================ #
+# _setupArgparse
+def _setupArgparse():
+    '''Setup the argparse arguments'''
+
+    parser = argparse.ArgumentParser(
+        description='Board comb synthesis service.')
+
+    parser.add_argument(
+        "--workers", type=int, default=cfg_b.comb_service_workers,
+        help="worker processes, 0 is one per core")
+
+    return parser.parse_args()
+
+
+# ============================================================================ #
+# _initWorker
+def _initWorker():
+    '''Worker process setup: the pool is sized to the cores already,
+    so each synthesis fft runs single threaded.
+    '''
+
+    cfg_b.wf_fft_workers = 1
+
+
+# ============================================================================ #
+# _job
+def _job(pool, req):
+    '''The job for a request, submitted to the pool if not already in flight.
+    Takes a reference, see _release.
+
+    Return: (key, job) with job a dict: shm, future, refs.
+    '''
+
+    from alcove_commands import tones
+
+    freqs, amps, phis = req['freqs'], req['amps'], req['phis']
+    key = tones._combKey(freqs, amps, phis)
+
+    with _lock:
+        job = _jobs.get(key)
+        if job is None:
+            shm = shared_memory.SharedMemory(create=True, size=cfg_b.wf_lut_len*4)
+            job = _jobs[key] = {
+                'shm'   :shm,
+                'future':pool.submit(comb_synth.synthJob, shm.name, freqs, amps, phis),
+                'refs'  :0}
+        job['refs'] += 1
+
+    return key, job
+
+
+# ============================================================================ #
+# _release
+def _release(key):
+    '''Drop a job reference and free its shared memory if it was the last.
+    '''
+
+    with _lock:
+        job = _jobs[key]
+        job['refs'] -= 1
+        if job['refs'] > 0:
+            return
+        del _jobs[key]
+
+    job['future'].cancel()
+    try:
+        job['future'].result() # the worker must be done with the block
+    except Exception:
+        pass
+    job['shm'].close()
+    job['shm'].unlink()
+
+
+# ============================================================================ #
+# _handle
+def _handle(pool, conn):
+    '''Serve one drone request: synthesize, reply, wait until it is done.
+    '''
+
+    key = None
+    try:
+        key, job = _job(pool, conn.recv())
+        dphi, freq_actual = job['future'].result()
+        conn.send({
+            'shm':job['shm'].name, 'n':cfg_b.wf_lut_len,
+            'dphi':dphi, 'freq_actual':freq_actual})
+        conn.recv() # 'done', or EOFError if the drone went away
+
+    except EOFError:
+        pass
+
+    except Exception as e:
+        print(f"Job failed: {e!r}")
+        try:
+            conn.send({'error':repr(e)})
+        except OSError:
+            pass
+
+    finally:
+        if key is not None:
+            _release(key)
+        conn.close()
+
+
+
+
+# ============================================================================ #
+# COMMANDS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# serve
+def serve(workers=0):
+    '''Run the comb service until interrupted.
+
+    workers: (int) Worker processes, 0 is one per core.
+    '''
+
+    sock = cfg_b.comb_service_socket
+    if os.path.exists(sock):
+        os.remove(sock) # stale, from a previous run
+
+    workers = workers or os.cpu_count()
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_initWorker)
+    listener = Listener(sock, family='AF_UNIX')
+
+    print(f"Listening on {sock} with {workers} workers...")
+
+    try:
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=_handle, args=(pool, conn), daemon=True).start()
+    finally:
+        listener.close()
+        pool.shutdown()
+
+
+
+
+# ============================================================================ #
+# MAIN
+# ============================================================================ #
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,7 @@ import importlib
 
 
 import alcove
+import alcove_commands.alcove_base as alcove_base
 from config import board as cfg_b
 import redis_channels as chans
 
@@ -162,12 +163,21 @@ def _setupTmpDir():
 # _loadFirmware
 def _loadFirmware():
 
+    # offline firmware simulator (no RFSoC)
+    if getattr(cfg_b, 'firmware_sim', False):
+        import firmware_sim
+        firmware_sim.install()
+
     try:
         from pynq import Overlay # type: ignore
 
         firmware_file = os.path.join(cfg_b.dir_root, cfg_b.firmware_file)
         cfg_b.firmware = Overlay(firmware_file, ignore_version=True, download=False)
 
+        # map memory and registers once for all commands
+        from alcove_commands.hw_context import initHwContext
+        initHwContext(cfg_b.drid)
+
     except Exception as e: 
         firmware = None
 
@@ -213,6 +223,7 @@ def listenMode(r, p, chan_subs):
         last_chan_str = chan_str
 
         payload = new_message['data'].decode('utf-8')
+        _setStreamHooks(r, chan_str)
         try:
             com_num, ret_data, args, kwargs = payloadToCom(payload)
             # print(com_num, args, kwargs)
@@ -220,6 +231,7 @@ def listenMode(r, p, chan_subs):
         except Exception as e:
             com_ret = f"Payload error ({payload}): {e}"
             print(com_ret)
+        alcove_base.setStreamHooks() # clear hooks
         
         # publishResponse(com_ret, r, bid, cid) # send response
         publishResponse(com_ret, r, chan_str) # send response
@@ -272,6 +284,55 @@ def publishResponse(resp, r, chan_str):
         pass
 
 
+# ============================================================================ #
+# publishPartial
+def publishPartial(resp, r, chan_str):
+    '''Publish a partial response on the partial return channel.
+    Used by long running commands (e.g. sweeps) before they complete.
+    '''
+
+    chan = chans.comChan(chan=chan_str)
+
+    try: 
+        r.publish(chan.pubPart, pickle.dumps(resp))
+
+    except Exception as e:
+        print(f' Publish partial response failed.')
+
+
+# ============================================================================ #
+# _cancelCount
+def _cancelCount(r):
+    '''Sum of the cancel request counters relevant to this drone.
+    '''
+
+    vals = r.mget(chans.cancelKeyList(cfg_b.bid, cfg_b.drid))
+    return sum(int(v) for v in vals if v is not None)
+
+
+# ============================================================================ #
+# _setStreamHooks
+def _setStreamHooks(r, chan_str):
+    '''Set the alcove partial publishing, cancellation, and fetch hooks 
+    for a command received on chan_str.
+    A command is cancelled if any relevant cancel counter
+    changes after the command starts.
+    '''
+
+    try:
+        count0 = _cancelCount(r)
+    except Exception as e:
+        print(f"Cancel key read failed: {e}")
+        alcove_base.setStreamHooks(
+            publish=lambda d: publishPartial(d, r, chan_str), fetch=r.get)
+        return
+
+    alcove_base.setStreamHooks(
+        publish   = lambda d: publishPartial(d, r, chan_str),
+        cancelled = lambda: _cancelCount(r) > count0, # not on a key reset
+        fetch     = r.get)
+
+
 # ============================================================================ #
 # listToArgsAndKwargs
 def listToArgsAndKwargs(args_list):
@@ -0,0 +1,606 @@
+# ============================================================================ #
+# firmware_sim.py
+# Offline simulator of the RFSoC firmware (cfg_b.firmware) for the alcove
+# commands, so that they can be run and profiled without a board.
+# James Burgoyne jburgoyne@phas.ubc.ca
+# CCAT/FYST 2024
+# ============================================================================ #
+
+# The simulator mimics the parts of the pynq Overlay that alcove uses:
+#   chanN.axi_wide_ctrl, chanN.dsp_regs_0, mix_freq_set_0, axi_ddr4_mux,
+#   gpio_udp_info_control, usp_rf_data_converter_0 (mixer settings),
+#   and a pynq-like MMIO class over a simulated memory space.
+# The comb is recovered from the simulated DDR4 exactly as written by
+# tones._loadDdr4, and the DDC bin list from the dsp_regs writes of
+# tones._loadBinList, so the alcove code paths run unmodified.
+# Accumulator (mux_sel=3) snaps return S21 of a configurable set of
+# (optionally nonlinear) resonators, plus noise, at each tone RF frequency.
+
+# Usage: call install() before the alcove commands access the firmware,
+# e.g. set firmware_sim = True in _cfg_board.py and drone.py will do so.
+
+import sys
+import types
+import numpy as np
+
+try: from config import board as cfg_b
+except ImportError: cfg_b = None
+
+
+
+
+# ============================================================================ #
+# CONFIG
+# ============================================================================ #
+
+
+# snap (wide BRAM) base addresses, see alcove_base._getSnapData
+_base_addr_wide = {
+    1:0x00_A007_0000, 2:0x00_B000_0000, 3:0x00_B000_8000, 4:0x00_8200_0000}
+
+# DDR4 waveform memory, see tones._loadDdr4
+_base_addr_ddr4 = 0x4_0000_0000
+_ddr4_words     = 4194304        # only this much of the 4 GiB is used
+
+# largest simulated memory region (32 bit words)
+_max_words      = _ddr4_words
+
+# adc/dac (tile, block) indices for each drone, see alcove_base._setNCLO
+_tb_indices_v13 = {1:[1,0,1,3], 2:[1,1,1,2], 3:[0,1,1,0], 4:[0,0,1,1]}
+_tb_indices     = {1:[0,0,1,3], 2:[0,1,1,2], 3:[1,0,1,1], 4:[1,1,1,0]}
+
+# the simulator currently in use (MMIO instances map into its memory)
+_sim = None
+
+
+
+
+# ============================================================================ #
+# RESONATORS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# SimResonators
+class SimResonators:
+    def __init__(self, f0=None, Qr=None, Qc=None, a=None, num_res=500,
+                 f_min=360e6, f_max=840e6, a_max=0, seed=0):
+        '''Set of resonators with a nonlinear Lorentzian S21 model.
+
+        f0:      (1D array of floats) Resonance frequencies [Hz].
+        Qr:      (1D array of floats) Loaded quality factors.
+        Qc:      (1D array of floats) Coupling quality factors.
+        a:       (1D array of floats) Nonlinearity (bifurcation at ~0.77).
+        Any not given are drawn randomly using:
+        num_res: (int) Number of resonators.
+        f_min:   (float) Minimum resonance frequency [Hz].
+        f_max:   (float) Maximum resonance frequency [Hz].
+        a_max:   (float) Maximum nonlinearity parameter.
+        seed:    (int) Random seed.
+        '''
+
+        rng = np.random.default_rng(seed)
+
+        if f0 is None:
+            f0 = rng.uniform(f_min, f_max, num_res)
+        f0 = np.sort(np.asarray(f0, dtype=float))
+        n  = len(f0)
+
+        self.f0 = f0
+        self.Qr = np.asarray(Qr if Qr is not None else rng.uniform(2e4, 6e4, n), dtype=float)
+        self.Qc = np.asarray(Qc if Qc is not None else self.Qr/rng.uniform(0.3, 0.8, n), dtype=float)
+        self.a  = np.asarray(a  if a  is not None else rng.uniform(0, a_max, n), dtype=float)
+
+
+    def s21(self, f, amp_factor=1, neighbours=2):
+        '''Forward transmission of all resonators at given frequencies.
+        Only the nearest resonators (either side) to each frequency are used.
+
+        f:          (1D array of floats) Frequencies [Hz].
+        amp_factor: (float or 1D array) Relative drive power (scales a).
+        neighbours: (int) Number of resonators each side to include.
+        '''
+
+        f = np.asarray(f, dtype=float)
+        S21 = np.ones(f.shape, dtype=complex)
+        if len(self.f0) == 0:
+            return S21
+
+        i = np.searchsorted(self.f0, f)
+        for di in range(-neighbours, neighbours):
+            j = i + di
+            valid = (j >= 0) & (j < len(self.f0))
+            j = np.clip(j, 0, len(self.f0) - 1)
+            S21 *= np.where(valid, self._s21(f, j, amp_factor), 1)
+
+        return S21
+
+
+    def _s21(self, f, j, amp_factor):
+        '''S21 of resonators j (one per frequency).'''
+
+        f0, Qr, Qc = self.f0[j], self.Qr[j], self.Qc[j]
+        a = self.a[j]*amp_factor
+
+        # nonlinear detuning: y = y0 + a/(1 + 4y^2), solved iteratively
+        # (upper branch, i.e. upwards sweep)
+        y0 = Qr*(f - f0)/f0
+        y = y0.copy()
+        if np.any(a):
+            for _ in range(30):
+                y = y0 + a/(1 + 4*y**2)
+
+        return 1 - (Qr/Qc)/(1 + 2j*y)
+
+
+
+
+# ============================================================================ #
+# SIMULATED HARDWARE
+# ============================================================================ #
+
+
+# ============================================================================ #
+# MMIO
+class MMIO:
+    def __init__(self, base_addr, length=4, **kwargs):
+        '''pynq-like memory mapped IO into the simulated memory.
+
+        base_addr: (int) Base address.
+        length:    (int) Length in bytes.
+        '''
+
+        self.base_addr = base_addr
+        self.length = length
+        self.array = _sim._region(base_addr, length)
+
+    def read(self, offset=0, length=4):
+        return int(self.array[offset//4])
+
+    def write(self, offset, data):
+        self.array[offset//4] = int(data) & 0xFFFFFFFF
+
+
+# ============================================================================ #
+# _SimRegs
+class _SimRegs:
+    def __init__(self, on_write=None):
+        '''Register block (pynq IP) with read/write and a write hook.'''
+
+        self.regs = {}
+        self.on_write = on_write
+
+    def read(self, offset):
+        return self.regs.get(offset, 0)
+
+    def write(self, offset, value):
+        prev = self.regs.get(offset, 0)
+        self.regs[offset] = int(value)
+        if self.on_write:
+            self.on_write(offset, int(value), prev)
+
+
+# ============================================================================ #
+# _SimMixerBlock
+class _SimMixerBlock:
+    def __init__(self):
+        '''RF data converter adc/dac block (mixer settings only).'''
+
+        self.MixerSettings = {'Freq':0.}
+
+    def UpdateEvent(self, event):
+        pass
+
+
+# ============================================================================ #
+# _SimTile
+class _SimTile:
+    def __init__(self, num_blocks=4):
+        self.blocks = [_SimMixerBlock() for _ in range(num_blocks)]
+
+
+# ============================================================================ #
+# _SimRfdc
+class _SimRfdc:
+    def __init__(self, num_tiles=4):
+        '''RF data converter with adc and dac tiles.'''
+
+        self.adc_tiles = [_SimTile() for _ in range(num_tiles)]
+        self.dac_tiles = [_SimTile() for _ in range(num_tiles)]
+
+
+# ============================================================================ #
+# SimFirmware
+class SimFirmware:
+    def __init__(self, resonators=None, noise=1e-3, adc_rms=1000,
+                 cable_delay=50e-9, ref_amp=373, firmware_file=None, seed=0):
+        '''Simulated firmware overlay, for use as cfg_b.firmware.
+
+        resonators:    (SimResonators) Resonators to simulate.
+        noise:         (float) Relative noise in accumulator values,
+            at the default accumulator length.
+        adc_rms:       (float) ADC noise rms [counts].
+        cable_delay:   (float) Cable delay [s].
+        ref_amp:       (float) Tone amplitude at which the resonator 
+            nonlinearity is a. Nonlinearity scales with tone power.
+            The default is the 1000 tone vna comb amplitude.
+        firmware_file: (str) Firmware filename, for the adc/dac tile mapping.
+        seed:          (int) Random seed for noise.
+        '''
+
+        self.resonators  = resonators if resonators else SimResonators()
+        self.noise       = noise
+        self.adc_rms     = adc_rms
+        self.cable_delay = cable_delay
+        self.ref_amp     = ref_amp
+        self.rng         = np.random.default_rng(seed)
+
+        self.fs      = cfg_b.wf_fs if cfg_b else 512e6
+        self.lut_len = cfg_b.wf_lut_len if cfg_b else 2**20
+        self.fft_len = cfg_b.wf_fft_len if cfg_b else 1024
+
+        self.mem = {}           # base_addr: 32 bit word array
+
+        # per drone (chan) state
+        self.bin_lists = {c:np.zeros(self.fft_len, dtype=int) for c in range(1,5)}
+        self.tones     = {c:None for c in range(1,5)}  # (f_bb, X) from DDR4
+        self.dirty     = {c:True for c in range(1,5)}  # DDR4 needs decoding
+
+        self.gpio_udp_info_control = _SimRegs()
+        self.mix_freq_set_0 = _SimRegs()
+        self.axi_ddr4_mux = _SimRegs(on_write=self._onDdr4Mux)
+        self.usp_rf_data_converter_0 = _SimRfdc()
+
+        for c in range(1,5):
+            chan = types.SimpleNamespace(
+                axi_wide_ctrl = _SimRegs(on_write=self._onWideCtrl(c)),
+                dsp_regs_0    = _SimRegs(on_write=self._onDspRegs(c)))
+            setattr(self, f'chan{c}', chan)
+
+        name = firmware_file if firmware_file else getattr(cfg_b, 'firmware_file', '')
+        try:
+            import os
+            v13 = int(os.path.splitext(os.path.basename(name))[0][7:9]) >= 13
+        except ValueError:
+            v13 = True
+        self.tb_indices = _tb_indices_v13 if v13 else _tb_indices
+
+
+    # ======================================================================== #
+    # memory
+    def _region(self, base_addr, length):
+        '''Word array for the memory region starting at base_addr.'''
+
+        words = min(max(length//4, 1), _max_words)
+        if base_addr not in self.mem or len(self.mem[base_addr]) < words:
+            self.mem[base_addr] = np.zeros(words, dtype=np.uint32)
+        return self.mem[base_addr]
+
+
+    # ======================================================================== #
+    # register write hooks
+    def _onDdr4Mux(self, offset, value, prev):
+        if offset == 0 and value == 1:   # mux switched back to read
+            for c in self.dirty:
+                self.dirty[c] = True
+
+    def _onDspRegs(self, chan):
+        def onWrite(offset, value, prev):
+            if offset == 0x00 and (value >> 12) & 1: # load bin strobe
+                addr = (value >> 13) & 0x3FF
+                self.bin_lists[chan][addr] = self.chan(chan).dsp_regs_0.read(0x04)
+        return onWrite
+
+    def _onWideCtrl(self, chan):
+        def onWrite(offset, value, prev):
+            if offset == 0x08 and (value & 1) and not (prev & 1): # rising edge
+                self._capture(chan, value >> 1)
+        return onWrite
+
+
+    # ======================================================================== #
+    # state
+    def chan(self, chan):
+        return getattr(self, f'chan{chan}')
+
+    def nclo(self, chan):
+        '''Coarse NCLO frequency [Hz].'''
+
+        ii = self.tb_indices[chan]
+        adc = self.usp_rf_data_converter_0.adc_tiles[ii[0]].blocks[ii[1]]
+        return float(adc.MixerSettings['Freq'])*1e6
+
+    def fineNclo(self, chan):
+        '''Fine NCLO frequency shift [Hz].'''
+
+        v = self.mix_freq_set_0.read((chan-1)*4) & 0xFFFFFFFF
+        v = v - 2**32 if v >= 2**31 else v # signed
+        return v*self.fs/2**22
+
+    def accumLength(self, chan):
+        return (self.chan(chan).dsp_regs_0.read(0x08) & 0xFFFFFF) or 2**19-1
+
+    def _tones(self, chan):
+        '''Recover tone baseband frequencies and phasors from DDR4.'''
+
+        if self.dirty[chan]:
+            self.dirty[chan] = False
+            self.tones[chan] = None
+
+            if _base_addr_ddr4 in self.mem:
+                w = self.mem[_base_addr_ddr4][:_ddr4_words].reshape(-1, 16)
+                w = w[:, 4*(chan-1):4*chan].reshape(-1)
+                x = (w & 0xFFFF).astype(np.uint16).view(np.int16) \
+                    + 1j*(w >> 16).astype(np.uint16).view(np.int16)
+                X = np.fft.fft(x)/self.lut_len
+                k = np.flatnonzero(np.abs(X) > 1e-2*np.max(np.abs(X))) # tone LUT bins
+                # (relative threshold rejects int16 truncation products)
+                f_bb = np.where(k > self.lut_len//2, k - self.lut_len, k)*(self.fs/self.lut_len)
+                self.tones[chan] = (f_bb, X[k])
+
+        return self.tones[chan]
+
+
+    # ======================================================================== #
+    # snap capture
+    def _capture(self, chan, mux_sel):
+        '''Write a new snap capture into the wide BRAM of given chan.'''
+
+        n = 4096
+        if mux_sel == 3:
+            z = np.zeros(n, dtype=complex)
+            z[4:] = self._accum(chan, n - 4)
+            z = np.round(z)
+        else:
+            scale = {0:self.adc_rms, 1:2**10, 2:2**12}.get(mux_sel, 1)
+            z = np.round(self.rng.normal(0, scale, n) + 1j*self.rng.normal(0, scale, n))
+
+        words = encodeSnap(mux_sel, z.real, z.imag)
+        self._region(_base_addr_wide[chan], 32768)[:len(words)] = words
+
+    def _accum(self, chan, n):
+        '''Accumulator values for the first n DDC channels.'''
+
+        z = np.zeros(n, dtype=complex)
+        tones = self._tones(chan)
+        if tones is None or len(tones[0]) == 0:
+            return z
+
+        f_bb, X = tones
+        tone_bins = np.int64(np.round(f_bb/(self.fs/self.fft_len))) % self.fft_len
+
+        # tone for each channel, matched through the DDC bin list
+        bins = self.bin_lists[chan][:n]  # (only fft_len channels exist)
+        order = np.argsort(tone_bins, kind='stable')
+        i = np.searchsorted(tone_bins[order], bins)
+        i = np.clip(i, 0, len(order) - 1)
+        has_tone = tone_bins[order][i] == bins
+        t = order[i[has_tone]]
+
+        # tone RF frequencies and resonator response
+        f_rf = self.nclo(chan) + self.fineNclo(chan) + f_bb[t]
+        amp_factor = (np.abs(X[t])/self.ref_amp)**2 # relative tone power
+        S21 = self.resonators.s21(f_rf, amp_factor)
+        S21 *= np.exp(-2j*np.pi*f_rf*self.cable_delay)
+
+        # accumulator gain and noise (noise averages down with length)
+        accum_len = self.accumLength(chan)
+        gain = accum_len/2**12
+        sigma = self.noise*np.sqrt((2**19-1)/accum_len)
+        noise = self.rng.normal(0, 1, len(t)) + 1j*self.rng.normal(0, 1, len(t))
+
+        z[:len(bins)][has_tone] = gain*X[t]*(S21 + sigma*noise)
+
+        return np.clip(z.real, -2**31, 2**31-1) + 1j*np.clip(z.imag, -2**31, 2**31-1)
+
+
+
+
+# ============================================================================ #
+# EXTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# encodeSnap
+def encodeSnap(mux_sel, I, Q):
+    '''Encode I and Q into wide BRAM words for given mux_sel.
+    This is the inverse of alcove_base._getSnapData decoding.
+
+    mux_sel: (int) 0-adc, 1-pfb, 2-ddc, 3-accum.
+    I, Q:    (1D arrays of ints) 4096 samples each (as returned by the
+             decoder before any trimming, i.e. accum includes the first 4).
+
+    Return: (1D array of uint32) 8192 words.
+    '''
+
+    I = np.asarray(I).astype(np.int64)
+    Q = np.asarray(Q).astype(np.int64)
+    w = np.zeros((2048, 4), dtype=np.uint64)
+
+    def u(x, bits): # two's complement field
+        return (x & ((1 << bits) - 1)).astype(np.uint64)
+
+    if mux_sel == 0:   # adc
+        w[:,0] = (u(Q[1::2], 16) << np.uint64(16)) | u(Q[0::2], 16)
+        w[:,1] = (u(I[1::2], 16) << np.uint64(16)) | u(I[0::2], 16)
+
+    elif mux_sel == 1: # pfb, 18 bit fields
+        q0, i0, q1, i1 = u(Q[0::2],18), u(I[0::2],18), u(Q[1::2],18), u(I[1::2],18)
+        c0 = q0 | (i0 << np.uint64(18))                     # chunk0 bits 0-35
+        w[:,0] = c0 & np.uint64(0xFFFFFFFF)
+        w[:,1] = (c0 >> np.uint64(32)) | (q1 << np.uint64(4)) \
+            | ((i1 << np.uint64(22)) & np.uint64(0xFFFFFFFF))
+        w[:,2] = i1 >> np.uint64(10)
+
+    elif mux_sel == 2: # ddc, 19 bit fields
+        q0, i0, q1, i1 = u(Q[0::2],19), u(I[0::2],19), u(Q[1::2],19), u(I[1::2],19)
+        c0 = q0 | (i0 << np.uint64(19))                     # chunk0 bits 0-37
+        w[:,0] = c0 & np.uint64(0xFFFFFFFF)
+        w[:,1] = (c0 >> np.uint64(32)) | (q1 << np.uint64(6)) \
+            | ((i1 << np.uint64(25)) & np.uint64(0xFFFFFFFF))
+        w[:,2] = i1 >> np.uint64(7)
+
+    elif mux_sel == 3: # accum, 32 bit
+        w[:,0], w[:,1] = u(I[0::2], 32), u(Q[0::2], 32)
+        w[:,2], w[:,3] = u(I[1::2], 32), u(Q[1::2], 32)
+
+    return w.reshape(-1).astype(np.uint32)
+
+
+# ============================================================================ #
+# install
+def install(resonators=None, **kwargs):
+    '''Install the simulator as cfg_b.firmware.
+    Also registers simulated pynq (MMIO, Overlay) and xrfdc modules
+    so that the alcove commands find them.
+
+    resonators: (SimResonators) Resonators to simulate.
+    kwargs:     Passed to SimFirmware.
+
+    Return: (SimFirmware) The installed simulator.
+    '''
+
+    global _sim
+
+    _sim = SimFirmware(resonators=resonators, **kwargs)
+
+    pynq = types.ModuleType('pynq')
+    pynq.MMIO = MMIO
+    pynq.Overlay = lambda *args, **kw: _sim
+    sys.modules['pynq'] = pynq
+
+    xrfdc = types.ModuleType('xrfdc')
+    xrfdc.EVENT_MIXER = 1
+    sys.modules['xrfdc'] = xrfdc
+
+    # alcove_base imports xrfdc at module level
+    alcove_base = sys.modules.get('alcove_commands.alcove_base')
+    if alcove_base is not None:
+        alcove_base.xrfdc = xrfdc
+
+    if cfg_b is not None:
+        cfg_b.firmware = _sim
+
+    return _sim
+
+
+
+
+# ============================================================================ #
+# Testing
+# ============================================================================ #
+
+def simRun(drid=1, f_lo=600, vna_kwargs=None, **kwargs):
+    '''Run the standard tuning chain end to end on the simulator.
+    Prints the time taken by each command and the resonator recovery.
+
+    drid: (int) Drone identifier to simulate.
+    f_lo: (float) NCLO frequency [MHz].
+    vna_kwargs: (dict) Arguments for findVnaResonators.
+        The default filter cutoffs of findVnaResonators (alt finder) are
+        above Nyquist for the default sweep_steps, so these default to
+        scaled cutoffs.
+    kwargs: Passed to install().
+    '''
+
+    import os
+    import time
+    import tempfile
+
+    import alcove_commands.board_io as io
+    import alcove_commands.alcove_base as alcove_base
+    import alcove_commands.tones as tones
+    import alcove_commands.sweeps as sweeps
+    import alcove_commands.analysis as analysis
+
+    if vna_kwargs is None and cfg_b.vna_finder == 'mf':
+        vna_kwargs = {}
+    elif vna_kwargs is None:
+        vna_kwargs = {'continuum_wn':30, 'noise_wn':3000}
+
+    sim = install(**kwargs)
+
+    cfg_b.drid = drid
+    cfg_b.src_dir = os.getcwd()
+    cfg_b.drone_dir = tempfile.mkdtemp(prefix=f'sim_drone{drid}_')
+
+    coms = [
+        (alcove_base.setNCLO, (f_lo,), {}),
+        (tones.writeNewVnaComb, (), {}),
+        (sweeps.vnaSweep, (), {}),
+        (analysis.findVnaResonators, (), vna_kwargs),
+        (tones.writeTargCombFromVnaSweep, (), {}),
+        (sweeps.targetSweep, (), {}),
+        (analysis.findTargResonators, (), {'stitch_bw':cfg_b.sweep_steps})]
+
+    for com, args, kw in coms:
+        t0 = time.perf_counter()
+        com(*args, **kw)
+        print(f"{com.__name__}: {time.perf_counter() - t0:.2f} s")
+
+    # resonator recovery within the band
+    f0 = sim.resonators.f0
+    f0 = f0[np.abs(f0 - f_lo*1e6) < 254e6]
+    f_res = np.sort(io.load(io.file.f_res_targ).real)
+    if len(f_res):
+        i = np.clip(np.searchsorted(f_res, f0), 1, len(f_res) - 1)
+        d = np.minimum(np.abs(f_res[i] - f0), np.abs(f_res[i-1] - f0))
+        print(f"found {len(f_res)} of {len(f0)} resonators, " \
+              f"median offset {np.median(d):.0f} Hz")
+    print(f"data in {cfg_b.drone_dir}")
+
+    return sim
+
+
+# ============================================================================ #
+# simCompareVnaFinders
+def simCompareVnaFinders(drid=1, f_lo=600, tol=20e3, resonators=None, **kwargs):
+    '''VNA sweep on the simulator, then compare the vna resonator finders
+    (_findResonators_alt and _findResonators_mf) against the simulated
+    resonators. Prints recall, precision, and time of each.
+
+    tol: (float) Max distance of a found resonator from a true one [Hz].
+    resonators: (SimResonators) e.g. shallow or dense sets.
+    kwargs: Passed to install().
+    '''
+
+    import os
+    import time
+    import tempfile
+
+    import alcove_commands.board_io as io
+    import alcove_commands.alcove_base as alcove_base
+    import alcove_commands.tones as tones
+    import alcove_commands.sweeps as sweeps
+    import alcove_commands.analysis as analysis
+
+    sim = install(resonators=resonators, **kwargs)
+
+    cfg_b.drid = drid
+    cfg_b.src_dir = os.getcwd()
+    cfg_b.drone_dir = tempfile.mkdtemp(prefix=f'sim_drone{drid}_')
+
+    alcove_base.setNCLO(f_lo)
+    tones.writeNewVnaComb()
+    sweeps.vnaSweep()
+    f, Z = io.load(io.file.s21_vna)
+
+    f0 = sim.resonators.f0
+    f0 = f0[(f0 > f.real.min()) & (f0 < f.real.max())]
+
+    finders = (
+        ('alt', analysis._findResonators_alt, {'continuum_wn':30, 'noise_wn':3000}),
+        ('mf',  analysis._findResonators_mf,  {}))
+    for name, finder, kw in finders:
+        t0 = time.perf_counter()
+        f_res = np.sort(finder(f, Z, **kw).real)
+        dt = time.perf_counter() - t0
+
+        dist = lambda a, b: np.min(np.abs(a[:, None] - b[None]), axis=1)
+        recall = np.mean(dist(f0, f_res) < tol) if len(f_res) else 0
+        precision = np.mean(dist(f_res, f0) < tol) if len(f_res) else 0
+        print(f"{name}: found {len(f_res)} of {len(f0)}, recall {recall:.3f}, "
+              f"precision {precision:.3f}, {dt:.2f} s")
+
+    return sim
@@ -28,6 +28,7 @@ from config import parentDir
 import queen_commands.control_io as io
 import redis_channels as chans
 import queen_commands.test_functions as test
+import queen_commands.analysis_offload as offload
 import drone_control as drone_control
 
 
@@ -49,12 +50,14 @@ logging.basicConfig(
 def _com():
     return {
         1:alcoveCommand,
+        2:offload.offloadAnalysis,
         3:getKeyValue,
         4:setKeyValue,
         5:getClientList,
         6:getClientListLight,
         7:drone_control.action,
         8:monitorMode,
+        9:cancelCommand,
         10:test.tonePowerTest,
         11:test.adriansNoiseTest,
         12:test.targetSweepPowerTest,
@@ -126,8 +129,8 @@ def alcoveCommand(com_num, bid=None, drid=None, all_boards=False,
     # build Redis command channels
     chan = chans.comChan(bid, drid)
         
-    # subscribe for returns
-    p.psubscribe(chan.subRet)
+    # subscribe for returns (and partial returns)
+    p.psubscribe(chan.subRet, chan.subPart)
 
     # send the command
     num_clients = r.publish(chan.pub, payload) # send command
@@ -226,6 +229,25 @@ def monitorMode():
         time.sleep(cfg.monitor_interval) 
 
 
+# ============================================================================ #
+#  cancelCommand
+def cancelCommand(bid=None, drid=None):
+    """Request cancellation of running commands (e.g. sweeps).
+    Cancels on given drone, all drones on given board, or all boards.
+    Commands check for cancellation between steps, so may not stop at once.
+
+    bid: (int) Board identifier, optional.
+    drid: (int) Drone identifier (1-4), optional. Requires bid to be set.
+    """
+
+    r,p = _connectRedis()
+
+    key = chans.cancelKey(bid, drid)
+    r.incr(key)
+
+    print(f"cancelCommand: {key} requested.")
+
+
 # ============================================================================ #
 #  get/setKeyValue
 def getKeyValue(key):
@@ -378,6 +400,12 @@ def _catchAllResponses(p, num_clients):
         if new_message['type'] != 'pmessage':
             continue 
 
+        # partial returns are saved but don't count as responses
+        if new_message['channel'].decode('utf-8').startswith('parts_'):
+            _processCommandReturn(new_message['data'])
+            print(f"Partial return: {new_message['channel'].decode('utf-8')}")
+            continue
+
         # process this return
         resps.append(new_message)
         _processCommandReturn(new_message['data'])  # print and save
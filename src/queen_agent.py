@@ -33,6 +33,7 @@ def main(args=None):
     rt('getClientList', readout.getClientList)
     rt('getClientListLight', readout.getClientListLight)
     rt('action', readout.action)
+    rt('cancelCommand', readout.cancelCommand, b=False)
 
     # drone commands
     rt('setNCLO', readout.setNCLO)
@@ -51,9 +52,16 @@ def main(args=None):
     rt('vnaSweep', readout.vnaSweep)
     rt('targetSweep', readout.targetSweep)
     rt('customSweep', readout.customSweep)
+    rt('targetSweepPower', readout.targetSweepPower)
+    rt('tuneTargets', readout.tuneTargets)
     rt('findVnaResonators', readout.findVnaResonators)
     rt('findTargResonators', readout.findTargResonators)
+    rt('fitTargResonators', readout.fitTargResonators)
+    rt('calibrateTargSweep', readout.calibrateTargSweep)
+    rt('catalogResonators', readout.catalogResonators)
     rt('findCalTones', readout.findCalTones)
+    rt('analysisCache', readout.analysisCache)
+    rt('optimizeTonePowers', readout.optimizeTonePowers)
     rt('sys_info', readout.sys_info)
     rt('sys_info_v', readout.sys_info_v)
     rt('timestreamOn', readout.timestreamOn)
@@ -166,6 +174,27 @@ class ReadoutAgent:
         return True, f"action: {drone_control.action(action, bid, drid)}"
 
 
+    # ======================================================================== #
+    # .cancelCommand
+    @ocs_agent.param('com_to', default=None, type=str)
+    def cancelCommand(self, session, params):
+        """cancelCommand()
+
+        **Task** - Request cancellation of running drone commands, e.g. sweeps.
+
+        Args
+        -------
+        com_to: str
+            Drone to cancel commands on in format bid.drid.
+            If None, will cancel on all drones.
+            Default is None.
+        """
+
+        bid, drid = drone_control._bid_drid(params['com_to'])
+
+        return True, f"cancelCommand: {queen.cancelCommand(bid, drid)}"
+
+
     # ======================================================================== #
     # .setNCLO
     @ocs_agent.param('com_to', default=None, type=str)
@@ -511,6 +540,7 @@ class ReadoutAgent:
     # .vnaSweep
     @ocs_agent.param('com_to', default=None, type=str)
     @ocs_agent.param('silent', default=False, type=bool)
+    @ocs_agent.param('profile', default=None, type=str)
     def vnaSweep(self, session, params):
         """vnaSweep()
 
@@ -522,12 +552,19 @@ class ReadoutAgent:
             Drone to send command to in format bid.drid.
             If None, will send to all drones.
             Default is None.
+        profile: str
+            Sweep speed/SNR profile, e.g. 'fast', 'standard', 'deep'.
+            If None, uses the board configured profile.
+            Default is None.
         """
   
+        com_args = f'profile={params["profile"]}' if params['profile'] else None
+
         rtn = _sendAlcoveCommand(
             com_str  = 'vnaSweep', 
             com_to   = params['com_to'],
-            silent   = params['silent'])
+            silent   = params['silent'],
+            com_args = com_args)
         
         # return is a fail message str or number of clients int
         return True, f"vnaSweep: {rtn}"
@@ -537,6 +574,7 @@ class ReadoutAgent:
     # .targetSweep
     @ocs_agent.param('com_to', default=None, type=str)
     @ocs_agent.param('silent', default=False, type=bool)
+    @ocs_agent.param('profile', default=None, type=str)
     def targetSweep(self, session, params):
         """targetSweep()
 
@@ -548,12 +586,19 @@ class ReadoutAgent:
             Drone to send command to in format bid.drid.
             If None, will send to all drones.
             Default is None.
+        profile: str
+            Sweep speed/SNR profile, e.g. 'fast', 'standard', 'deep'.
+            If None, uses the board configured profile.
+            Default is None.
         """
   
+        com_args = f'profile={params["profile"]}' if params['profile'] else None
+
         rtn = _sendAlcoveCommand(
             com_str  = 'targetSweep', 
             com_to   = params['com_to'],
-            silent   = params['silent'])
+            silent   = params['silent'],
+            com_args = com_args)
         
         # return is a fail message str or number of clients int
         return True, f"targetSweep: {rtn}"
@@ -595,6 +640,114 @@ class ReadoutAgent:
         return True, f"customSweep: {rtn}"
 
 
+    # ======================================================================== #
+    # .targetSweepPower
+    @ocs_agent.param('com_to', default=None, type=str)
+    @ocs_agent.param('silent', default=False, type=bool)
+    @ocs_agent.param('n_sweeps', default=None, type=int)
+    @ocs_agent.param('step_db', default=None, type=float)
+    @ocs_agent.param('profile', default=None, type=str)
+    def targetSweepPower(self, session, params):
+        """targetSweepPower()
+
+        **Task** - Target sweeps at a series of resonator tone powers,
+            from the current comb amplitudes down, for optimizeTonePowers.
+            The comb is restored afterwards.
+            Note that the target comb must be written first.
+
+        Args
+        -------
+        com_to: str
+            Drone to send command to in format bid.drid.
+            If None, will send to all drones.
+            Default is None.
+        n_sweeps: int
+            Sweeps in the series.
+            If None, uses tone_power_sweeps in the board config.
+        step_db: float
+            Tone power step per sweep [dB].
+            If None, uses tone_power_step_db in the board config.
+        profile: str
+            Sweep speed/SNR profile, e.g. 'fast', 'standard', 'deep'.
+            If None, uses the board configured profile.
+            Default is None.
+        """
+
+        com_args = ', '.join(
+            f'{k}={params[k]}' for k in ('n_sweeps', 'step_db', 'profile')
+            if params[k] is not None)
+  
+        rtn = _sendAlcoveCommand(
+            com_str  = 'targetSweepPower', 
+            com_to   = params['com_to'],
+            silent   = params['silent'],
+            com_args = com_args or None)
+        
+        # return is a fail message str or number of clients int
+        return True, f"targetSweepPower: {rtn}"
+
+
+    # ======================================================================== #
+    # .tuneTargets
+    @ocs_agent.param('com_to', default=None, type=str)
+    @ocs_agent.param('silent', default=False, type=bool)
+    @ocs_agent.param('f_tol', default=None, type=float)
+    @ocs_agent.param('a_tol', default=None, type=float)
+    @ocs_agent.param('max_iters', default=None, type=int)
+    @ocs_agent.param('time_budget', default=None, type=float)
+    @ocs_agent.param('shrink', default=None, type=float)
+    @ocs_agent.param('profile', default=None, type=str)
+    def tuneTargets(self, session, params):
+        """tuneTargets()
+
+        **Task** - Iteratively retune the target tone frequencies and
+            amplitudes, sweeping only the tones not yet converged, with
+            narrower and fewer point sweeps each iteration.
+            Writes the target comb with the result.
+            Note that the target comb must be written first.
+
+        Args
+        -------
+        com_to: str
+            Drone to send command to in format bid.drid.
+            If None, will send to all drones.
+            Default is None.
+        f_tol: float
+            Frequency step tolerance [Hz].
+            If None, uses tune_f_tol in the board config.
+        a_tol: float
+            Relative amplitude step tolerance.
+            If None, uses tune_a_tol in the board config.
+        max_iters: int
+            Max iterations.
+            If None, uses tune_max_iters in the board config.
+        time_budget: float
+            No iteration is started that would end after this [s].
+            If None, uses tune_time_budget in the board config.
+        shrink: float
+            Sweep bandwidth and points factor per iteration.
+            If None, uses tune_shrink in the board config.
+        profile: str
+            Sweep speed/SNR profile, e.g. 'fast', 'standard', 'deep'.
+            If None, uses the board configured profile.
+            Default is None.
+        """
+
+        com_args = ', '.join(
+            f'{k}={params[k]}' for k in (
+                'f_tol', 'a_tol', 'max_iters', 'time_budget', 'shrink', 'profile')
+            if params[k] is not None)
+  
+        rtn = _sendAlcoveCommand(
+            com_str  = 'tuneTargets', 
+            com_to   = params['com_to'],
+            silent   = params['silent'],
+            com_args = com_args or None)
+        
+        # return is a fail message str or number of clients int
+        return True, f"tuneTargets: {rtn}"
+
+
     # ======================================================================== #
     # .findVnaResonators
     @ocs_agent.param('com_to', default=None, type=str)
@@ -610,6 +763,9 @@ class ReadoutAgent:
     @ocs_agent.param('continuum_wn', default=300, type=int)
     @ocs_agent.param('remove_noise', default=True, type=bool)
     @ocs_agent.param('noise_wn', default=30_000, type=int)
+    @ocs_agent.param('method', default=None, type=str)
+    @ocs_agent.param('snr', default=8, type=float)
+    @ocs_agent.param('offload', default=False, type=bool)
     def findVnaResonators(self, session, params):
         """findVnaResonators()
 
@@ -646,10 +802,21 @@ class ReadoutAgent:
             Whether to subtract noise.
         noise_wn: (int) 
             Noise filter cutoff frequency [Hz].
+        method: (str)
+            Finder: 'alt' (filters and peaks, the arguments above) or
+            'mf' (matched filter, uses stitch and snr).
+            If None, uses vna_finder in the board config (with the
+            arguments that finder takes).
+        snr: (float)
+            Matched filter detection threshold, in noise std.
+        offload: bool
+            Run the analysis on the queen (all drones in parallel)
+            instead of on the boards.
+            Default is False.
         """
   
-        com_args = ''
-        com_args += f'peak_prom_std={params["stitch_bw"]}, '
+        com_args = '' if params['method'] is None else f'method={params["method"]}, '
+        com_args += f'peak_prom_std={params["peak_prom_std"]}, '
         com_args += f'peak_prom_db={params["peak_prom_db"]}, '
         com_args += f'peak_dis={params["peak_dis"]}, '
         com_args += f'width_min={params["width_min"]}, '
@@ -660,11 +827,17 @@ class ReadoutAgent:
         com_args += f'continuum_wn={params["continuum_wn"]}, '
         com_args += f'remove_noise={params["remove_noise"]}, '
         com_args += f'noise_wn={params["noise_wn"]}'
+        if params['method'] is None:
+            com_args += f', snr={params["snr"]}'
+
+        if params['method'] == 'mf':
+            com_args = f'method=mf, snr={params["snr"]}, stitch={params["stitch"]}'
 
         rtn = _sendAlcoveCommand(
             com_str  = 'findVnaResonators', 
             com_to   = params['com_to'],
             silent   = params['silent'],
+            offload  = params['offload'],
             com_args = com_args)
         
         # return is a fail message str or number of clients int
@@ -703,6 +876,115 @@ class ReadoutAgent:
         return True, f"findTargResonators: {rtn}"
 
 
+    # ======================================================================== #
+    # .fitTargResonators
+    @ocs_agent.param('com_to', default=None, type=str)
+    @ocs_agent.param('silent', default=False, type=bool)
+    @ocs_agent.param('update_f_res', default=False, type=bool)
+    @ocs_agent.param('offload', default=False, type=bool)
+    def fitTargResonators(self, session, params):
+        """fitTargResonators()
+
+        **Task** - Fit the resonator S21 model to every tone of the
+            targSweep S21 (f0, Qr, Qc, Qi, nonlinearity, cable delay).
+            Note that targSweep must be run first.
+
+        Args
+        -------
+        com_to: str
+            Drone to send command to in format bid.drid.
+            If None, will send to all drones.
+            Default is None.
+        update_f_res: bool
+            Also save the fitted f0 as the target resonator frequencies.
+        offload: bool
+            Run the analysis on the queen (all drones in parallel)
+            instead of on the boards.
+            Default is False.
+        """
+  
+        rtn = _sendAlcoveCommand(
+            com_str  = 'fitTargResonators', 
+            com_to   = params['com_to'],
+            silent   = params['silent'],
+            offload  = params['offload'],
+            com_args = f'update_f_res={params["update_f_res"]}')
+        
+        # return is a fail message str or number of clients int
+        return True, f"fitTargResonators: {rtn}"
+
+
+    # ======================================================================== #
+    # .calibrateTargSweep
+    @ocs_agent.param('com_to', default=None, type=str)
+    @ocs_agent.param('silent', default=False, type=bool)
+    def calibrateTargSweep(self, session, params):
+        """calibrateTargSweep()
+
+        **Task** - IQ loop calibration (circle centre, rotation, phase slope)
+            of every tone of the targSweep S21. Runs after every targSweep
+            if iq_cal_auto is set in the board config.
+            Note that targSweep must be run first.
+
+        Args
+        -------
+        com_to: str
+            Drone to send command to in format bid.drid.
+            If None, will send to all drones.
+            Default is None.
+        """
+  
+        rtn = _sendAlcoveCommand(
+            com_str  = 'calibrateTargSweep', 
+            com_to   = params['com_to'],
+            silent   = params['silent'])
+        
+        # return is a fail message str or number of clients int
+        return True, f"calibrateTargSweep: {rtn}"
+
+
+    # ======================================================================== #
+    # .catalogResonators
+    @ocs_agent.param('com_to', default=None, type=str)
+    @ocs_agent.param('silent', default=False, type=bool)
+    @ocs_agent.param('kind', default='vna', type=str)
+    @ocs_agent.param('tol', default=None, type=float)
+    def catalogResonators(self, session, params):
+        """catalogResonators()
+
+        **Task** - Give the resonators of the latest findVnaResonators
+            or findTargResonators stable IDs, matching them to previous
+            sweeps. Runs after each of those if res_catalog_auto is set
+            in the board config.
+
+        Args
+        -------
+        com_to: str
+            Drone to send command to in format bid.drid.
+            If None, will send to all drones.
+            Default is None.
+        kind: str
+            'vna' or 'targ' resonators.
+            Default is 'vna'.
+        tol: float
+            Max match distance [Hz], after removing the common shift.
+            If None, uses res_catalog_tol in the board config.
+        """
+
+        com_args = f'kind={params["kind"]}'
+        if params['tol'] is not None:
+            com_args += f', tol={params["tol"]}'
+  
+        rtn = _sendAlcoveCommand(
+            com_str  = 'catalogResonators', 
+            com_to   = params['com_to'],
+            silent   = params['silent'],
+            com_args = com_args)
+        
+        # return is a fail message str or number of clients int
+        return True, f"catalogResonators: {rtn}"
+
+
     # ======================================================================== #
     # .findCalTones
     @ocs_agent.param('com_to', default=None, type=str)
@@ -711,6 +993,7 @@ class ReadoutAgent:
     @ocs_agent.param('f_hi', default=50, type=float)
     @ocs_agent.param('tol', default=2, type=float)
     @ocs_agent.param('max_tones', default=10, type=int)
+    @ocs_agent.param('offload', default=False, type=bool)
     def findCalTones(self, session, params):
         """findCalTones()
 
@@ -730,18 +1013,103 @@ class ReadoutAgent:
             Reject tones tol*std_noise from continuum.
         max_tones: int 
             Maximum number of tones to return.
+        offload: bool
+            Run the analysis on the queen (all drones in parallel)
+            instead of on the boards.
+            Default is False.
         """
   
         rtn = _sendAlcoveCommand(
             com_str  = 'findCalTones', 
             com_to   = params['com_to'],
             silent   = params['silent'],
+            offload  = params['offload'],
             com_args = f'f_hi={params["f_hi"]}, f_lo={params["f_lo"]}, tol={params["tol"]}, max_tones={params["max_tones"]}')
         
         # return is a fail message str or number of clients int
         return True, f"findCalTones: {rtn}"
 
 
+    # ======================================================================== #
+    # .analysisCache
+    @ocs_agent.param('com_to', default=None, type=str)
+    @ocs_agent.param('silent', default=False, type=bool)
+    @ocs_agent.param('clear', default=False, type=bool)
+    def analysisCache(self, session, params):
+        """analysisCache()
+
+        **Task** - Analysis result cache use (hits, misses, entries, size).
+            findVnaResonators, findTargResonators and findCalTones reuse
+            results for the same sweep and arguments.
+
+        Args
+        -------
+        com_to: str
+            Drone to send command to in format bid.drid.
+            If None, will send to all drones.
+            Default is None.
+        clear: bool
+            Remove all cache entries (of all drones on the board).
+        """
+  
+        rtn = _sendAlcoveCommand(
+            com_str  = 'analysisCache', 
+            com_to   = params['com_to'],
+            silent   = params['silent'],
+            com_args = f'clear={params["clear"]}')
+        
+        # return is a fail message str or number of clients int
+        return True, f"analysisCache: {rtn}"
+
+
+    # ======================================================================== #
+    # .optimizeTonePowers
+    @ocs_agent.param('com_to', default=None, type=str)
+    @ocs_agent.param('silent', default=False, type=bool)
+    @ocs_agent.param('method', default=None, type=str)
+    @ocs_agent.param('target', default=None, type=float)
+    @ocs_agent.param('write_comb', default=True, type=bool)
+    def optimizeTonePowers(self, session, params):
+        """optimizeTonePowers()
+
+        **Task** - Choose every resonator tone amplitude from the latest
+            targetSweepPower series (where its nonlinearity reaches target,
+            below bifurcation), and write the comb with them.
+            Note that targetSweepPower must be run first.
+
+        Args
+        -------
+        com_to: str
+            Drone to send command to in format bid.drid.
+            If None, will send to all drones.
+            Default is None.
+        method: str
+            'asym' (dip asymmetry) or 'fit' (fitted nonlinearity).
+            If None, uses tone_power_method in the board config.
+        target: float
+            Metric to drive each tone at.
+            If None, uses tone_power_targets in the board config.
+        write_comb: bool
+            Save and write the custom comb with the new amplitudes.
+            Default is True.
+        """
+
+        com_args = f'write_comb={params["write_comb"]}'
+        if params['method'] is not None:
+            com_args += f', method={params["method"]}'
+        if params['target'] is not None:
+            com_args += f', target={params["target"]}'
+  
+        rtn = _sendAlcoveCommand(
+            com_str  = 'optimizeTonePowers', 
+            com_to   = params['com_to'],
+            silent   = params['silent'],
+            com_args = com_args)
+        
+        # return is a fail message str or number of clients int
+        return True, f"optimizeTonePowers: {rtn}"
+
+
     # ======================================================================== #
     # .sys_info
     @ocs_agent.param('com_to', default=None, type=str)
@@ -911,7 +1279,8 @@ def _comNumAlcove(com_str):
 
 # ============================================================================ #
 # _sendAlcoveCommand
-def _sendAlcoveCommand(com_str, com_to, com_args=None, silent=False):
+def _sendAlcoveCommand(com_str, com_to, com_args=None, silent=False, 
+                       offload=False):
     """Send Alcove command.
 
     com_str:    (str)   String name of command. 
@@ -922,10 +1291,19 @@ def _sendAlcoveCommand(com_str, com_to, com_args=None, silent=False):
     com_args:   (str)   Command arguments.
                         E.g. 'f_lo=500'
     ret_data:   (bool)  Whether the board should return data or be silent.
+    offload:    (bool)  Run the (analysis) command on the queen instead.
+                        See queen_commands/analysis_offload.py.
     """
 
     print(com_str, com_to, com_args)
 
+    if offload:
+        ids = com_to.split('.') if com_to else []
+        bid = int(ids[0]) if len(ids)>0 else None
+        drid = int(ids[1]) if len(ids)>1 else None
+        return queen.offload.offloadAnalysis(
+            com_str, bid=bid, drid=drid, all_boards=not bid, args=com_args)
+
     com_num = _comNumAlcove(com_str)
     ret_data = not silent
 
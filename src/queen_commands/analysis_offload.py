@@ -0,0 +1,160 @@
+# ============================================================================ #
+# queen_commands/analysis_offload.py
+# Run drone analysis commands on the control computer (queen).
+# CCAT Prime 2024
+# ============================================================================ #
+
+#############################################################
+### The drone returns the inputs of an analysis command   ###
+### (getAnalysisInputs), the queen runs the same command  ###
+### in a process pool (one drone per process) on a mirror ###
+### of the drone's data directory, and leaves the files   ###
+### it wrote in Redis for the drone to save as its own    ###
+### (putAnalysisResults).                                 ###
+#############################################################
+
+import os
+import pickle
+
+import redis_channels as chans
+import queen_commands.control_io as io
+from config import queen as cfg
+
+
+
+# ============================================================================ #
+# EXTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# offloadAnalysis
+def offloadAnalysis(com, bid=None, drid=None, all_boards=False, args=None,
+                    **kwargs):
+    '''Run an analysis command for the given drone[s] on the queen, saving
+    the results on the drones. See analysis.OFFLOAD_INPUTS for commands.
+
+    com: (str) Analysis command name, e.g. 'findVnaResonators'.
+    bid: (int) Board identifier, optional. All boards if None.
+    drid: (int) Drone identifier (1-4), optional. Requires bid to be set.
+    all_boards: (bool) Send to all boards instead of bid/drid.
+    args: (str) Command arguments, e.g. 'peak_prom_std=12'.
+    kwargs: More command arguments.
+
+    Return: (dict) Drone id: names of the files saved, or an error str.
+    '''
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import queen  # not at import, so worker processes can import this module
+    import alcove
+
+    _, kw = queen._strToArgsAndKwargs(args)
+    kw.update(kwargs)
+
+    # inputs from the drone[s]
+    _, resps = queen.alcoveCommand(
+        alcove.comNumFromStr('getAnalysisInputs'), bid=bid, drid=drid,
+        all_boards=all_boards or not bid, args=f'com={com}')
+
+    rtn = {}
+    jobs = []
+    for resp in resps:
+        chan = chans.comChan(chan=resp['channel'].decode('utf-8'))
+        d = pickle.loads(resp['data'])
+        if isinstance(d, list):
+            jobs.append((chan.bid, chan.drid, d))
+        else: # error message
+            rtn[chan.id] = d
+
+    r, p = queen._connectRedis()
+    with ProcessPoolExecutor(max_workers=cfg.offload_workers) as ex:
+        futs = {
+            ex.submit(_runAnalysis, com, b, dr, d, kw):(b, dr)
+            for b, dr, d in jobs}
+
+        # back to each drone as it finishes
+        for fut in as_completed(futs):
+            b, dr = futs[fut]
+            id = f'{b}.{dr}'
+            try:
+                res = fut.result()
+            except Exception as e:
+                rtn[id] = f"Offloaded {com} failed: {e}"
+                print(rtn[id])
+                continue
+
+            io.saveWrappedToTmp(res) # as returns from the drones
+
+            key = chans.offloadKey(b, dr)
+            r.set(key, pickle.dumps(res), ex=cfg.offload_expire)
+            _, rr = queen.alcoveCommand(
+                alcove.comNumFromStr('putAnalysisResults'), bid=b, drid=dr,
+                args=f'key={key}')
+            rtn[id] = pickle.loads(rr[0]['data']) if rr else "No response."
+
+    print(f"offloadAnalysis: {com}: {rtn}")
+
+    return rtn
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _runAnalysis
+def _runAnalysis(com_str, bid, drid, inputs, kwargs):
+    '''Run an analysis command on the inputs of one drone (process pool).
+
+    inputs: (list) returnWrapper of each input file (getAnalysisInputs).
+
+    Return: (list) returnWrapper of each file the command wrote.
+    '''
+
+    import shutil
+    from config import board as cfg_b
+    import alcove_commands.board_io as bio
+    import alcove_commands.analysis as analysis
+
+    # mirror of the drone's directories (inputs only)
+    mirror = os.path.join(cfg.dir_root, cfg.offload_dir, f'drone{bid}.{drid}')
+    shutil.rmtree(mirror, ignore_errors=True)
+    cfg_b.bid, cfg_b.drid = bid, drid
+    cfg_b.drone_dir = os.path.join(mirror, 'drone')
+    cfg_b.src_dir = os.path.join(mirror, 'src')
+
+    # the catalog is on the drone (updated by putAnalysisResults)
+    cfg_b.res_catalog_auto = False
+
+    for w in inputs:
+        bio.save(bio.fileByName(w['filename']), w['data'], timestamp=w['timestamp'])
+
+    v0 = _versions(bio, cfg_b.drone_dir)
+    getattr(analysis, com_str)(**kwargs)
+    v1 = _versions(bio, cfg_b.drone_dir)
+
+    files = bio.fileAttrs()
+    new = [name for name in v1 if v1[name] != v0.get(name)]
+
+    return bio.returnWrapperMultiple(
+        [files[name] for name in new],
+        [bio.loadVersion(files[name], v1[name]) for name in new])
+
+
+# ============================================================================ #
+# _versions
+def _versions(bio, dname):
+    '''Most recent version (timestamp) of each timestamped file in dname.
+    '''
+
+    v = {}
+    for name, f in bio.fileAttrs().items():
+        if f.get('use_timestamp') and f['dname'].startswith(dname):
+            try:
+                v[name] = bio.mostRecentTimestamp(f)
+            except IndexError: # none yet
+                pass
+
+    return v
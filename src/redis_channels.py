@@ -54,13 +54,14 @@ def _bidDrid(id):
 
 # ============================================================================ #
 # _pubChan
-def _pubChan(bid=None, drid=None, cid=None, ret=False):
+def _pubChan(bid=None, drid=None, cid=None, ret=False, part=False):
     '''Redis publish channel.
 
     bid: (int) Board identifier.
     drid: (int) Drone identifier {1,4}.
     cid: (str) Unique channel identifier.
     ret: (bool) Whether this is a return channel or not.
+    part: (bool) Whether this is a partial return channel or not.
     '''
 
     chan = 'board'
@@ -78,23 +79,28 @@ def _pubChan(bid=None, drid=None, cid=None, ret=False):
     if ret:
         chan = f'rets_{chan}' # e.g. rets_board_1.1
 
+    elif part:
+        chan = f'parts_{chan}' # e.g. parts_board_1.1
+
     return chan
 
 
 # ============================================================================ #
 # _subChan
-def _subChan(bid=None, drid=None, cid=None, ret=False, wildcard=True):
+def _subChan(bid=None, drid=None, cid=None, ret=False, part=False, 
+             wildcard=True):
     '''Redis subscribe channel.
 
     bid: (int) Board identifier.
     drid: (int) Drone identifier {1,4}.
     cid: (str) Unique channel identifier.
     ret: (bool) Whether this is a return channel or not.
+    part: (bool) Whether this is a partial return channel or not.
     wildcard: (bool) Will wildcard catch all sub channels.
         e.g. bid=1 will catch all channels to any drone on board 1.
     '''
 
-    chan = f'{_pubChan(bid, drid, cid, ret)}'
+    chan = f'{_pubChan(bid, drid, cid, ret, part)}'
 
     if wildcard:
         chan = f'{chan}_*'
@@ -136,8 +142,8 @@ def _recoverChanParts(chan):
     # get the default chan words
     base_words = _pubChan(ret=True).split('_') # ['rets','board','all']
 
-    # remove 'rets' if it exists
-    if words[0] == base_words[0]:
+    # remove 'rets' (or 'parts') if it exists
+    if words[0] in (base_words[0], 'parts'):
         words = words[1:]
 
     # get cid if it exists
@@ -190,6 +196,8 @@ class comChan:
         self.pubRet = _pubChan(bid, drid, cid, ret=True)
         self.sub    = _subChan(bid, drid, cid=None, ret=False)
         self.subRet = _subChan(bid, drid, cid=None, ret=True)
+        self.pubPart = _pubChan(bid, drid, cid, part=True)
+        self.subPart = _subChan(bid, drid, cid=None, part=True)
 
 
 # ============================================================================ #
@@ -211,6 +219,53 @@ def subList(bid, drid):
     return chans
 
 
+# ============================================================================ #
+# cancelKey
+def cancelKey(bid=None, drid=None):
+    '''Redis key used to request cancellation of running commands.
+    The value is a counter which is incremented for each cancel request.
+
+    bid: (int) Board identifier.
+    drid: (int) Drone identifier {1,4}.
+
+    Return: (str) key e.g. 'cancel_board_1.1' or 'cancel_board_all'
+    '''
+
+    return f'cancel_{_pubChan(bid, drid)}'
+
+
+# ============================================================================ #
+# cancelKeyList
+def cancelKeyList(bid, drid):
+    '''List of all cancel keys relevant to given bid and drid.
+
+    bid: (int) Board identifier.
+    drid: (int) Drone identifier {1,4}.
+    '''
+
+    keys = []
+    keys += [cancelKey(bid, drid)]
+    keys += [cancelKey(bid, drid=None)]
+    keys += [cancelKey(bid=None, drid=None)]
+
+    return keys
+
+
+# ============================================================================ #
+# offloadKey
+def offloadKey(bid, drid):
+    '''Unique Redis key for data the queen leaves for a drone
+    (e.g. results of analysis offloaded to the queen).
+
+    bid: (int) Board identifier.
+    drid: (int) Drone identifier {1,4}.
+
+    Return: (str) key e.g. 'offload_board_1.1_16fd2706-...'
+    '''
+
+    return f'offload_{_pubChan(bid, drid, cid=str(uuid.uuid4()))}'
+
+
 
 
 # ============================================================================ #
@@ -237,6 +292,8 @@ def testBidDridChan():
         print(f'{chan.pubRet=}')
         print(f'{chan.sub=}')
         print(f'{chan.subRet=}')
+        print(f'{chan.pubPart=}')
+        print(f'{chan.subPart=}')
 
 def testChan():
     # chan tests:
@@ -245,7 +302,7 @@ def testChan():
     chans += ['board_1.1', 'board_1.2', 'board_1.3', 'board_1.4', 'board_1.5', 'board_1.10']
     chans += ['board_2.4', 'board_3.5', 'board_10.1', 'board_10.10']
     chans += ['board_16fd2706-8baf-433b-82eb-8c7fada847da', 'board_1_16fd2706-8baf-433b-82eb-8c7fada847da', 'board_1.1_16fd2706-8baf-433b-82eb-8c7fada847da']
-    chans += ['rets_' + e for e in chans] # add rets version of all
+    chans += ['rets_' + e for e in chans] + ['parts_' + e for e in chans] # add rets/parts version of all
 
     for chan in chans:
         cchan = comChan(None, None, chan)